@@ -0,0 +1,223 @@
+import struct
+import weakref
+from typing import BinaryIO, Dict, Iterator, Tuple
+from decoder import DecodedInsn, MAX_INSN_SIZE
+
+# Compact binary execution traces. A trace starts with TRACE_MAGIC, followed by fixed-size records that each start
+# with their event type. Instruction and memory addresses are stored as deltas to the previous address of the same
+# stream, with an EV_REBASE record whenever a delta doesn't fit in 32 bits. Instruction bytes are stored in an EV_CODE
+# record right before the first execution of each address, and again when they changed (self-modifying code), so traces
+# can be disassembled offline.
+
+TRACE_MAGIC = b"MUWMTRC1"
+
+# Event types
+EV_INSN = 1
+EV_MEM_READ_HIT = 2
+EV_MEM_READ_MISS = 3
+EV_MEM_WRITE = 4
+EV_CHECKPOINT = 5
+EV_ROLLBACK = 6
+EV_SPEC_WINDOW_EXCEEDED = 7
+EV_CACHE_FLUSH = 8
+EV_CODE = 9     # bytes of the instruction in the next EV_INSN record
+EV_REBASE = 10  # sets the previous address of a stream
+EV_ROUND = 11   # round marker (e.g. the round_count of the SHA-1 drivers)
+
+EVENT_NAMES = {
+    EV_INSN: "insn",
+    EV_MEM_READ_HIT: "mem_read_hit",
+    EV_MEM_READ_MISS: "mem_read_miss",
+    EV_MEM_WRITE: "mem_write",
+    EV_CHECKPOINT: "checkpoint",
+    EV_ROLLBACK: "rollback",
+    EV_SPEC_WINDOW_EXCEEDED: "spec_window_exceeded",
+    EV_CACHE_FLUSH: "cache_flush",
+    EV_ROUND: "round",
+}
+
+# Address streams that are delta-encoded
+STREAM_INSN = 0
+STREAM_MEM = 1
+
+# Record layouts, all little-endian and starting with the event type
+INSN_RECORD = struct.Struct("<Bi")            # type, address delta
+MEM_READ_RECORD = struct.Struct("<BiB")       # type, address delta, size
+MEM_WRITE_RECORD = struct.Struct("<BiBQ")     # type, address delta, size, value
+ADDR_RECORD = struct.Struct("<BQ")            # type, absolute address (checkpoint, rollback, cache flush) or round
+SPEC_RECORD = struct.Struct("<BII")           # type, speculation depth, speculation limit
+CODE_RECORD = struct.Struct(f"<BB{MAX_INSN_SIZE}s")  # type, instruction size, instruction bytes
+REBASE_RECORD = struct.Struct("<BBQ")         # type, stream, absolute address
+
+RECORDS: Dict[int, struct.Struct] = {
+    EV_INSN: INSN_RECORD,
+    EV_MEM_READ_HIT: MEM_READ_RECORD,
+    EV_MEM_READ_MISS: MEM_READ_RECORD,
+    EV_MEM_WRITE: MEM_WRITE_RECORD,
+    EV_CHECKPOINT: ADDR_RECORD,
+    EV_ROLLBACK: ADDR_RECORD,
+    EV_SPEC_WINDOW_EXCEEDED: SPEC_RECORD,
+    EV_CACHE_FLUSH: ADDR_RECORD,
+    EV_CODE: CODE_RECORD,
+    EV_REBASE: REBASE_RECORD,
+    EV_ROUND: ADDR_RECORD,
+}
+
+INT32_MIN = -(1 << 31)
+INT32_MAX = (1 << 31) - 1
+
+class TraceWriter():
+    """
+    Writes a binary execution trace through a buffered stream. Call close() (or use it as a context manager) to make
+    sure all records are written.
+    """
+    def __init__(self, path: str, buffer_size: int = 1 << 20):
+        self.path = path
+        self.file: BinaryIO = open(path, 'wb', buffering=buffer_size)
+        self._finalizer = weakref.finalize(self, self.file.close)
+        self._write = self.file.write
+        self._write(TRACE_MAGIC)
+
+        self.prev_insn_addr = 0
+        self.prev_mem_addr = 0
+        self.seen_code: Dict[int, bytes] = {}  # instruction bytes last written per address
+
+    def _rebase(self, stream: int, address: int):
+        self._write(REBASE_RECORD.pack(EV_REBASE, stream, address))
+
+    def insn(self, insn: DecodedInsn):
+        address = insn.address
+        insn_bytes = self.seen_code.get(address)
+        if insn_bytes is not insn.bytes:  # the same object until the decode cache drops the instruction
+            self.seen_code[address] = insn.bytes
+            if insn_bytes != insn.bytes:
+                self._write(CODE_RECORD.pack(EV_CODE, insn.size, insn.bytes))
+
+        delta = address - self.prev_insn_addr
+        if not INT32_MIN <= delta <= INT32_MAX:
+            self._rebase(STREAM_INSN, address)
+            delta = 0
+        self.prev_insn_addr = address
+        self._write(INSN_RECORD.pack(EV_INSN, delta))
+
+    def mem_read(self, address: int, size: int, hit: bool):
+        delta = address - self.prev_mem_addr
+        if not INT32_MIN <= delta <= INT32_MAX:
+            self._rebase(STREAM_MEM, address)
+            delta = 0
+        self.prev_mem_addr = address
+        self._write(MEM_READ_RECORD.pack(EV_MEM_READ_HIT if hit else EV_MEM_READ_MISS, delta, size))
+
+    def mem_write(self, address: int, size: int, value: int):
+        delta = address - self.prev_mem_addr
+        if not INT32_MIN <= delta <= INT32_MAX:
+            self._rebase(STREAM_MEM, address)
+            delta = 0
+        self.prev_mem_addr = address
+        self._write(MEM_WRITE_RECORD.pack(EV_MEM_WRITE, delta, size, value & 0xFFFFFFFFFFFFFFFF))
+
+    def checkpoint(self, next_insn_addr: int):
+        self._write(ADDR_RECORD.pack(EV_CHECKPOINT, next_insn_addr))
+
+    def rollback(self, next_insn_addr: int):
+        self._write(ADDR_RECORD.pack(EV_ROLLBACK, next_insn_addr))
+
+    def spec_window_exceeded(self, depth: int, limit: int):
+        self._write(SPEC_RECORD.pack(EV_SPEC_WINDOW_EXCEEDED, depth, limit))
+
+    def cache_flush(self, address: int):
+        self._write(ADDR_RECORD.pack(EV_CACHE_FLUSH, address))
+
+    def round(self, round_num: int):
+        self._write(ADDR_RECORD.pack(EV_ROUND, round_num))
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        self._finalizer()  # closes the file only once
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+# A decoded event: (event type, address, size, value, instruction bytes). Unused fields are 0 (or b"" for the bytes).
+# Speculation window exceeded events report the depth and limit as size and value, round markers the round as value.
+TraceEvent = Tuple[int, int, int, int, bytes]
+
+class TraceReader():
+    """
+    Decodes the records of a binary trace. Decoding can start in the middle of a trace by restoring the previous
+    addresses of both streams and passing the instruction bytes seen before (see trace_index.py).
+    """
+    def __init__(self, data: bytes, prev: Tuple[int, int] = (0, 0), code: Dict[int, bytes] = None):
+        if not data.startswith(TRACE_MAGIC):
+            raise ValueError("Not a binary execution trace")
+        self.data = data
+        self.prev = list(prev)  # previous address per stream
+        self.code: Dict[int, bytes] = {} if code is None else code
+        self.pending_code: bytes = None
+        self.offset: int = len(TRACE_MAGIC)  # offset of the next record, prev holds the decoder state at it
+
+    def events(self, offset: int = len(TRACE_MAGIC), end: int = None) -> Iterator[Tuple[int, TraceEvent]]:
+        """
+        Yields (record offset, event) tuples with absolute addresses for the records in [offset, end).
+        EV_CODE and EV_REBASE records are resolved internally.
+        """
+        self.offset = offset
+        data = self.data
+        prev = self.prev
+        code = self.code
+        if end is None:
+            end = len(data)
+        while offset < end:
+            record_offset = offset
+            event = data[offset]
+            record = RECORDS.get(event)
+            if record is None:
+                raise ValueError(f"Unknown event type {event} at offset {offset}")
+            fields = record.unpack_from(data, offset)
+            offset += record.size
+
+            if event == EV_INSN:
+                address = prev[STREAM_INSN] + fields[1]
+                prev[STREAM_INSN] = address
+                if self.pending_code is not None:
+                    code[address] = self.pending_code
+                    self.pending_code = None
+                insn_bytes = code.get(address, b"")
+                item = (event, address, len(insn_bytes), 0, insn_bytes)
+            elif event == EV_MEM_READ_HIT or event == EV_MEM_READ_MISS:
+                address = prev[STREAM_MEM] + fields[1]
+                prev[STREAM_MEM] = address
+                item = (event, address, fields[2], 0, b"")
+            elif event == EV_MEM_WRITE:
+                address = prev[STREAM_MEM] + fields[1]
+                prev[STREAM_MEM] = address
+                item = (event, address, fields[2], fields[3], b"")
+            elif event == EV_SPEC_WINDOW_EXCEEDED:
+                item = (event, 0, fields[1], fields[2], b"")
+            elif event == EV_ROUND:
+                item = (event, 0, 0, fields[1], b"")
+            elif event == EV_CODE:
+                self.pending_code = fields[2][:fields[1]]
+                continue
+            elif event == EV_REBASE:
+                prev[fields[1]] = fields[2]
+                continue
+            else:
+                item = (event, fields[1], 0, 0, b"")
+
+            self.offset = offset
+            yield record_offset, item
+
+def read_trace(path: str) -> Iterator[TraceEvent]:
+    """
+    Yields the events of a binary trace file with absolute addresses.
+    """
+    with open(path, 'rb') as f:
+        data = f.read()
+    for _, event in TraceReader(data).events():
+        yield event
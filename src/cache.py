@@ -9,6 +9,7 @@ class Cache(ABC):
     """
     Abstract base class for cache implementations
     """
+    tag_only: bool = False  # only tracks which lines are cached, read() returns None instead of line data
     
     @abstractmethod
     def get_set_index(self, address: int) -> int:
@@ -56,42 +57,60 @@ class Cache(ABC):
         pass
 
 
+_MISSING = object()  # default for dict lookups, line data can be any value
+
+def _log2(n: int) -> Optional[int]:
+    """Returns log2(n) if n is a power of two, None otherwise"""
+    return n.bit_length() - 1 if n > 0 and n & (n - 1) == 0 else None
+
+
 class LRUCache():
     """
     A simple L1D set-associative cache model with LRU replacement policy
     """
-    def __init__(self, amt_sets=64, amt_ways=8, line_size=64, debug=False):
+    def __init__(self, amt_sets=64, amt_ways=8, line_size=64, debug=False, tag_only=False):
         """
         Args:
             sets: Number of cache sets (default: 64 for a typical L1D cache)
             ways: Number of ways per set (default: 8-way associative)
             line_size: Size of each cache line in bytes (default: 64 bytes)
+            tag_only: Only track which lines are cached, without their data (no memory reads on misses)
         """
         self.amt_sets = amt_sets
         self.amt_ways = amt_ways
         self.line_size = line_size
         self.debug = debug
+        self.tag_only = tag_only
+
+        # addresses are split with shifts and masks for power-of-two geometries
+        self._line_shift = _log2(line_size)
+        self._set_shift = _log2(amt_sets)
+        self._set_mask = amt_sets - 1
         
-        # Initialize cache structure as a dictionary of sets
-        # Each set is a list of (tag, data) tuples representing the ways
-        self.cache = {i: [] for i in range(amt_sets)}
+        # Initialize cache structure as a list of sets
+        # Each set maps tag -> data, in LRU order: the first entry is the least, the last the most recently used
+        self.cache = [{} for _ in range(amt_sets)]
     
     def get_set_index(self, address) -> int:
         return (address // self.line_size) % self.amt_sets
     
     def get_tag(self, address) -> int:
         return address // (self.line_size * self.amt_sets)
+
+    def _lookup(self, address):
+        """Returns the set and the tag of an address"""
+        if self._line_shift is not None and self._set_shift is not None:
+            line = address >> self._line_shift
+            return self.cache[line & self._set_mask], line >> self._set_shift
+        tag, set_index = divmod(address // self.line_size, self.amt_sets)
+        return self.cache[set_index], tag
     
     def is_cached(self, address) -> bool:
-        set_index = self.get_set_index(address)
-        tag = self.get_tag(address)
-        cache_set = self.cache[set_index]
-        
-        for existing_tag, _ in cache_set:
-            if existing_tag == tag:
-                if self.debug:
-                    print(f"Present in cache: 0x{address:x}")
-                return True
+        cache_set, tag = self._lookup(address)
+        if tag in cache_set:
+            if self.debug:
+                print(f"Present in cache: 0x{address:x}")
+            return True
         
         if self.debug:
             print(f"Not present in cache: 0x{address:x}")
@@ -101,61 +120,52 @@ class LRUCache():
         if self.debug:
             print(f"Reading from cache: 0x{address:x}")
 
-        set_idx = self.get_set_index(address)
-        tag = self.get_tag(address)
-        cache_set = self.cache[set_idx]
-
-        for i, (existing_tag, data) in enumerate(cache_set):
-            if existing_tag == tag:
-                # Cache hit, move to start (MRU position)
-                cache_set.insert(0, cache_set.pop(i))
-                return data
+        cache_set, tag = self._lookup(address)
+        data = cache_set.pop(tag, _MISSING)
+        if data is not _MISSING:
+            # Cache hit, move to the end (MRU position)
+            cache_set[tag] = data
+            return data
         
         # Cache miss - read from memory and update cache
-        value = mu.mem_read(address, self.line_size)
+        value = None if self.tag_only else mu.mem_read(address, self.line_size)
         self.write(address, value)
         return value
     
     def write(self, address, value):
-        set_idx = self.get_set_index(address)
-        tag = self.get_tag(address)
-        cache_set = self.cache[set_idx]
+        cache_set, tag = self._lookup(address)
+        if self.tag_only:
+            value = None
 
-        for i, (existing_tag, data) in enumerate(cache_set):
-            if existing_tag == tag:
-                # Cache hit, remove old value and insert new at start (MRU position)
-                cache_set.pop(i)
-                cache_set.insert(0, (tag, value))
-                if self.debug:
-                    print(f"Writing to cache: 0x{address:x}, value = {value} (replaced old value)")
+        if tag in cache_set:
+            # Cache hit, remove old value and insert new at the end (MRU position)
+            del cache_set[tag]
+            cache_set[tag] = value
+            if self.debug:
+                print(f"Writing to cache: 0x{address:x}, value = {value} (replaced old value)")
 
-                return
+            return
 
         # Cache miss, add to cache
         if len(cache_set) >= self.amt_ways:
-            # Evict least recently used (last item)
-            cache_set.pop(-1)
-        cache_set.insert(0, (tag, value))
+            # Evict least recently used (first item)
+            del cache_set[next(iter(cache_set))]
+        cache_set[tag] = value
 
         if self.debug:
             print(f"Writing to cache: 0x{address:x}, value = {value}")
     
     def flush(self):
-        self.cache = {i: [] for i in range(self.amt_sets)}
+        self.cache = [{} for _ in range(self.amt_sets)]
         if self.debug:
             print("Flushed complete cache")
     
     def flush_address(self, address):
-        set_index = self.get_set_index(address)
-        tag = self.get_tag(address)
-        cache_set = self.cache[set_index]
-        
-        for i, (existing_tag, _) in enumerate(cache_set):
-            if existing_tag == tag:
-                cache_set.pop(i)
-                if self.debug:
-                    print(f"Flushed address 0x{address:x} from cache")
-                return
+        cache_set, tag = self._lookup(address)
+        if cache_set.pop(tag, _MISSING) is not _MISSING:
+            if self.debug:
+                print(f"Flushed address 0x{address:x} from cache")
+            return
         
         if self.debug:
             print(f"Address 0x{address:x} was not in cache, nothing to flush")
@@ -172,7 +182,7 @@ class LRUCache():
             sets_to_print = min(max_sets, self.amt_sets)
             
         total_size_kb = (self.amt_sets * self.amt_ways * self.line_size) / 1024
-        occupancy = sum(len(ways) for ways in self.cache.values())
+        occupancy = sum(len(ways) for ways in self.cache)
         total_ways = self.amt_sets * self.amt_ways
         
         print(f"L1D Cache Status:")
@@ -188,7 +198,7 @@ class LRUCache():
                 
             print(f"Set {set_idx:3d}: {len(ways)}/{self.amt_ways} ways occupied")
             
-            for way_idx, (tag, data) in enumerate(ways):
+            for way_idx, (tag, data) in enumerate(reversed(ways.items())):
                 # Calculate the full address from tag and set
                 addr = (tag * self.amt_sets + set_idx) * self.line_size
                 
@@ -198,6 +208,8 @@ class LRUCache():
                     data_preview = binascii.hexlify(data[:data_preview_bytes]).decode()
                     if len(data) > data_preview_bytes:
                         data_preview += "..."
+                elif self.tag_only:
+                    data_preview = "(tag only)"
                 else:
                     data_preview = str(data)
                     
@@ -211,37 +223,48 @@ class LRUCache():
 
 
 class InfiniteCache():
-    def __init__(self, amt_sets=64, line_size=64, debug=False):
+    def __init__(self, amt_sets=64, line_size=64, debug=False, tag_only=False):
         """
         Args:
             amt_sets: Number of cache sets (default: 64 for a typical L1D cache)
             line_size: Size of each cache line in bytes (default: 64 bytes)
+            tag_only: Only track which lines are cached, without their data (no memory reads on misses)
             Note: No amt_ways parameter since sets can grow infinitely
         """
         self.amt_sets = amt_sets
         self.line_size = line_size
         self.debug = debug
+        self.tag_only = tag_only
+
+        # addresses are split with shifts and masks for power-of-two geometries
+        self._line_shift = _log2(line_size)
+        self._set_shift = _log2(amt_sets)
+        self._set_mask = amt_sets - 1
         
-        # Initialize cache structure as a dictionary of sets
-        # Each set is a list of (tag, data) tuples with no size limit
-        self.cache = {i: [] for i in range(amt_sets)}
+        # Initialize cache structure as a list of sets
+        # Each set maps tag -> data with no size limit, in insertion order
+        self.cache = [{} for _ in range(amt_sets)]
     
     def get_set_index(self, address) -> int:
         return (address // self.line_size) % self.amt_sets
     
     def get_tag(self, address) -> int:
         return address // (self.line_size * self.amt_sets)
+
+    def _lookup(self, address):
+        """Returns the set and the tag of an address"""
+        if self._line_shift is not None and self._set_shift is not None:
+            line = address >> self._line_shift
+            return self.cache[line & self._set_mask], line >> self._set_shift
+        tag, set_index = divmod(address // self.line_size, self.amt_sets)
+        return self.cache[set_index], tag
     
     def is_cached(self, address) -> bool:
-        set_index = self.get_set_index(address)
-        tag = self.get_tag(address)
-        cache_set = self.cache[set_index]
-        
-        for existing_tag, _ in cache_set:
-            if existing_tag == tag:
-                if self.debug:
-                    print(f"Present in cache: 0x{address:x}")
-                return True
+        cache_set, tag = self._lookup(address)
+        if tag in cache_set:
+            if self.debug:
+                print(f"Present in cache: 0x{address:x}")
+            return True
         
         if self.debug:
             print(f"Not present in cache: 0x{address:x}")
@@ -251,55 +274,46 @@ class InfiniteCache():
         if self.debug:
             print(f"Reading from cache: 0x{address:x}")
 
-        set_idx = self.get_set_index(address)
-        tag = self.get_tag(address)
-        cache_set = self.cache[set_idx]
-
-        for existing_tag, data in cache_set:
-            if existing_tag == tag:
-                # Cache hit - no LRU management needed
-                return data
+        cache_set, tag = self._lookup(address)
+        data = cache_set.get(tag, _MISSING)
+        if data is not _MISSING:
+            # Cache hit - no LRU management needed
+            return data
         
         # Cache miss - read from memory and update cache
-        value = mu.mem_read(address, self.line_size)
+        value = None if self.tag_only else mu.mem_read(address, self.line_size)
         self.write(address, value)
         return value
     
     def write(self, address, value):
-        set_idx = self.get_set_index(address)
-        tag = self.get_tag(address)
-        cache_set = self.cache[set_idx]
+        cache_set, tag = self._lookup(address)
+        if self.tag_only:
+            value = None
 
-        for i, (existing_tag, data) in enumerate(cache_set):
-            if existing_tag == tag:
-                # Cache hit, update existing entry
-                cache_set[i] = (tag, value)
-                if self.debug:
-                    print(f"Writing to cache: 0x{address:x}, value = {value} (replaced old value)")
-                return
+        if tag in cache_set:
+            # Cache hit, update existing entry
+            cache_set[tag] = value
+            if self.debug:
+                print(f"Writing to cache: 0x{address:x}, value = {value} (replaced old value)")
+            return
 
         # Cache miss, add to cache (no eviction needed - infinite size)
-        cache_set.append((tag, value))
+        cache_set[tag] = value
 
         if self.debug:
             print(f"Writing to cache: 0x{address:x}, value = {value}")
     
     def flush(self):
-        self.cache = {i: [] for i in range(self.amt_sets)}
+        self.cache = [{} for _ in range(self.amt_sets)]
         if self.debug:
             print("Flushed complete cache")
     
     def flush_address(self, address):
-        set_index = self.get_set_index(address)
-        tag = self.get_tag(address)
-        cache_set = self.cache[set_index]
-        
-        for i, (existing_tag, _) in enumerate(cache_set):
-            if existing_tag == tag:
-                cache_set.pop(i)
-                if self.debug:
-                    print(f"Flushed address 0x{address:x} from cache")
-                return
+        cache_set, tag = self._lookup(address)
+        if cache_set.pop(tag, _MISSING) is not _MISSING:
+            if self.debug:
+                print(f"Flushed address 0x{address:x} from cache")
+            return
         
         if self.debug:
             print(f"Address 0x{address:x} was not in cache, nothing to flush")
@@ -311,9 +325,9 @@ class InfiniteCache():
     
     def get_cache_stats(self):
         """Get statistics about the cache state"""
-        total_lines = sum(len(ways) for ways in self.cache.values())
-        max_set_size = max(len(ways) for ways in self.cache.values())
-        non_empty_sets = sum(1 for ways in self.cache.values() if ways)
+        total_lines = sum(len(ways) for ways in self.cache)
+        max_set_size = max(len(ways) for ways in self.cache)
+        non_empty_sets = sum(1 for ways in self.cache if ways)
         
         return {
             'total_lines': total_lines,
@@ -344,7 +358,7 @@ class InfiniteCache():
                 
             print(f"Set {set_idx:3d}: {len(ways)} lines")
             
-            for way_idx, (tag, data) in enumerate(ways):
+            for way_idx, (tag, data) in enumerate(ways.items()):
                 # Calculate the full address from tag and set
                 addr = (tag * self.amt_sets + set_idx) * self.line_size
                 
@@ -354,6 +368,8 @@ class InfiniteCache():
                     data_preview = binascii.hexlify(data[:data_preview_bytes]).decode()
                     if len(data) > data_preview_bytes:
                         data_preview += "..."
+                elif self.tag_only:
+                    data_preview = "(tag only)"
                 else:
                     data_preview = str(data)
                     
@@ -1,43 +1,163 @@
 import subprocess
+import hashlib
 import os
+import shutil
+import tempfile
+from typing import Dict, List
+from capstone import Cs, CS_ARCH_X86, CS_MODE_64
 
-def compile_asm(asm_code, output_dir, output_bin="assign_gate.bin", output_obj="assign_gate.o", debug=False):
-    # Create output directory if it doesn't exist
-    os.makedirs(output_dir, exist_ok=True)
-    
-    # Update file paths to use output directory
-    asm_file = os.path.join(output_dir, "assign_gate.asm")
-    output_obj = os.path.join(output_dir, output_obj)
-    output_bin = os.path.join(output_dir, output_bin)
-    objdump_output_file = os.path.join(output_dir, "objdump.txt")
-    
-    # Save the assembly to a file
-    with open(asm_file, 'w') as f:
-        f.write(asm_code)
-        if debug:
-            print(f"Saved assembly to {asm_file}")
-    
-    try:
-        # Assemble using NASM
-        subprocess.run(['nasm', '-f', 'elf64', asm_file, '-o', output_obj], check=True)
-        if debug:
-            print(f"Compiled object file to {output_obj}")
-
-        # Extract binary code
-        subprocess.run(['objcopy', '-O', 'binary', '-j', '.text', output_obj, output_bin], check=True)
-        if debug:
-            print(f"Extracted binary to {output_bin}")
-        
-        # Generate objdump output
-        subprocess.run(['objdump', '-M', 'intel', '-d', output_obj], stdout=open(objdump_output_file, 'w'), check=True)
-        if debug:
-            print(f"Objdump saved to {objdump_output_file}")
+try:
+    from keystone import Ks, KsError, KS_ARCH_X86, KS_MODE_64, KS_OPT_SYNTAX_NASM
+except ImportError:  # optional, nasm is used without it
+    Ks = None
+
+# assembler backends
+BACKEND_NASM = "nasm"          # nasm + objcopy subprocesses
+BACKEND_KEYSTONE = "keystone"  # in-process, falls back to nasm if keystone is missing or rejects the code
+
+DEFAULT_BACKEND = BACKEND_NASM
+# machine code by source hash, shared by all runs in this directory. A build cache only, it isn't shipped: assembling
+# needs nasm (with objcopy) or keystone-engine
+CACHE_DIR = os.path.join("output", "asm_cache")
+
+# nasm directives keystone doesn't know, the gates only address memory through registers so DEFAULT REL changes nothing
+KEYSTONE_SKIPPED_DIRECTIVES = ("bits", "default", "section", "global")
+
+_machine_code: Dict[str, bytes] = {}  # in-memory cache, same keys as the files in the cache directory
+
+def compile_asm(asm_code: str, output_dir: str, debug: bool = False, backend: str = None, cache_dir: str = CACHE_DIR) -> bytes:
+    """
+    Assembles asm_code into raw machine code. Results are cached by the hash of backend and source, in memory and in
+    cache_dir (None disables both), so repeated runs don't spawn any subprocesses. The build itself runs in a temporary
+    directory, parallel runs don't clobber each other's files. With debug, the source and a disassembly are written to
+    output_dir. Without nasm, code the keystone backend assembled (or has cached) is used, otherwise a RuntimeError
+    names both backends.
+    """
+    if backend is None:
+        backend = DEFAULT_BACKEND
+    if backend == BACKEND_KEYSTONE and Ks is None:
+        backend = BACKEND_NASM
+    key = _cache_key(backend, asm_code)
+
+    listing = None
+    machine_code = _load_cached(key, cache_dir)
+    if machine_code is None:
+        if backend == BACKEND_KEYSTONE:
+            machine_code = _assemble_keystone(asm_code)
+            if machine_code is None:
+                return compile_asm(asm_code, output_dir, debug=debug, backend=BACKEND_NASM, cache_dir=cache_dir)
+        else:
+            try:
+                machine_code, listing = _assemble_nasm(asm_code, debug)
+            except FileNotFoundError as e:
+                # nasm or objcopy is missing, use code of the keystone backend instead
+                key = _cache_key(BACKEND_KEYSTONE, asm_code)
+                machine_code = _load_cached(key, cache_dir)
+                if machine_code is None and Ks is not None:
+                    machine_code = _assemble_keystone(asm_code)
+                if machine_code is None:
+                    raise RuntimeError(f"Can't assemble: {e.filename} isn't installed for the {BACKEND_NASM} backend, and the "
+                                       f"{BACKEND_KEYSTONE} backend (keystone-engine) isn't installed or can't assemble "
+                                       f"this code. Install nasm and objcopy, or keystone-engine.") from e
+            if machine_code is None:
+                return None
+        if cache_dir is not None:
+            _store(cache_dir, os.path.join(cache_dir, key + ".bin"), machine_code)
+    if cache_dir is not None:
+        _machine_code[key] = machine_code
+
+    if debug:
+        os.makedirs(output_dir, exist_ok=True)
+        asm_file = os.path.join(output_dir, "gate.asm")
+        with open(asm_file, 'w') as f:
+            f.write(asm_code)
+        print(f"Saved assembly to {asm_file}")
+
+        # the objdump listing has the labels, cached and keystone code is disassembled with capstone instead
+        objdump_output_file = os.path.join(output_dir, "objdump.txt")
+        with open(objdump_output_file, 'w') as f:
+            f.write(listing if listing is not None else _disassemble(machine_code))
+        print(f"Disassembly saved to {objdump_output_file}")
+
+    return machine_code
+
+def installed_backends() -> List[str]:
+    """
+    The assembler backends that can run here, nasm needs objcopy as well.
+    """
+    backends = []
+    if shutil.which('nasm') is not None and shutil.which('objcopy') is not None:
+        backends.append(BACKEND_NASM)
+    if Ks is not None:
+        backends.append(BACKEND_KEYSTONE)
+    return backends
+
+def _assemble_nasm(asm_code: str, debug: bool):
+    """
+    Returns the machine code and, with debug, the objdump listing of the object file.
+    """
+    with tempfile.TemporaryDirectory() as build_dir:
+        asm_file = os.path.join(build_dir, "gate.asm")
+        output_obj = os.path.join(build_dir, "gate.o")
+        output_bin = os.path.join(build_dir, "gate.bin")
+        with open(asm_file, 'w') as f:
+            f.write(asm_code)
+
+        try:
+            # Assemble using NASM and extract the binary code
+            subprocess.run(['nasm', '-f', 'elf64', asm_file, '-o', output_obj], check=True)
+            subprocess.run(['objcopy', '-O', 'binary', '-j', '.text', output_obj, output_bin], check=True)
+            listing = None
+            if debug:
+                listing = subprocess.run(['objdump', '-M', 'intel', '-d', output_obj], stdout=subprocess.PIPE,
+                                         text=True, check=True).stdout
+        except subprocess.CalledProcessError as e:
+            print(f"Compilation error: {e}")
+            return None, None
 
         with open(output_bin, 'rb') as f:
+            return f.read(), listing
+
+def _assemble_keystone(asm_code: str) -> bytes:
+    """
+    Returns the machine code, or None if keystone can't assemble asm_code.
+    """
+    lines = []
+    for line in asm_code.splitlines():
+        line = line.split(";", 1)[0]  # keystone only takes ASCII, comments may not be
+        words = line.split(None, 1)
+        if not words or words[0].lower() not in KEYSTONE_SKIPPED_DIRECTIVES:
+            lines.append(line)
+    ks = Ks(KS_ARCH_X86, KS_MODE_64)
+    ks.syntax = KS_OPT_SYNTAX_NASM
+    try:
+        encoding, _ = ks.asm("\n".join(lines), 0)
+    except KsError:
+        return None
+    return bytes(encoding) if encoding else None
+
+def _cache_key(backend: str, asm_code: str) -> str:
+    return hashlib.sha256(f"{backend}\0{asm_code}".encode()).hexdigest()
+
+def _load_cached(key: str, cache_dir: str) -> bytes:
+    if cache_dir is None:
+        return None
+    machine_code = _machine_code.get(key)
+    cache_file = os.path.join(cache_dir, key + ".bin")
+    if machine_code is None and os.path.exists(cache_file):
+        with open(cache_file, 'rb') as f:
             machine_code = f.read()
-        
-        return machine_code
-    
-    except subprocess.CalledProcessError as e:
-        print(f"Compilation error: {e}")
-        return None
\ No newline at end of file
+    return machine_code
+
+def _store(cache_dir: str, cache_file: str, machine_code: bytes):
+    # written next to the cache file and renamed, so parallel runs never read a partial file
+    os.makedirs(cache_dir, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=cache_dir)
+    with os.fdopen(fd, 'wb') as f:
+        f.write(machine_code)
+    os.replace(tmp_path, cache_file)
+
+def _disassemble(machine_code: bytes) -> str:
+    cs = Cs(CS_ARCH_X86, CS_MODE_64)
+    return "".join(f"{insn.address:8x}:\t{insn.bytes.hex(' '):<24}\t{insn.mnemonic} {insn.op_str}\n"
+                   for insn in cs.disasm(machine_code, 0))
@@ -0,0 +1,79 @@
+"""
+Renders a binary execution trace (see bintrace.py) as text, in the format of the emulation logs, or as CSV.
+
+Usage: python decode_trace.py <trace> [--format text|csv] [-o <output file>]
+"""
+import argparse
+import csv
+import sys
+from typing import Dict, Iterator, Tuple
+from capstone import Cs, CS_ARCH_X86, CS_MODE_64
+from bintrace import *
+
+cs = Cs(CS_ARCH_X86, CS_MODE_64)
+disassembly: Dict[Tuple[int, bytes], Tuple[str, str]] = {}  # keyed by the bytes as well, code can be rewritten
+
+def disassemble(address: int, insn_bytes: bytes) -> Tuple[str, str]:
+    key = (address, insn_bytes)
+    if key not in disassembly:
+        disassembly[key] = ("(unknown)", "")
+        for _, _, mnemonic, op_str in cs.disasm_lite(insn_bytes, address, 1):
+            disassembly[key] = (mnemonic, op_str)
+    return disassembly[key]
+
+def format_event(event: TraceEvent) -> str:
+    """
+    Formats an event like MuWMEmulator.log does.
+    """
+    event_type, address, size, value, insn_bytes = event
+    if event_type == EV_INSN:
+        mnemonic, op_str = disassemble(address, insn_bytes)
+        return f"Executing 0x{address:x}: {mnemonic} {op_str}"
+    if event_type == EV_MEM_READ_HIT:
+        return f"\tMemory read: address=0x{address:x}, size={size}, CACHE HIT"
+    if event_type == EV_MEM_READ_MISS:
+        return f"\tMemory read: address=0x{address:x}, size={size}, CACHE MISS"
+    if event_type == EV_MEM_WRITE:
+        return f"\tMemory write: address=0x{address:x}, size={size}, value=0x{value:x}"
+    if event_type == EV_CHECKPOINT:
+        return f"\tCheckpoint at 0x{address:x}"
+    if event_type == EV_ROLLBACK:
+        return "\tRollback complete"
+    if event_type == EV_SPEC_WINDOW_EXCEEDED:
+        return f"\tSpeculation window exceeded (depth: {size}, limit: {value})"
+    if event_type == EV_CACHE_FLUSH:
+        return f"\tFlushing address 0x{address:x} from cache"
+    if event_type == EV_ROUND:
+        return f"Round {value}"
+    return f"\tUnknown event {event_type}"
+
+def write_text(events: Iterator[TraceEvent], out):
+    for event in events:
+        out.write(format_event(event) + '\n')
+
+def write_csv(events: Iterator[TraceEvent], out):
+    writer = csv.writer(out)
+    writer.writerow(["index", "event", "address", "size", "value", "mnemonic", "op_str"])
+    for index, (event_type, address, size, value, insn_bytes) in enumerate(events):
+        mnemonic, op_str = disassemble(address, insn_bytes) if event_type == EV_INSN else ("", "")
+        writer.writerow([index, EVENT_NAMES.get(event_type, event_type), f"0x{address:x}", size, value, mnemonic, op_str])
+
+def main():
+    parser = argparse.ArgumentParser(description="Decode a binary execution trace")
+    parser.add_argument("trace", help="binary trace file written by a TraceWriter")
+    parser.add_argument("--format", choices=["text", "csv"], default="text")
+    parser.add_argument("-o", "--output", help="output file (default: stdout)")
+    args = parser.parse_args()
+
+    out = open(args.output, 'w', newline='') if args.output else sys.stdout
+    try:
+        if args.format == "csv":
+            write_csv(read_trace(args.trace), out)
+        else:
+            write_text(read_trace(args.trace), out)
+    finally:
+        if out is not sys.stdout:
+            out.close()
+
+if __name__ == "__main__":
+    main()
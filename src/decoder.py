@@ -0,0 +1,211 @@
+from capstone import Cs, CsInsn, CS_OP_MEM
+from unicorn import Uc, UcError
+from typing import Dict, List, Optional, Set, Tuple
+
+# Instruction classes that the emulator's hooks treat specially
+INSN_OTHER = 0
+INSN_CALL = 1
+INSN_RET = 2
+INSN_RDTSCP = 3
+INSN_CLFLUSH = 4
+INSN_MFENCE = 5
+INSN_DIV = 6  # div/idiv, the only instructions that raise #DE
+
+MNEMONIC_CLASSES = {
+    "call": INSN_CALL,
+    "ret": INSN_RET,
+    "rdtscp": INSN_RDTSCP,
+    "clflush": INSN_CLFLUSH,
+    "mfence": INSN_MFENCE,
+    "div": INSN_DIV,
+    "idiv": INSN_DIV,
+}
+
+# Mnemonics that access memory without a memory operand (stack and string instructions)
+IMPLICIT_MEMORY_MNEMONICS = {
+    "push", "pop", "pushf", "pushfq", "popf", "popfq", "call", "ret", "enter", "leave",
+    "movsb", "movsw", "movsd", "movsq", "stosb", "stosw", "stosd", "stosq", "lodsb", "lodsw", "lodsd", "lodsq",
+    "cmpsb", "cmpsw", "cmpsd", "cmpsq", "scasb", "scasw", "scasd", "scasq",
+}
+
+MAX_INSN_SIZE = 15  # x86 instruction size limit
+PAGE_SHIFT = 12
+
+# (base, index, scale, disp) of a memory operand, using Capstone register ids
+MemOperand = Tuple[int, int, int, int]
+
+class DecodedInsn():
+    """
+    An instruction decoded once by Capstone, together with the details the emulator hooks query on every execution.
+    """
+    __slots__ = ("insn", "address", "size", "bytes", "mnemonic", "op_str", "insn_class", "regs_read", "regs_written", "mem_operands", "can_fault")
+
+    def __init__(self, insn: CsInsn):
+        self.insn = insn
+        self.address: int = insn.address
+        self.size: int = insn.size
+        self.bytes: bytes = bytes(insn.bytes)
+        self.mnemonic: str = insn.mnemonic
+        self.op_str: str = insn.op_str
+        self.insn_class: int = MNEMONIC_CLASSES.get(insn.mnemonic, INSN_OTHER)
+
+        regs_read, regs_written = insn.regs_access()
+        self.regs_read: Tuple[int, ...] = tuple(regs_read)
+        self.regs_written: Tuple[int, ...] = tuple(regs_written)
+
+        self.mem_operands: Tuple[MemOperand, ...] = tuple(
+            (op.mem.base, op.mem.index, op.mem.scale, op.mem.disp)
+            for op in insn.operands if op.type == CS_OP_MEM
+        )
+
+        # whether executing the instruction can raise an exception: #DE or an access to unmapped/protected memory
+        # (lea only computes an address)
+        self.can_fault: bool = self.insn_class == INSN_DIV or (bool(self.mem_operands) and insn.mnemonic != "lea") \
+            or insn.mnemonic in IMPLICIT_MEMORY_MNEMONICS
+
+class DecodeCache():
+    """
+    Per-address cache of decoded instructions. Entries are invalidated when a memory write overlaps them (self-modifying code).
+    """
+    def __init__(self, cs: Cs):
+        self.cs = cs
+        self.entries: Dict[int, DecodedInsn] = {}
+        self.pages: Set[int] = set()  # pages containing at least one decoded instruction
+        self.code_written: bool = False  # whether a write hit a page with decoded instructions since the last clear()
+
+    def get(self, uc: Uc, address: int, size: int) -> Optional[DecodedInsn]:
+        """
+        Returns the decoded instruction at the given address, decoding it on a miss. Returns None if it can't be decoded.
+        """
+        entry = self.entries.get(address)
+        if entry is not None:
+            return entry
+
+        insn_bytes = uc.mem_read(address, size)  # may raise UcError, handled by the caller
+        for insn in self.cs.disasm(insn_bytes, address, 1):
+            entry = DecodedInsn(insn)
+            self.entries[address] = entry
+            self.pages.add(address >> PAGE_SHIFT)
+            self.pages.add((address + entry.size - 1) >> PAGE_SHIFT)
+        return entry
+
+    def get_at(self, uc: Uc, address: int) -> Optional[DecodedInsn]:
+        """
+        Like get(), for callers that don't know the instruction size. Returns None if it can't be decoded.
+        """
+        entry = self.entries.get(address)
+        if entry is not None:
+            return entry
+
+        # the instruction might end right before unmapped memory
+        for size in range(MAX_INSN_SIZE, 0, -1):
+            try:
+                return self.get(uc, address, size)
+            except UcError:
+                continue
+        return None
+
+    def invalidate(self, address: int, size: int) -> None:
+        """
+        Drops all decoded instructions overlapping the range [address, address + size).
+        """
+        if (address >> PAGE_SHIFT) not in self.pages and ((address + size - 1) >> PAGE_SHIFT) not in self.pages:
+            return
+        self.code_written = True
+
+        entries = self.entries
+        for insn_addr in range(address - MAX_INSN_SIZE + 1, address + size):
+            entry = entries.get(insn_addr)
+            if entry is not None and insn_addr + entry.size > address:
+                del entries[insn_addr]
+
+    def clear(self) -> None:
+        self.entries.clear()
+        self.pages.clear()
+        self.code_written = False
+
+# Mnemonics that end a straight-line run of instructions
+BRANCH_MNEMONICS = {"call", "ret", "jmp", "loop", "loope", "loopne", "jrcxz", "jecxz", "syscall", "sysenter", "int", "int3", "hlt", "ud2", "iretq"}
+
+def is_branch(mnemonic: str) -> bool:
+    return mnemonic[0] == "j" or mnemonic in BRANCH_MNEMONICS
+
+def linear_sweep(cs: Cs, code: bytes, base: int) -> List[Tuple[int, int, str]]:
+    """
+    Disassembles a code region linearly into (address, size, mnemonic) tuples, skipping bytes Capstone can't decode.
+    """
+    insns = []
+    offset = 0
+    while offset < len(code):
+        start = offset
+        for address, size, mnemonic, _ in cs.disasm_lite(code[offset:], base + offset):
+            insns.append((address, size, mnemonic))
+            offset = address - base + size
+        if offset == start:
+            offset += 1  # undecodable byte
+    return insns
+
+def find_calls(cs: Cs, code: bytes, base: int, targets: Set[int]) -> Dict[int, int]:
+    """
+    Finds the direct calls to any of the target addresses in a code region, returns their targets by call site.
+    """
+    calls = {}
+    for address, _, mnemonic in linear_sweep(cs, code, base):
+        if mnemonic != "call":
+            continue
+        for insn in cs.disasm(code[address - base:address - base + MAX_INSN_SIZE], address, 1):
+            if insn.op_str.startswith("0x") and int(insn.op_str, 16) in targets:
+                calls[address] = int(insn.op_str, 16)
+    return calls
+
+class SiteMap():
+    """
+    The "special" instruction sites of a code image: instructions whose execution needs a Python callback (calls, returns,
+    rdtscp, clflush, mfence and div/idiv). Unicorn checks the bounds of every code hook for each hooked instruction, so
+    nearby sites are merged into at most `max_ranges` hook ranges, closing the smallest gaps first.
+    """
+    def __init__(self, cs: Cs, code_regions: List[Tuple[int, bytes]], max_ranges: int = 64):
+        self.ranges: List[Tuple[int, int]] = []  # inclusive (begin, end) hook ranges
+        self.hooked: Set[int] = set()  # addresses of all instructions covered by a hook range
+        self.trailing: Dict[int, int] = {}  # last site of a range -> amount of unhooked instructions following it in straight-line code
+
+        # groups of [region, first insn index, last insn index]
+        regions = [linear_sweep(cs, code, base) for base, code in code_regions]
+        groups: List[List[int]] = []
+        for region_idx, insns in enumerate(regions):
+            for i, (_, _, mnemonic) in enumerate(insns):
+                if mnemonic in MNEMONIC_CLASSES:
+                    groups.append([region_idx, i, i])
+
+        # merge the groups separated by the fewest instructions
+        while len(groups) > max_ranges:
+            gaps = [(groups[j + 1][1] - groups[j][2], j) for j in range(len(groups) - 1) if groups[j][0] == groups[j + 1][0]]
+            if not gaps:
+                break
+            gaps.sort()
+            merge = sorted(j for _, j in gaps[:len(groups) - max_ranges])
+            for j in reversed(merge):
+                groups[j][2] = groups[j + 1][2]
+                del groups[j + 1]
+
+        for region_idx, first, last in groups:
+            insns = regions[region_idx]
+            self.ranges.append((insns[first][0], insns[last][0]))
+            for address, _, _ in insns[first:last + 1]:
+                self.hooked.add(address)
+
+        # sites that don't end a basic block account for the unhooked instructions after them, up to the next hooked one
+        # or the end of the block. Inside of a range, every instruction is hooked, so only the last one has any.
+        for region_idx, _, last in groups:
+            insns = regions[region_idx]
+            address, _, mnemonic = insns[last]
+            if is_branch(mnemonic):
+                continue
+            count = 0
+            for next_address, _, next_mnemonic in insns[last + 1:]:
+                if next_address in self.hooked:
+                    break
+                count += 1
+                if is_branch(next_mnemonic):
+                    break
+            self.trailing[address] = count
@@ -1,19 +1,45 @@
 from unicorn import *
 from unicorn.x86_const import *
 from helper import *
-from typing import List, Tuple, Dict, ByteString
-from logger import Logger
+from typing import Callable, List, Tuple, Dict, Set, ByteString
+from logger import *
 from cache import *
 from rsb import RSB
+from scoreboard import RegisterScoreboard
 from read_timer import Timer
 from loader import *
+from decoder import *
+from bintrace import TraceWriter
+from trace_index import TraceIndex
+from trace_filter import TraceFilter
+from plt_stubs import PltStub
+import state_file
 from capstone import Cs, CS_ARCH_X86, CS_MODE_64, CsInsn
 from capstone.x86 import *
 import os
+import copy
+import ctypes
+import hashlib
 import traceback
+import weakref
+
+# policies for memory accesses outside of the modeled ranges (see MuWMEmulator's mem_ranges)
+MEM_ALWAYS_HIT = "hit"   # count as cache hits, without touching the cache model
+MEM_IGNORE = "ignore"    # not modeled at all
+
+# checkpoint backends (see MuWMEmulator's checkpoint_backend)
+CHECKPOINT_JOURNAL = "journal"    # registers only, speculative writes are journaled in store_logs and undone one by one
+CHECKPOINT_SNAPSHOT = "snapshot"  # registers and a copy-on-write memory snapshot of Unicorn, restored in bulk
+                                  # (no memory can be mapped after speculating then, see save_reset_state)
 
 Checkpoint = Tuple[object, int, int]  # context, next_insn_addr, flags
 
+IMMUTABLE_LOG_ARGS = (int, str, float, bool, bytes, type(None))  # log arguments the flight recorder formats lazily
+
+# demand paging (see MuWMEmulator.add_demand_region)
+DEMAND_CHUNK_SHIFT = 16  # regions are mapped in aligned chunks of 64 KiB
+DemandRegion = Tuple[int, int, int, object, int]  # start, end, perms, contents, address of the contents
+
 class MuWMEmulator():
     # initialize capstone
     cs = Cs(CS_ARCH_X86, CS_MODE_64)
@@ -24,10 +50,34 @@ class MuWMEmulator():
     REGULAR_INSTR_CYCLES = 1  # Regular instruction timing
     MAX_SPEC_WINDOW = 250
 
-    def __init__(self, name: str, loader: Loader, cache: Cache = None, debug: bool = True):
+    # site maps of code images, shared between emulators (see sparse_hooks)
+    _site_maps: Dict[bytes, SiteMap] = {}
+    _plt_call_sites: Dict[Tuple[bytes, Tuple[int, ...]], Dict[int, int]] = {}  # same, for calls to PLT stubs
+
+    # flight recorder capacity for emulators that don't specify one (0 disables it), see dump_flight_recorder. Off by
+    # default, test runners that dump it on failure set it.
+    flight_recorder_size: int = 0
+    flight_recorder_level: int = DEBUG  # TRACE also records every instruction and access, at a cost in bulk runs
+    flight_recorder_categories: int = CAT_ALL
+    checkpoint_backend: str = CHECKPOINT_JOURNAL  # for emulators that don't specify one
+    # flight recorder of the most recently created or reset emulator, so test runners can dump it (it holds no engine)
+    last_flight_recorder: FlightRecorder = None
+    live_engines: int = 0  # Unicorn engines not released yet, see close()
+
+    def __init__(self, name: str, loader: Loader, cache: Cache = None, debug: bool = True, sparse_hooks: bool = False,
+                 log_level: int = TRACE, log_categories: int = CAT_ALL, flight_recorder_size: int = None,
+                 trace_path: str = None, trace_filter: TraceFilter = None, mem_ranges: List[Tuple[int, int]] = None,
+                 unmodeled_policy: str = MEM_ALWAYS_HIT, plt_stubs: Dict[str, PltStub] = None,
+                 checkpoint_backend: str = None):
         # initialize unicorn
         self.uc = Uc(UC_ARCH_X86, UC_MODE_64)
+        MuWMEmulator.live_engines += 1
+        self.engine_finalizer = weakref.finalize(self.uc, MuWMEmulator._engine_released)
         self.pending_fault_id: int = 0
+        # fault handlers by Unicorn error number (UC_ERR_EXCEPTION for CPU exceptions such as #DE, UC_ERR_*_UNMAPPED for
+        # unmapped accesses), returning the address to continue at or 0 if the fault isn't handled (see handle_fault)
+        self.fault_handlers: Dict[int, Callable[[int], int]] = {UC_ERR_EXCEPTION: self.speculate_fault}
+        self.unhandled_fault: bool = False  # set by hooks that already offered a fault to the handlers
 
         # cache
         if cache is None:
@@ -44,57 +94,446 @@ class MuWMEmulator():
         self.in_speculation: bool = False
         self.speculation_depth: int = 0
         self.speculation_limit: int = 0
-        self.previous_context = None
+        self.previous_context = None  # registers before the last instruction that can fault, see emulate()
+        self.previous_context_addr: int = None  # address of that instruction
 
         # OoOE
-        self.pending_registers: Dict[str, int] = {}
+        self.pending_registers = RegisterScoreboard()
         self.pending_memory_loads = set()
 
         # Timing (for rdtscp support)
         self.timer = Timer()
 
         # instructions
-        self.curr_insn: CsInsn
+        self.decode_cache = DecodeCache(self.cs)
+        self.curr_insn: DecodedInsn
         self.curr_insn_address: int = 0
         self.next_insn_addr: int = 0
+        self.curr_mem_address: int = 0  # address of the last memory access, only used by trace filters
+        self.curr_mem_insn_address: int = -1  # instruction that made the last memory access
+
+        # sparse hooking: only special instruction sites get a code hook outside of speculation
+        self.sparse_hooks = sparse_hooks
+        self.site_map: SiteMap = None
+        self.exit_sites: Set[int] = set()
+        self.block_prefix_insns: Dict[Tuple[int, int], int] = {}  # (block address, size) -> instructions before the first hooked one
+        self.speculation_hook = None  # per-instruction code hook, only installed during speculation in sparse mode
+        self.block_hook_handle = None  # per-block cycle accounting, only installed while the timer runs in sparse mode
+        self.restart_address: int = None  # set when emulation must be restarted (e.g. to install new hooks)
+
+        # memory hooks scoped to [start, end) ranges (e.g. the pages holding weird registers), None models all accesses.
+        # Accesses elsewhere (e.g. the stack) follow unmodeled_policy, only speculative writes there are still logged
+        # for rollback, by a hook that is only installed during speculation. Self-modifying code is only detected inside
+        # of the ranges.
+        self.mem_ranges: List[Tuple[int, int]] = sorted(mem_ranges) if mem_ranges is not None else None
+        self.unmodeled_policy = unmodeled_policy
+        self.unmodeled_write_hooks: List[int] = []
+
+        # region of interest: microarchitectural modeling is only done inside of it (see set_roi)
+        self.roi_ranges: List[Tuple[int, int]] = []
+        self.roi_enter_addrs: Set[int] = set()
+        self.roi_exit_addrs: Set[int] = set()
+        self.roi_warm_cache: bool = True
+        self.in_roi: bool = True
+        self.roi_accesses: Dict[int, None] = {}  # cache lines accessed while fast-forwarding, in access order
+        self.model_hooks: List[int] = []
+        self.fast_forward_hooks: List[int] = []
+
+        # calls to PLT stubs that are replaced by a Python implementation (see install_plt_intercepts)
+        self.plt_intercepts: Dict[int, PltStub] = {}  # call site -> stub
+
+        # regions that are only mapped once they are accessed (see add_demand_region)
+        self.demand_regions: List[DemandRegion] = []
+        self.demand_chunks: Set[int] = set()  # start addresses of the chunks mapped so far
+        self.demand_pages: int = 0
+        self.demand_page_limit: int = None  # maximum number of pages mapped on demand, None for no limit
 
         # checkpointing
         self.checkpoints: List[Checkpoint] = []
         self.store_logs: List[List[Tuple[int, ByteString]]] = []  # each entry is a list of (address, prev_value) tuples, one entry per checkpoint
+        # with memory snapshots, the store logs only keep the speculative writes to decoded code, with an empty prev_value,
+        # as the decode cache has to forget them on rollback
+        if checkpoint_backend is None:
+            checkpoint_backend = MuWMEmulator.checkpoint_backend
+        if checkpoint_backend not in (CHECKPOINT_JOURNAL, CHECKPOINT_SNAPSHOT):
+            raise ValueError(f"Unknown checkpoint backend: {checkpoint_backend}")
+        self.snapshot_memory: bool = checkpoint_backend == CHECKPOINT_SNAPSHOT
+
+        # state restored by reset(), see save_reset_state
+        self.reset_context = None
+        self.reset_models: Tuple[Cache, RSB, Timer] = None
 
         # logging & compilation
         self.name = name
         self.output_dir = os.path.join("output", name)
-        self.logger = Logger(os.path.join(self.output_dir, 'emulation_log.txt'), debug)
-        
+        self.logger = Logger(os.path.join(self.output_dir, 'emulation_log.txt'), debug, level=log_level, categories=log_categories)
+
+        # in-memory trace of the most recent log messages, dumped by test runners when a result is wrong
+        if flight_recorder_size is None:
+            flight_recorder_size = MuWMEmulator.flight_recorder_size
+        self.flight_recorder: FlightRecorder = None
+        self._record = None
+        self._record_level = 0
+        self._record_categories = 0  # nothing passes without a flight recorder
+        if flight_recorder_size:
+            self.flight_recorder = FlightRecorder(flight_recorder_size, MuWMEmulator.flight_recorder_level,
+                                                  MuWMEmulator.flight_recorder_categories,
+                                                  path=os.path.join(self.output_dir, 'flight_recorder.txt'))
+            self._record = self.flight_recorder.record
+            self._record_level = self.flight_recorder.level
+            self._record_categories = self.flight_recorder.categories
+        MuWMEmulator.last_flight_recorder = self.flight_recorder
+
+        # optional compact binary trace (see bintrace.py and decode_trace.py)
+        self.trace: TraceWriter = TraceWriter(trace_path) if trace_path is not None else None
+        self.trace_filter: TraceFilter = trace_filter
+        self._log_filter = None  # compiled trace_filter, set after loading (symbols need the loaded image)
+
         # Helper addresses
         self.code_start_address: int
-        self.code_exit_addr: int
+        self.code_exit_addr: int = None
         # self.fault_handler_addr: int
         self.data_start_addr: int
 
         # load code & map memory
         self.loader = loader
         self.loader.load(self)
+        self.set_trace_filter(trace_filter)
+        self.previous_context = self.uc.context_save()  # preallocated, updated in place by instruction_hook
 
         # hooks
-        self.uc.hook_add(UC_HOOK_MEM_READ, self.mem_read_hook, self)
-        self.uc.hook_add(UC_HOOK_MEM_WRITE, self.mem_write_hook, self)
-        self.uc.hook_add(UC_HOOK_CODE, self.instruction_hook, self)
+        if self.sparse_hooks:
+            self.load_site_map()
+        self.install_model_hooks()
+        self.uc.hook_add(UC_HOOK_INTR, self.interrupt_hook, self)
+        self.uc.hook_add(UC_HOOK_MEM_UNMAPPED, self.unmapped_hook, self)
+        if plt_stubs:
+            self.install_plt_intercepts(plt_stubs)
+
+    def install_model_hooks(self):
+        """
+        Installs the hooks that model the microarchitecture.
+        """
+        if self.mem_ranges is None:
+            self.model_hooks.append(self.uc.hook_add(UC_HOOK_MEM_READ, self.mem_read_hook, self))
+            self.model_hooks.append(self.uc.hook_add(UC_HOOK_MEM_WRITE, self.mem_write_hook, self))
+        else:
+            for start, end in self.mem_ranges:
+                self.model_hooks.append(self.uc.hook_add(UC_HOOK_MEM_READ, self.mem_read_hook, self, start, end - 1))
+                self.model_hooks.append(self.uc.hook_add(UC_HOOK_MEM_WRITE, self.mem_write_hook, self, start, end - 1))
+            if self.unmodeled_policy == MEM_ALWAYS_HIT:
+                for start, end in complement_ranges(self.mem_ranges):
+                    self.model_hooks.append(self.uc.hook_add(UC_HOOK_MEM_READ, self.unmodeled_read_hook, self, start, end - 1))
+        if self.sparse_hooks:
+            self.install_site_hooks()
+        else:
+            self.model_hooks.append(self.uc.hook_add(UC_HOOK_CODE, self.instruction_hook, self))
+
+        # detect leaving the region of interest
+        for address in self.roi_exit_addrs:
+            self.model_hooks.append(self.uc.hook_add(UC_HOOK_CODE, self.roi_exit_hook, self, address, address))
+        self.hook_plt_calls(self.model_hooks)
+
+    def remove_model_hooks(self):
+        for hook in self.model_hooks:
+            self.uc.hook_del(hook)
+        self.model_hooks.clear()
+        self.exit_sites.clear()
+
+        for hook in (self.speculation_hook, self.block_hook_handle):
+            if hook is not None:
+                self.uc.hook_del(hook)
+        self.speculation_hook = None
+        self.block_hook_handle = None
+
+        for hook in self.unmodeled_write_hooks:
+            self.uc.hook_del(hook)
+        self.unmodeled_write_hooks.clear()
+
+    def read_code_regions(self) -> Tuple[List[Tuple[int, bytes]], bytes]:
+        """
+        The (start, code) regions of the loaded code, and a digest of them to share analyses between emulators.
+        """
+        code_regions = [(start, bytes(self.uc.mem_read(start, end - start))) for start, end in self.loader.get_code_ranges()]
+        digest = hashlib.sha1()
+        for start, code in code_regions:
+            digest.update(start.to_bytes(8, 'little'))
+            digest.update(code)
+        return code_regions, digest.digest()
+
+    def load_site_map(self):
+        """
+        Finds the special instruction sites of the loaded code (see SiteMap). Site maps are shared between emulators.
+        """
+        code_regions, key = self.read_code_regions()
+        if key not in self._site_maps:
+            self._site_maps[key] = SiteMap(self.cs, code_regions)
+        self.site_map = self._site_maps[key]
+
+    def install_plt_intercepts(self, plt_stubs: Dict[str, PltStub]):
+        """
+        Replaces the calls to dynamically linked functions by Python stubs, keyed by symbol name (e.g. plt_stubs.LIBC_STUBS).
+        The PLT stubs are resolved from the loader's relocations, and all direct calls to them get a single code hook
+        that dispatches on the call site. Like the other hooks, these are reinstalled when switching between modeling and
+        fast-forwarding (see set_roi), always after the hooks of the new mode.
+        """
+        stub_addrs = {address: plt_stubs[name] for address, name in self.loader.get_plt_symbols().items() if name in plt_stubs}
+        if not stub_addrs:
+            return
+
+        code_regions, digest = self.read_code_regions()
+        key = (digest, tuple(sorted(stub_addrs)))
+        if key not in self._plt_call_sites:
+            calls = {}
+            for start, code in code_regions:
+                calls.update(find_calls(self.cs, code, start, set(stub_addrs)))
+            self._plt_call_sites[key] = calls
+
+        for call_site, target in self._plt_call_sites[key].items():
+            self.plt_intercepts[call_site] = stub_addrs[target]
+        self.hook_plt_calls(self.fast_forward_hooks if self.fast_forward_hooks else self.model_hooks)
+
+    def hook_plt_calls(self, hooks: List[int]):
+        """
+        Hooks the intercepted call sites, adding the hooks to the given list (model_hooks or fast_forward_hooks).
+        """
+        for call_site in self.plt_intercepts:
+            hooks.append(self.uc.hook_add(UC_HOOK_CODE, self.plt_intercept_hook, self, call_site, call_site))
+
+    def plt_intercept_hook(self, uc: Uc, address: int, size: int, user_data):
+        stub = self.plt_intercepts.get(address)
+        if stub is not None:
+            self.log("\tIntercepted call to %s at 0x%x", stub.__name__, address, category=CAT_INSN)
+            stub(self)
+            self.skip_curr_insn()
+
+    def install_site_hooks(self):
+        """
+        Hooks only the special instruction sites of the loaded code. All other instructions are accounted per basic block,
+        and only get a per-instruction hook during speculation.
+        """
+        for begin, end in self.site_map.ranges:
+            self.model_hooks.append(self.uc.hook_add(UC_HOOK_CODE, self.instruction_hook, self, begin, end))
+        if self.code_exit_addr is not None:
+            self.hook_exit_site()
+
+    def hook_exit_site(self):
+        """
+        The exit address is only known once emulation starts, so it gets its site hook lazily.
+        """
+        exit_addr = self.code_exit_addr
+        if exit_addr in self.exit_sites or exit_addr in self.site_map.hooked:
+            return
+        self.model_hooks.append(self.uc.hook_add(UC_HOOK_CODE, self.instruction_hook, self, exit_addr, exit_addr))
+        self.exit_sites.add(exit_addr)
+        self.block_prefix_insns.clear()
+        self.uc.ctl_flush_tb()
+
+    def is_hooked_site(self, address: int) -> bool:
+        return address in self.site_map.hooked or address in self.exit_sites
+
+    def block_hook(self, uc: Uc, address: int, size: int, user_data):
+        """
+        Accounts cycles for the unhooked instructions at the start of a basic block (sparse mode only).
+        """
+        if self.speculation_hook is not None:
+            return  # instruction_hook accounts every instruction during speculation
+
+        amt_insns = self.block_prefix_insns.get((address, size))
+        if amt_insns is None:
+            amt_insns = 0
+            for insn_address, _, _, _ in self.cs.disasm_lite(bytes(uc.mem_read(address, size)), address):
+                if self.is_hooked_site(insn_address):
+                    break
+                amt_insns += 1
+            self.block_prefix_insns[(address, size)] = amt_insns
+
+        self.timer.increase_cycles(amt_insns * self.REGULAR_INSTR_CYCLES)
+
+    def speculative_instruction_hook(self, uc: Uc, address: int, size: int, user_data):
+        if not self.is_hooked_site(address):  # sites already have their own hook
+            self.instruction_hook(uc, address, size, user_data)
+
+    def sync_sparse_hooks(self):
+        """
+        In sparse mode, installs the per-instruction hook while speculating and the per-block hook while the timer runs,
+        and removes them afterwards. Unicorn only calls hooks from code translated after they were added, so new hooks
+        need a restart and a flush of the translation cache. This is called before every (re)start.
+        """
+        if not self.sparse_hooks:
+            return
+
+        flush = False
+        if self.in_speculation and self.speculation_hook is None:
+            self.speculation_hook = self.uc.hook_add(UC_HOOK_CODE, self.speculative_instruction_hook, self)
+            flush = True
+        elif not self.in_speculation and self.speculation_hook is not None:
+            self.uc.hook_del(self.speculation_hook)
+            self.speculation_hook = None
+
+        if self.timer.active and self.block_hook_handle is None:
+            self.block_hook_handle = self.uc.hook_add(UC_HOOK_BLOCK, self.block_hook, self)
+            flush = True
+        elif not self.timer.active and self.block_hook_handle is not None:
+            self.uc.hook_del(self.block_hook_handle)
+            self.block_hook_handle = None
+
+        if flush:
+            self.uc.ctl_flush_tb()
+
+    def sync_unmodeled_hooks(self):
+        """
+        With scoped memory hooks, installs the hook logging speculative writes outside of the modeled ranges while
+        speculating. Like sync_sparse_hooks, this is called before every (re)start. Speculation always starts with a
+        restart, and a leftover hook after a rollback only costs a check.
+        """
+        if self.mem_ranges is None or self.snapshot_memory:
+            return  # memory snapshots also cover the unmodeled writes
+
+        if self.in_speculation and not self.unmodeled_write_hooks:
+            for start, end in complement_ranges(self.mem_ranges):
+                self.unmodeled_write_hooks.append(self.uc.hook_add(UC_HOOK_MEM_WRITE, self.unmodeled_write_hook, self, start, end - 1))
+            self.uc.ctl_flush_tb()
+        elif not self.in_speculation and self.unmodeled_write_hooks:
+            for hook in self.unmodeled_write_hooks:
+                self.uc.hook_del(hook)
+            self.unmodeled_write_hooks.clear()
+
+    def set_roi(self, ranges: List[Tuple[int, int]], enter_addrs: List[int] = (), exit_addrs: List[int] = (), warm_cache: bool = True):
+        """
+        Restricts microarchitectural modeling to a region of interest (ROI). Outside of it, all modeling hooks are removed
+        and code is fast-forwarded architecturally: the cache, RSB, timer and speculation state are left untouched.
+
+        The ROI is entered when a basic block starting inside one of the [start, end) ranges executes, or when one of
+        the enter addresses is reached. It is only left at one of the exit addresses (which should lie outside of the
+        ranges), so code called from inside the ROI is modeled as well. The ROI is never left during speculation.
+        With warm_cache, the cache lines accessed while fast-forwarding are loaded into the cache when entering the ROI.
+        """
+        self.roi_ranges = list(ranges)
+        self.roi_enter_addrs = set(enter_addrs)
+        self.roi_exit_addrs = set(exit_addrs)
+        self.roi_warm_cache = warm_cache
+
+    def roi_enabled(self) -> bool:
+        return bool(self.roi_ranges or self.roi_enter_addrs)
+
+    def in_roi_range(self, address: int) -> bool:
+        for start, end in self.roi_ranges:
+            if start <= address < end:
+                return True
+        return False
+
+    def install_fast_forward_hooks(self):
+        for start, end in self.roi_ranges:
+            self.fast_forward_hooks.append(self.uc.hook_add(UC_HOOK_BLOCK, self.roi_enter_hook, self, start, end - 1))
+        for address in self.roi_enter_addrs:
+            self.fast_forward_hooks.append(self.uc.hook_add(UC_HOOK_CODE, self.roi_enter_hook, self, address, address))
+        if self.code_exit_addr is not None:
+            self.fast_forward_hooks.append(self.uc.hook_add(UC_HOOK_CODE, self.instruction_hook, self, self.code_exit_addr, self.code_exit_addr))
+        if self.roi_warm_cache:
+            self.fast_forward_hooks.append(self.uc.hook_add(UC_HOOK_MEM_READ | UC_HOOK_MEM_WRITE, self.roi_access_hook, self))
+        self.fast_forward_hooks.append(self.uc.hook_add(UC_HOOK_INSN_INVALID, self.fast_forward_invalid_insn_hook, self))
+        self.hook_plt_calls(self.fast_forward_hooks)
+
+    def remove_fast_forward_hooks(self):
+        for hook in self.fast_forward_hooks:
+            self.uc.hook_del(hook)
+        self.fast_forward_hooks.clear()
+
+    def roi_enter_hook(self, uc: Uc, address: int, size: int, user_data):
+        if self.in_roi:
+            return
+        self.in_roi = True
+        self.restart_at(address)
+
+    def roi_exit_hook(self, uc: Uc, address: int, size: int, user_data):
+        if not self.in_roi or self.in_speculation:
+            return
+        self.in_roi = False
+        self.restart_at(address)
+
+    def roi_access_hook(self, uc: Uc, access, address: int, size: int, value, user_data):
+        """
+        Cheap summary of the memory accesses done while fast-forwarding.
+        """
+        line = address - address % self.cache.line_size
+        self.roi_accesses.pop(line, None)
+        self.roi_accesses[line] = None
+        if access == UC_MEM_WRITE:
+            self.decode_cache.invalidate(address, size)
+
+    def fast_forward_invalid_insn_hook(self, uc: Uc, user_data) -> bool:
+        """
+        Unicorn doesn't support rdtscp, which is normally skipped by instruction_hook. While fast-forwarding, it reads 0.
+        """
+        rip = uc.reg_read(UC_X86_REG_RIP)
+        insn = self.decode_cache.get_at(uc, rip)
+        if insn is None or insn.insn_class != INSN_RDTSCP:
+            return False
+        uc.reg_write(UC_X86_REG_RAX, 0)
+        uc.reg_write(UC_X86_REG_RDX, 0)
+        uc.reg_write(UC_X86_REG_RIP, rip + insn.size)
+        return True
+
+    def warm_cache(self):
+        """
+        Loads the cache lines accessed while fast-forwarding into the cache, least recently accessed first.
+        """
+        self.log("Warming cache with %d lines accessed outside of the ROI", len(self.roi_accesses))
+        for line in self.roi_accesses:
+            self.cache.read(line, self.uc)
+        self.roi_accesses.clear()
+
+    def sync_roi_hooks(self, address: int):
+        """
+        Swaps between the modeling and fast-forwarding hooks when the ROI was entered or left. Like sync_sparse_hooks,
+        this is called before every (re)start.
+        """
+        if not self.roi_enabled():
+            return
+
+        if self.in_roi and not self.model_hooks:
+            self.log("Entering ROI at 0x%x", address)
+            self.remove_fast_forward_hooks()
+            self.warm_cache()
+            self.install_model_hooks()
+            self.uc.ctl_flush_tb()
+        elif not self.in_roi and not self.fast_forward_hooks:
+            self.log("Leaving ROI at 0x%x, fast-forwarding", address)
+            self.remove_model_hooks()
+            self.install_fast_forward_hooks()
+            self.uc.ctl_flush_tb()
+
+    def restart_at(self, address: int):
+        """
+        Stops the running emulation and makes emulate() resume it at the given address.
+        """
+        self.restart_address = address
+        self.uc.emu_stop()
+
+    def set_context_memory(self, enabled: bool):
+        """
+        Whether Unicorn contexts include a memory snapshot. Only checkpoints use them, the pre-fault context stays registers only.
+        """
+        mode = UC_CTL_CONTEXT_CPU | UC_CTL_CONTEXT_MEMORY if enabled else UC_CTL_CONTEXT_CPU
+        self.uc.ctl(UC_CTL_CONTEXT_MODE, UC_CTL_IO_WRITE, ctypes.c_int(mode))
 
     def checkpoint(self, emulator: Uc, next_insn_addr: int):
         flags = emulator.reg_read(UC_X86_REG_EFLAGS)
-        context = emulator.context_save()
+        if self.snapshot_memory:
+            self.set_context_memory(True)
+            context = emulator.context_save()
+            self.set_context_memory(False)
+        else:
+            context = emulator.context_save()
         self.store_logs.append([])
-        self.log(f"\tCheckpoint at 0x{next_insn_addr:x}")
+        self.log("\tCheckpoint at 0x%x", next_insn_addr, category=CAT_SPEC)
+        if self.trace is not None:
+            self.trace.checkpoint(next_insn_addr)
         self.checkpoints.append((context, next_insn_addr, flags))
 
     def speculate_fault(self, errno: int) -> int:
-        # speculates only division by zero errors currently
-        if not errno == 21:
-            self.log(f"Unhandled fault: {errno}")
-            return 0
-        
+        # only division by zero raises CPU exceptions in the emulated code currently
         # normally, the fault handler would be called after rollback, which continues execution 256 bytes after the faulty instruction
         # modelling this fault handler is difficult, so we manually hardcode the effect of the fault handler
         insn_addr_after_fault = self.curr_insn.address + 256
@@ -117,60 +556,166 @@ class MuWMEmulator():
         self.in_speculation = True
         self.speculation_limit = self.MAX_SPEC_WINDOW
 
+        if self.sparse_hooks and self.speculation_hook is None:
+            self.restart_at(predicted_ret_addr)  # the speculation hook needs a restart to take effect
+
     def handle_fault(self, errno: int) -> int:
-        next_addr = self.speculate_fault(errno)
+        handler = self.fault_handlers.get(errno)
+        if handler is None:
+            self.log("Unhandled fault: %d", errno, level=ERROR)
+            return 0
+        return handler(errno)
+
+    def interrupt_hook(self, uc: Uc, intno: int, user_data):
+        """
+        Handles CPU exceptions in place, instead of letting emu_start fail with UC_ERR_EXCEPTION.
+        """
+        self.log("\tInterrupt %d at 0x%x", intno, self.curr_insn_address, category=CAT_SPEC)
+        self.restore_pre_fault_context()
+        next_addr = self.handle_fault(UC_ERR_EXCEPTION)
         if next_addr:
-            return next_addr
+            self.restart_at(next_addr)  # in sparse mode, the speculation hook needs a restart to take effect
+        else:
+            self.unhandled_fault = True
+            uc.emu_stop()
+
+    def restore_pre_fault_context(self):
+        """
+        Workaround for a Unicorn bug: after an exception, some pre-exception context must be restored, otherwise the
+        emulator becomes corrupted (e.g. the next exception is raised as a double fault).
+        """
+        if self.previous_context_addr == self.curr_insn_address:
+            self.uc.context_restore(self.previous_context)
+        # another workaround, specifically for flags
+        self.uc.reg_write(UC_X86_REG_EFLAGS, self.uc.reg_read(UC_X86_REG_EFLAGS))
+
+    def unmapped_hook(self, uc: Uc, access: int, address: int, size: int, value: int, user_data) -> bool:
+        """
+        Accesses to demand regions are mapped and retried. Other unmapped accesses can't be resumed in place: the access
+        fails and emulate() calls the handler of its fault type.
+        """
+        if self.demand_regions and self.map_on_demand(address, size):
+            return True
+        self.log("\tUnmapped memory access: address=0x%x, size=%d", address, size, category=CAT_MEM)
+        return False
     
+    def add_demand_region(self, start: int, end: int, perms: int, contents: ByteString = b'', contents_addr: int = None):
+        """
+        Maps the page-aligned region [start, end) only once it is accessed, one chunk at a time, instead of up front.
+        contents (e.g. a segment's file contents) is written at contents_addr as the chunks holding it get mapped.
+        """
+        if self.snapshot_memory:
+            raise ValueError("Demand paging can't be combined with memory snapshots (no memory can be mapped after one)")
+        self.demand_regions.append((start, end, perms, contents, start if contents_addr is None else contents_addr))
+
+    def map_on_demand(self, address: int, size: int) -> bool:
+        """
+        Maps the chunks of the demand region that [address, address + size) falls in. Also called before memory the
+        access hooks or PLT stubs read or write from Python, as those don't pass unmapped_hook. Returns False if the
+        range isn't inside of a demand region, or mapping it would exceed demand_page_limit.
+        """
+        for start, end, perms, contents, contents_addr in self.demand_regions:
+            if start <= address and address + size <= end:
+                break
+        else:
+            return False
+
+        for chunk in range(address >> DEMAND_CHUNK_SHIFT, ((address + size - 1) >> DEMAND_CHUNK_SHIFT) + 1):
+            chunk_start = max(start, chunk << DEMAND_CHUNK_SHIFT)
+            if chunk_start in self.demand_chunks:
+                continue
+            chunk_end = min(end, (chunk + 1) << DEMAND_CHUNK_SHIFT)
+            pages = (chunk_end - chunk_start) >> PAGE_SHIFT
+            if self.demand_page_limit is not None and self.demand_pages + pages > self.demand_page_limit:
+                self.log("\tDemand page limit reached: address=0x%x", address, category=CAT_MEM)
+                return False
+
+            self.uc.mem_map(chunk_start, chunk_end - chunk_start, perms)
+            data_start = max(chunk_start, contents_addr)
+            data_end = min(chunk_end, contents_addr + len(contents))
+            if data_start < data_end:
+                self.uc.mem_write(data_start, bytes(contents[data_start - contents_addr:data_end - contents_addr]))
+            self.demand_chunks.add(chunk_start)
+            self.demand_pages += pages
+            self.log("\tMapped on demand: 0x%x - 0x%x", chunk_start, chunk_end - 1, category=CAT_MEM)
+        return True
+
+    def mapped_regions(self) -> List[Tuple[int, int, int]]:
+        """Returns the (start, end, perms) of the mapped memory, end exclusive"""
+        return [(start, end + 1, perms) for start, end, perms in self.uc.mem_regions()]
+
+    def is_mapped(self, address: int) -> bool:
+        return any(start <= address < end for start, end, _ in self.mapped_regions())
+
+    def memory_report(self) -> str:
+        """
+        Lists the mapped regions, with the demand regions they belong to, and the total amount of mapped memory.
+        """
+        lines = ["Mapped regions:"]
+        total = 0
+        for start, end, perms in self.mapped_regions():
+            total += end - start
+            flags = "".join(c if perms & p else "-" for c, p in (("r", UC_PROT_READ), ("w", UC_PROT_WRITE), ("x", UC_PROT_EXEC)))
+            demand = any(r_start <= start < r_end for r_start, r_end, *_ in self.demand_regions)
+            lines.append(f"\t0x{start:x} - 0x{end - 1:x} {flags} 0x{end - start:x} bytes{' (on demand)' if demand else ''}")
+        lines.append(f"Total: 0x{total:x} bytes, {self.demand_pages} pages mapped on demand")
+        return "\n".join(lines)
+
     def skip_curr_insn(self) -> None:
         """Skips current instruction by directly jumping to the next one"""
-        address = self.curr_insn.address
-        size = self.curr_insn.size
-        self.uc.reg_write(UC_X86_REG_RIP, address + size)
+        # decode at RIP, as hooks added by users might run before instruction_hook updated curr_insn
+        address = self.uc.reg_read(UC_X86_REG_RIP)
+        insn = self.decode_cache.get_at(self.uc, address)
+        self.uc.reg_write(UC_X86_REG_RIP, address + insn.size)
 
     def instruction_hook(self, uc: Uc, address: int, size: int, user_data):
+        if self.restart_address is not None:
+            return  # emulation stops before this instruction executes
         # when unicorn encounters unsupported instructions (e.g. rdtscp), it might set the size to garbage
         # workaround by setting it to the x86 instruction size limit
-        if size > 15: size = 15
+        if size > MAX_INSN_SIZE: size = MAX_INSN_SIZE
         
         try:
-            insn_bytes = uc.mem_read(address, size)
+            insn = self.decode_cache.get(uc, address, size)
         except UcError as e:
-            self.log(f"\tError reading instruction bytes at 0x{address:x}: {e}")
+            self.log("\tError reading instruction bytes at 0x%x: %s", address, e, level=ERROR)
             return
         
-        for insn in self.cs.disasm(insn_bytes, address, 1):
+        if insn is not None:
             self.timer.increase_cycles(self.REGULAR_INSTR_CYCLES)
 
             self.curr_insn = insn
             self.curr_insn_address = address
             self.next_insn_addr = address + size
-            self.log(f"Executing 0x{address:x}: {insn.mnemonic} {insn.op_str}")
+            self.log("Executing 0x%x: %s %s", address, insn.mnemonic, insn.op_str, category=CAT_INSN, level=TRACE)
+            if self.trace is not None:
+                self.trace.insn(insn)
 
-            if address == 0x3841 or address == 0x3842 or address == 0x3843:
-                self.log(f"\tRSP: 0x{uc.reg_read(UC_X86_REG_RSP):x}")
+            if (address == 0x3841 or address == 0x3842 or address == 0x3843) and self.log_enabled(CAT_INSN, TRACE):
+                self.log("\tRSP: 0x%x", uc.reg_read(UC_X86_REG_RSP), category=CAT_INSN, level=TRACE)
 
             if address == self.code_exit_addr:
                 self.finish_emulation()
                 return
 
-            if insn.mnemonic == "call":
+            if insn.insn_class == INSN_CALL:
                 return_addr = address + insn.size
-                self.log(f"\tCall instruction detected, adding to RSB: 0x{return_addr:x}")
+                self.log("\tCall instruction detected, adding to RSB: 0x%x", return_addr, category=CAT_INSN)
 
                 self.rsb.add_ret_addr(return_addr)
             
-            if insn.mnemonic == "ret":
+            if insn.insn_class == INSN_RET:
                 predicted_ret_addr = self.rsb.pop_ret_addr()
-                self.log(f"\tReturn instruction detected, popping from RSB: 0x{predicted_ret_addr:x}")
+                self.log("\tReturn instruction detected, popping from RSB: 0x%x", predicted_ret_addr, category=CAT_INSN)
 
                 rsp = uc.reg_read(UC_X86_REG_RSP)
                 actual_ret_addr = int.from_bytes(uc.mem_read(rsp, 8), byteorder='little')
 
                 misprediction = predicted_ret_addr != actual_ret_addr and predicted_ret_addr != 0
                 if misprediction:
-                    self.log(f"\tCurrent RSB stack: {self.rsb.stack}")
-                    self.log(f"\tRSB misprediction detected: RSB predicted 0x{predicted_ret_addr:x}, actual 0x{actual_ret_addr:x}, RSP located at 0x{rsp:x}")
+                    self.log("\tCurrent RSB stack: %s", self.rsb.stack, category=CAT_SPEC)
+                    self.log("\tRSB misprediction detected: RSB predicted 0x%x, actual 0x%x, RSP located at 0x%x",
+                             predicted_ret_addr, actual_ret_addr, rsp, category=CAT_SPEC)
                     uc.reg_write(UC_X86_REG_RSP, rsp+8) # pop return address from stack for after rollback
                     self.speculate_rsb_misprediction(actual_ret_addr, predicted_ret_addr)
 
@@ -179,88 +724,120 @@ class MuWMEmulator():
                 return
             
             # Check if instruction is rdtscp
-            if insn.mnemonic == "rdtscp":
+            if insn.insn_class == INSN_RDTSCP:
                 self.persist_pending_loads()  # rdtscp waits until all previous loads are globally visisble (Intel manual v2)
                 self.timer.rdtscp(self)
                 self.skip_curr_insn()
+                if self.sparse_hooks and self.timer.active != (self.block_hook_handle is not None):
+                    self.restart_at(address + insn.size)  # (un)install the block hook
                 return
             
             # Check if instruction is clflush
-            if insn.mnemonic == "clflush":
-                for i, op in enumerate(insn.operands):
-                    if op.type == CS_OP_MEM:
-                        # Get base register value if it exists
-                        base_value = 0
-                        if op.mem.base != 0:
-                            if op.mem.base == X86_REG_RIP:  # Special handling for RIP-relative addressing
-                                # For RIP-relative addressing, we need the address of the next instruction
-                                # which is current RIP + instruction size
-                                base_value = uc.reg_read(op.mem.base) + insn.size
-                            else:
-                                base_value = uc.reg_read(op.mem.base)
-                        
-                        # Get index register value and scale if they exist
-                        index_value = 0
-                        if op.mem.index != 0:
-                            index_value = uc.reg_read(op.mem.index)
-                            index_value *= op.mem.scale
-                        
-                        # Calculate the full address
-                        flush_addr = base_value + index_value + op.mem.disp
-                        
-                        # Flush this address from the cache
-                        self.log(f"\tFlushing address 0x{flush_addr:x} from cache")
-                        self.cache.flush_address(flush_addr)
-                        break
+            if insn.insn_class == INSN_CLFLUSH:
+                for base, index, scale, disp in insn.mem_operands:
+                    # Get base register value if it exists
+                    base_value = 0
+                    if base != 0:
+                        if base == X86_REG_RIP:  # Special handling for RIP-relative addressing
+                            # For RIP-relative addressing, we need the address of the next instruction
+                            # which is current RIP + instruction size
+                            base_value = uc.reg_read(base) + insn.size
+                        else:
+                            base_value = uc.reg_read(base)
+                    
+                    # Get index register value and scale if they exist
+                    index_value = 0
+                    if index != 0:
+                        index_value = uc.reg_read(index)
+                        index_value *= scale
+                    
+                    # Calculate the full address
+                    flush_addr = base_value + index_value + disp
+                    
+                    # Flush this address from the cache
+                    self.log("\tFlushing address 0x%x from cache", flush_addr, category=CAT_MEM)
+                    if self.trace is not None:
+                        self.trace.cache_flush(flush_addr)
+                    self.cache.flush_address(flush_addr)
+                    break
                 
                 self.skip_curr_insn()
                 return
 
             # Check if instruction is mfence
-            if insn.mnemonic == "mfence":
-                self.log(f"\tMFENCE encountered, serializing all memory operations")
+            if insn.insn_class == INSN_MFENCE:
+                self.log("\tMFENCE encountered, serializing all memory operations", category=CAT_MEM)
                 self.persist_pending_loads()  # Complete all prior memory ops
                 self.pending_registers.clear()  # Clear pending registers
                 self.skip_curr_insn()
                 return
 
+            # the sites above skip their instruction (or restart), so Unicorn continues in a new basic block that
+            # block_hook accounts for. Here execution falls through to the rest of the block (e.g. after a div).
+            if self.sparse_hooks and self.speculation_hook is None:
+                self.timer.increase_cycles(self.site_map.trailing.get(address, 0) * self.REGULAR_INSTR_CYCLES)
+
             # Check if we should execute this instruction based on dependencies
             if not self.can_resolve_deps(insn):
-                self.log(f"\tSkipping instruction (resolving dependencies will exceed speculation limit)")
+                self.log("\tSkipping instruction (resolving dependencies will exceed speculation limit)", category=CAT_SPEC)
                 self.skip_curr_insn()
                 return
 
-        self.previous_context = self.uc.context_save()
-        
+            # only instructions that can fault need a snapshot for the workaround in emulate()
+            if insn.can_fault:
+                self.uc.context_update(self.previous_context)
+                self.previous_context_addr = address
+
         if self.in_speculation:
             self.speculation_depth += self.REGULAR_INSTR_CYCLES
-            self.log(f"\tSpeculation depth: {self.speculation_depth}")
+            self.log("\tSpeculation depth: %d", self.speculation_depth, category=CAT_SPEC, level=TRACE)
 
             # and on expired speculation window
             if self.speculation_depth > self.speculation_limit:
-                self.log(f"\tSpeculation window exceeded (depth: {self.speculation_depth}, limit: {self.speculation_limit})")
-                self.uc.emu_stop()
+                self.log("\tSpeculation window exceeded (depth: %d, limit: %d)", self.speculation_depth, self.speculation_limit, category=CAT_SPEC)
+                if self.trace is not None:
+                    self.trace.spec_window_exceeded(self.speculation_depth, self.speculation_limit)
+                if self.sparse_hooks:
+                    self.uc.emu_stop()  # the speculation hook is removed on the restart after the rollback
+                else:
+                    uc.reg_write(UC_X86_REG_RIP, self.rollback())  # roll back without leaving emu_start
 
     def mem_read_hook(self, uc: Uc, access, address: int, size: int, value, user_data):
-        regs_read, regs_written = self.curr_insn.regs_access()
+        if self.sparse_hooks and self.speculation_hook is None:
+            # most instructions don't pass instruction_hook in sparse mode
+            rip = uc.reg_read(UC_X86_REG_RIP)
+            insn = self.decode_cache.get_at(uc, rip)
+            if insn is not None:
+                self.curr_insn = insn
+            self.curr_insn_address = rip
+
+        if self._log_filter is not None:
+            self.curr_mem_address = address
+            self.curr_mem_insn_address = self.curr_insn_address
+        regs_written = self.curr_insn.regs_written
 
         # cache miss: add address and registers to pending
         if not self.cache.is_cached(address):
+            if self.demand_regions and not self.cache.tag_only:
+                # the cache reads line_size bytes from the address before unmapped_hook runs, possibly from the next chunk
+                self.map_on_demand(address, self.cache.line_size)
             self.timer.increase_cycles(self.CACHE_MISS_CYCLES)
             self.pending_memory_loads.add(address)
             for reg in regs_written:
-                self.pending_registers[reg] = self.CACHE_MISS_CYCLES
+                self.pending_registers.set(reg, self.CACHE_MISS_CYCLES)
                 if self.in_speculation:
                     if self.CACHE_MISS_CYCLES > self.speculation_limit:
-                        self.log(f"\tSkipping instruction (execution will exceed speculation limit)")
+                        self.log("\tSkipping instruction (execution will exceed speculation limit)", category=CAT_SPEC)
                         self.skip_curr_insn()
                     else:
                         self.speculation_depth += self.CACHE_MISS_CYCLES
-                        self.log(f"\tReading cache address 0x{address:x}")
+                        self.log("\tReading cache address 0x%x", address, category=CAT_MEM, level=TRACE)
                         self.cache.read(address, uc)
                 else:
                     self.cache.read(address, uc)
-            self.log(f"\tMemory read: address=0x{address:x}, size={size}, CACHE MISS")
+            self.log("\tMemory read: address=0x%x, size=%d, CACHE MISS", address, size, category=CAT_MEM, level=TRACE)
+            if self.trace is not None:
+                self.trace.mem_read(address, size, False)
         
         # cache hit: remove address and registers from pending
         else:
@@ -270,20 +847,52 @@ class MuWMEmulator():
             for reg in regs_written:
                 self.remove_pending_register(reg)
 
-            self.log(f"\tMemory read: address=0x{address:x}, size={size}, CACHE HIT")
+            self.log("\tMemory read: address=0x%x, size=%d, CACHE HIT", address, size, category=CAT_MEM, level=TRACE)
+            if self.trace is not None:
+                self.trace.mem_read(address, size, True)
         
         self._pretty_print_pending_state(indent=1)
 
     def mem_write_hook(self, uc: Uc, access, address: int, size: int, value, user_data):
+        self.decode_cache.invalidate(address, size)  # self-modifying code
+        if self._log_filter is not None:
+            self.curr_mem_address = address
+            self.curr_mem_insn_address = self.curr_insn_address
         self.cache.write(address, value)
         if self.in_speculation:
-            # store the original value in case we need to rollback
-            original_value = uc.mem_read(address, size)
-            self.store_logs[-1].append((address, original_value))
-        self.log(f"\tMemory write: address=0x{address:x}, size={size}, value=0x{value:x}")
+            if not self.snapshot_memory:
+                # store the original value in case we need to rollback
+                if self.demand_regions:
+                    self.map_on_demand(address, size)
+                original_value = uc.mem_read(address, size)
+                self.store_logs[-1].append((address, original_value))
+            elif (address >> PAGE_SHIFT) in self.decode_cache.pages:
+                self.store_logs[-1].append((address, bytes(size)))
+        self.log("\tMemory write: address=0x%x, size=%d, value=0x%x", address, size, value, category=CAT_MEM, level=TRACE)
+        if self.trace is not None:
+            self.trace.mem_write(address, size, value)
+
+    def unmodeled_read_hook(self, uc: Uc, access, address: int, size: int, value, user_data):
+        """
+        Reads outside of mem_ranges always hit (MEM_ALWAYS_HIT), without touching the cache model.
+        """
+        if self.sparse_hooks and self.speculation_hook is None:
+            insn = self.decode_cache.get_at(uc, uc.reg_read(UC_X86_REG_RIP))
+            if insn is not None:
+                self.curr_insn = insn
+        self.timer.increase_cycles(self.REGULAR_INSTR_CYCLES)
+        for reg in self.curr_insn.regs_written:
+            self.remove_pending_register(reg)
+
+    def unmodeled_write_hook(self, uc: Uc, access, address: int, size: int, value, user_data):
+        if self.in_speculation:
+            if self.demand_regions:
+                self.map_on_demand(address, size)
+            self.store_logs[-1].append((address, uc.mem_read(address, size)))
 
     def rollback(self):
-        self.log(f"RSP before rollback: 0x{self.uc.reg_read(UC_X86_REG_RSP):x}")
+        if self.log_enabled(CAT_SPEC):
+            self.log("RSP before rollback: 0x%x", self.uc.reg_read(UC_X86_REG_RSP), category=CAT_SPEC)
         state, next_insn_addr, flags = self.checkpoints.pop()
         
         # reset speculative state
@@ -291,21 +900,32 @@ class MuWMEmulator():
         self.speculation_depth = 0
         self.speculation_limit = 0
         self.persist_pending_loads()
-        self.log(f"\tRollback complete")
+        self.log("\tRollback complete", category=CAT_SPEC)
+        if self.trace is not None:
+            self.trace.rollback(next_insn_addr)
         
-        # restore registers
-        self.uc.context_restore(state)
-
-        # rollback memory changes
+        # restore registers (and memory, with snapshots)
         mem_changes = self.store_logs.pop()
-        while mem_changes:
-            addr, val = mem_changes.pop()
-            self.uc.mem_write(addr, bytes(val))
+        if self.snapshot_memory:
+            self.set_context_memory(True)
+            self.uc.context_restore(state)
+            self.set_context_memory(False)
+            for addr, val in mem_changes:
+                self.decode_cache.invalidate(addr, len(val))
+        else:
+            self.uc.context_restore(state)
+
+            # rollback memory changes
+            while mem_changes:
+                addr, val = mem_changes.pop()
+                self.uc.mem_write(addr, bytes(val))
+                self.decode_cache.invalidate(addr, len(val))
         
         # restore flags
         self.uc.reg_write(UC_X86_REG_EFLAGS, flags)
 
-        self.log(f"RSP after rollback: 0x{self.uc.reg_read(UC_X86_REG_RSP):x}")
+        if self.log_enabled(CAT_SPEC):
+            self.log("RSP after rollback: 0x%x", self.uc.reg_read(UC_X86_REG_RSP), category=CAT_SPEC)
 
         return next_insn_addr
     
@@ -313,14 +933,14 @@ class MuWMEmulator():
         """
         Persist pending memory loads to the cache.
         """
-        self.log("Persisting pending memory loads...")
+        self.log("Persisting pending memory loads...", category=CAT_DEPS)
         self._pretty_print_pending_state(indent=1)
         for address in self.pending_memory_loads:
-            self.cache.write(address, self.uc.mem_read(address, self.cache.line_size))
+            self.cache.write(address, None if self.cache.tag_only else self.uc.mem_read(address, self.cache.line_size))
         self.pending_memory_loads.clear()
         self.pending_registers.clear()
 
-    def can_resolve_deps(self, insn: CsInsn):
+    def can_resolve_deps(self, insn: DecodedInsn):
         """
         Determines if an instruction can resolve its dependencies within the speculative limit.
         """
@@ -328,11 +948,11 @@ class MuWMEmulator():
             # only perform OOO execution in speculation
             return True
             
-        regs_read, regs_written = insn.regs_access()
+        regs_written = insn.regs_written
 
         # check if any read registers are pending
         max_cycle_wait = self.cycles_to_resolve_dep(insn)
-        self.log(f"\tCycles to resolve deps: {max_cycle_wait}")
+        self.log("\tCycles to resolve deps: %d", max_cycle_wait, category=CAT_DEPS, level=TRACE)
 
         # no dependencies
         if max_cycle_wait == 0:
@@ -343,31 +963,27 @@ class MuWMEmulator():
 
         # update resolve times for affected registers
         for reg in regs_written:
-            self.pending_registers[reg] = max_cycle_wait
+            self.pending_registers.set(reg, max_cycle_wait)
 
         return max_cycle_wait <= self.speculation_limit
     
-    def cycles_to_resolve_dep(self, insn: CsInsn) -> int:
+    def cycles_to_resolve_dep(self, insn: DecodedInsn) -> int:
         """
         Calculate the maximum amount of cycles needed for resolving the dependencies of the given instruction. Checks both direct dependencies and aliased register dependencies.
         """
-        regs_read, _ = insn.regs_access()
+        regs_read = insn.regs_read
         max_cycle_wait = 0
 
-        self.log(f"\tRegs read: {[f'{self.cs.reg_name(reg_id)}' for reg_id in regs_read]}")
-        self.log(f"\tPending registers: {[f'{self.cs.reg_name(reg_id)}' for reg_id in self.pending_registers.keys()]}")
+        if self.log_enabled(CAT_DEPS, TRACE):
+            self.log(f"\tRegs read: {[f'{self.cs.reg_name(reg_id)}' for reg_id in regs_read]}", category=CAT_DEPS, level=TRACE)
+            self.log(f"\tPending registers: {[f'{self.cs.reg_name(reg_id)}' for reg_id, _ in self.pending_registers.items()]}", category=CAT_DEPS, level=TRACE)
         
+        # direct and aliasing dependencies
+        wait = self.pending_registers.wait
         for reg_read in regs_read:
-            # Check direct dependencies
-            if reg_read in self.pending_registers:
-                max_cycle_wait = max(max_cycle_wait, self.pending_registers[reg_read])
-                continue
-                
-            # Check for aliasing dependencies
-            for pending_reg, cycles in self.pending_registers.items():
-                if registers_alias(reg_read, pending_reg):
-                    max_cycle_wait = max(max_cycle_wait, cycles)
-                    break
+            cycles = wait(reg_read)
+            if cycles > max_cycle_wait:
+                max_cycle_wait = cycles
                     
         return max_cycle_wait
     
@@ -375,20 +991,21 @@ class MuWMEmulator():
         """
         Remove a register and all its aliases from pending_registers.
         """
-        from helper import get_register_aliases
-        
-        # Get all aliases for this register
-        aliases = get_register_aliases(reg_id)
-        
-        # Remove the register and all its aliases from pending_registers
-        for alias in aliases:
-            if alias in self.pending_registers:
-                self.log(f"\tRemoving pending register {self.cs.reg_name(alias)}")
-                self.pending_registers.pop(alias)
+        removed = self.pending_registers.remove_family(reg_id)
+        if removed and self.log_enabled(CAT_DEPS, TRACE):
+            for alias in removed:
+                self.log("\tRemoving pending register %s", self.cs.reg_name(alias), category=CAT_DEPS, level=TRACE)
 
     
     def emulate(self):
         start_address = self.code_start_address
+        if self.sparse_hooks and self.model_hooks:
+            self.hook_exit_site()
+        if self.roi_enabled():
+            self.in_roi = self.in_roi_range(start_address) or start_address in self.roi_enter_addrs
+            self.remove_model_hooks()
+            self.remove_fast_forward_hooks()
+
         while True:
             self.pending_fault_id = 0
 
@@ -396,41 +1013,56 @@ class MuWMEmulator():
                 self.finish_emulation()
                 return
 
+            self.sync_roi_hooks(start_address)
+            if self.in_roi:
+                self.sync_sparse_hooks()
+                self.sync_unmodeled_hooks()
+
             try:
-                self.log(f"(Re)starting emulation with start address 0x{start_address:x}, exit address 0x{self.code_exit_addr:x}")
-                self.log(f"Execution mode: {'speculative (limit: ' + str(self.speculation_limit) + ')' if self.in_speculation else 'normal'}")
+                self.log("(Re)starting emulation with start address 0x%x, exit address 0x%x", start_address, self.code_exit_addr)
+                if self.in_speculation:
+                    self.log("Execution mode: speculative (limit: %d)", self.speculation_limit)
+                else:
+                    self.log("Execution mode: normal")
                 self.uc.emu_start(start_address, -1)
 
-                if self.curr_insn_address == self.code_exit_addr:
+                # curr_insn_address isn't updated while fast-forwarding, so it may be stale on a restart
+                if self.restart_address is None and self.curr_insn_address == self.code_exit_addr:
                     return
                 
             except UcError as e:
-                self.log(f"\tError interpreting instruction at 0x{self.curr_insn.address:x}: {e}")
+                self.log("\tError interpreting instruction at 0x%x: %s", self.curr_insn.address, e)
                 self.pending_fault_id = int(e.errno)
             
             except Exception as e:
                 error_msg = f"Unhandled exception (stopping emulation): {e}"
                 stack_trace = traceback.format_exc()
-                self.log(f"{error_msg}\n{stack_trace}")
+                self.log("%s\n%s", error_msg, stack_trace, level=ERROR)
                 print(f"{error_msg}\n{stack_trace}")
                 self.finish_emulation()
                 return
 
+            if self.restart_address is not None:
+                start_address = self.restart_address
+                self.restart_address = None
+                continue
+
+            faulted = self.pending_fault_id != 0 or self.unhandled_fault
+            self.unhandled_fault = False
             if self.pending_fault_id:
-                # workaround for a Unicorn bug: after catching an exception
-                # we need to restore some pre-exception context. otherwise,
-                # the emulator becomes corrupted
-                self.uc.context_restore(self.previous_context)
-                # another workaround, specifically for flags
-                self.uc.reg_write(UC_X86_REG_EFLAGS, self.uc.reg_read(UC_X86_REG_EFLAGS))
+                self.restore_pre_fault_context()
             
                 start_address = self.handle_fault(self.pending_fault_id)
 
                 self.pending_fault_id = 0
                 if start_address and start_address != self.code_exit_addr:
-                    self.log(f"\tSetting start address at 0x{start_address:x}")
+                    self.log("\tSetting start address at 0x%x", start_address)
                     continue
             
+            if faulted and not self.in_speculation:
+                self.finish_emulation()  # unhandled fault, resuming would only fault again
+                return
+
             # used to resume emulation after rollback
             if self.in_speculation:
                 start_address = self.rollback()
@@ -439,24 +1071,198 @@ class MuWMEmulator():
     def finish_emulation(self):
         self.persist_pending_loads()
         self.log("Emulation finished")
+        self.logger.flush()
+        if self.trace is not None:
+            self.trace.flush()
         self.uc.emu_stop()
 
+    def resettable(self) -> bool:
+        """Whether save_reset_state() supports this emulator"""
+        return not self.demand_regions and not self.snapshot_memory
+
+    def save_reset_state(self):
+        """
+        Saves the state reset() returns to: registers, a copy-on-write snapshot of memory, and the cache, RSB and timer.
+        Unicorn (2.1) can't map memory anymore once memory was written after a snapshot, so this is called after all
+        memory is mapped, typically once the binary is loaded and the input/output pages are set up (see EmulatorPool).
+        That rules out demand paging as well.
+        """
+        if self.demand_regions:
+            raise ValueError("Emulators with demand-paged memory can't be reset (no memory can be mapped after a snapshot)")
+        if self.snapshot_memory:
+            raise ValueError("Emulators with the snapshot checkpoint backend can't be reset (Unicorn crashes restoring it)")
+        self.set_context_memory(True)
+        self.reset_context = self.uc.context_save()
+        self.set_context_memory(False)
+        self.reset_models = copy.deepcopy((self.cache, self.rsb, self.timer))
+
+    def reset(self):
+        """
+        Restores the state saved by save_reset_state(), so another evaluation can reuse the loaded emulator. Hooks added
+        by users are kept.
+        """
+        self.set_context_memory(True)
+        self.uc.context_restore(self.reset_context)
+        self.set_context_memory(False)
+        self.cache, self.rsb, self.timer = copy.deepcopy(self.reset_models)
+
+        # speculation, OoOE and checkpoints
+        self.in_speculation = False
+        self.speculation_depth = 0
+        self.speculation_limit = 0
+        self.previous_context_addr = None
+        self.pending_registers.clear()
+        self.pending_memory_loads = set()
+        self.checkpoints = []
+        self.store_logs = []
+        self.pending_fault_id = 0
+        self.unhandled_fault = False
+        self.restart_address = None
+        self.round_count = None
+
+        self.curr_insn_address = 0
+        self.next_insn_addr = 0
+        self.curr_mem_address = 0
+        self.curr_mem_insn_address = -1
+        if self.decode_cache.code_written:
+            self.decode_cache.clear()  # decodings of written code might not match the restored memory
+
+        if self.flight_recorder is not None:
+            self.flight_recorder.clear()
+        MuWMEmulator.last_flight_recorder = self.flight_recorder
+
+    def save_state(self, path: str, extra: object = None):
+        """
+        Saves memory, registers and the modeled microarchitectural state to a file (see state_file.py), to resume from
+        later with load_state(). Called from a code hook, the saved state resumes at that hook's instruction. extra can
+        be any JSON-serializable value the caller needs to resume, e.g. its own progress (tuples come back as lists).
+        """
+        if self.snapshot_memory or self.reset_context is not None:
+            raise ValueError("Emulators using memory snapshots can't be saved (Unicorn misreports their memory regions)")
+        state_file.save_state(self, path, extra)
+
+    def load_state(self, path: str) -> object:
+        """
+        Restores a state saved by save_state() into an emulator created for the same binary. Emulation continues with
+        emulate() at code_start_address, which is set to the saved instruction. Returns the saved extra object.
+        """
+        extra = state_file.load_state(self, path)
+        self.code_start_address = self.uc.reg_read(UC_X86_REG_RIP)
+        self.decode_cache.clear()
+        self.restart_address = None
+        return extra
+
     def _pretty_print_pending_state(self, indent=0):
         """
         Pretty prints the current state of pending memory loads and registers.
         """
+        if not self.log_enabled(CAT_DEPS, TRACE):
+            return
+
         indent_str = "\t" * indent
-        self.log(f"{indent_str}Pending memory loads: {[f'0x{address:x}' for address in self.pending_memory_loads]}")
+        self.log(f"{indent_str}Pending memory loads: {[f'0x{address:x}' for address in self.pending_memory_loads]}", category=CAT_DEPS, level=TRACE)
         
         # Update to show both register names and cycle counts
         reg_entries = [f"{self.cs.reg_name(reg_id)}:{cycles}" for reg_id, cycles in self.pending_registers.items()]
-        self.log(f"{indent_str}Pending registers: {reg_entries}")
+        self.log(f"{indent_str}Pending registers: {reg_entries}", category=CAT_DEPS, level=TRACE)
     
-    def log(self, message: str):
+    def mark_round(self, round_num: int):
+        """
+        Marks the start of a round (e.g. of a SHA-1 block) in the binary trace, so it can be found through its index.
+        """
+        if self.trace is not None:
+            self.trace.round(round_num)
+
+    def close_trace(self, index: bool = False):
+        """
+        Closes the binary trace and optionally indexes it for random-access queries (see trace_index.py).
+        """
+        if self.trace is None:
+            return
+        self.trace.close()
+        if index:
+            TraceIndex(self.trace.path)
+        self.trace = None
+
+    def close(self):
+        """
+        Releases the Unicorn engine with its memory and saved contexts, and closes the log, the trace and the loader.
+        The flight recorder is kept, so it can still be dumped. Closing again does nothing.
+
+        Uc has no close(), the engine is released when it is collected. Unicorn's hook callbacks reference it in cycles,
+        so that is up to the garbage collector; engine_finalizer.alive tells whether it is still around.
+        """
+        if self.uc is None:
+            return
+        self.close_trace()
+        self.logger.close()
+        self.loader.close()
+
+        # saved contexts and segment views are freed before the engine they belong to
+        self.previous_context = None
+        self.reset_context = None
+        self.reset_models = None
+        self.checkpoints = []
+        self.store_logs = []
+        self.demand_regions = []
+        self.decode_cache.clear()
+
+        self.uc = None
+
+    @staticmethod
+    def _engine_released():
+        MuWMEmulator.live_engines -= 1
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def dump_flight_recorder(self, path: str = None) -> str:
+        """
+        Writes the most recent log messages to output/<name>/flight_recorder.txt (or the given path) and returns the path.
+        Returns None if the flight recorder is disabled.
+        """
+        if self.flight_recorder is None:
+            return None
+        return self.flight_recorder.dump(path)
+
+    @classmethod
+    def dump_last_flight_recorder(cls) -> str:
+        """
+        Dumps the flight recorder of the most recently created or reset emulator, for test runners that don't have
+        access to it. Works after the emulator was closed, too.
+        """
+        if cls.last_flight_recorder is None:
+            return None
+        return cls.last_flight_recorder.dump()
+
+    def log_enabled(self, category: int = CAT_GENERAL, level: int = DEBUG) -> bool:
+        """
+        Whether log() would write a message of the given category and level to the log. Guard expensive messages with
+        this, the flight recorder only records the cheap ones (see log()).
+        """
+        return self.logger.enabled(category, level) and (self._log_filter is None or self._log_filter(self))
+
+    def set_trace_filter(self, trace_filter: TraceFilter):
+        """
+        Restricts the log to what trace_filter selects (None logs everything). The binary trace is not filtered.
+        """
+        self.trace_filter = trace_filter
+        self._log_filter = trace_filter.compile(self.loader.get_symbol_range) if trace_filter is not None else None
+
+    def log(self, message: str, *args, category: int = CAT_GENERAL, level: int = DEBUG):
         """
-        Log a message using the logger.
+        Log a message using the logger. Formatting the message with args is deferred until it is known to be written.
         """
-        # if 0xa2820 <= self.curr_insn_address <= 0xa2d19 or \
-        #     (self.round_count is not None and self.round_count[0] == 65): # in sha1_block
-        if 0xa2820 <= self.curr_insn_address <= 0xa2d19:
-            self.logger.log(message)
\ No newline at end of file
+        if self._record_categories & category and level >= self._record_level:
+            if args and not all(type(arg) in IMMUTABLE_LOG_ARGS for arg in args):
+                self._record((message % args, ()))  # mutable arguments (e.g. the RSB stack) may change before the dump
+            else:
+                self._record((message, args))
+        logger = self.logger
+        if not logger.categories & category or level < logger.level:
+            return  # cheap exit, e.g. with debug off
+        if self._log_filter is None or self._log_filter(self):
+            logger.log(message, *args)
\ No newline at end of file
@@ -0,0 +1,53 @@
+import gc
+from typing import Callable, Dict, Hashable, Set
+from emulator import MuWMEmulator
+
+class EmulatorPool():
+    """
+    Loaded emulators by key (e.g. gate name and debug flag), so repeated evaluations of the same binary skip parsing the
+    ELF, mapping memory and creating loggers. The first get() builds the emulator with the factory, which also maps all
+    memory the evaluations need, and saves its reset state. Later calls reset() it to that state. Emulators that can't be
+    reset (with the snapshot checkpoint backend or demand paging) are built anew for every get(), which is reported once
+    per key. Close the pool (or use it as a context manager) to close its emulators.
+    """
+    def __init__(self):
+        self.emulators: Dict[Hashable, MuWMEmulator] = {}
+        self.unpooled: Set[Hashable] = set()  # keys whose emulators can't be reset
+
+    def get(self, key: Hashable, factory: Callable[[], MuWMEmulator]) -> MuWMEmulator:
+        # the class-wide checkpoint backend is only read when an emulator is built
+        key = (key, MuWMEmulator.checkpoint_backend)
+        emulator = self.emulators.get(key)
+        if emulator is not None and not emulator.resettable():
+            # Unicorn (2.1) crashes restoring the reset snapshot after checkpoint snapshots and can't map memory after
+            # one, these are rebuilt instead
+            emulator.close()
+            emulator = None
+        if emulator is None:
+            emulator = factory()
+            if emulator.resettable():
+                emulator.save_reset_state()
+            elif key not in self.unpooled:
+                self.unpooled.add(key)
+                print(f"EmulatorPool: {emulator.name} can't be reset (snapshot checkpoints or demand paging), "
+                      f"it is rebuilt for every evaluation")
+            self.emulators[key] = emulator
+        else:
+            emulator.reset()
+        return emulator
+
+    def clear(self):
+        """Closes and forgets all emulators, and collects their engines (see MuWMEmulator.close)"""
+        for emulator in self.emulators.values():
+            emulator.close()
+        self.emulators.clear()
+        gc.collect()
+
+    def close(self):
+        self.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
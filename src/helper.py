@@ -1,5 +1,5 @@
 from unicorn.x86_const import *
-from typing import Set
+from typing import List, Set, Tuple
 
 # Global mapping of x86 register families - each list contains registers that alias
 X86_REG_FAMILIES = {
@@ -53,6 +53,20 @@ def get_register_aliases(reg_id: int) -> Set[int]:
     # If register is not found in any family, return just the register itself
     return {reg_id}
 
+def complement_ranges(ranges: List[Tuple[int, int]], limit: int = 1 << 64) -> List[Tuple[int, int]]:
+    """
+    The [start, end) ranges of [0, limit) that aren't covered by the given sorted, non-overlapping ranges.
+    """
+    complement = []
+    prev_end = 0
+    for start, end in ranges:
+        if start > prev_end:
+            complement.append((prev_end, start))
+        prev_end = max(prev_end, end)
+    if prev_end < limit:
+        complement.append((prev_end, limit))
+    return complement
+
 def compare_runs(function, inputs):
     """
     Can be used to show determinism of the emulator.
@@ -1,8 +1,12 @@
 from unicorn import *
 from unicorn.x86_const import *
 from compiler import compile_asm
-from typing import Protocol, runtime_checkable
+from typing import Dict, List, Optional, Protocol, Tuple, runtime_checkable
+from elftools.construct.lib.container import Container
 from elftools.elf.elffile import ELFFile
+import ctypes
+import mmap
+import os
 from logger import Logger
 
 @runtime_checkable
@@ -23,11 +27,38 @@ class EmulatorInterface(Protocol):
     # logger
     logger: Logger
 
+    # demand paging
+    demand_page_limit: int
+
+    def add_demand_region(self, start: int, end: int, perms: int, contents: bytes = b'', contents_addr: int = None): ...
+
 class Loader():
     def load(self, emulator: EmulatorInterface):
         """Abstract method to load code into the emulator"""
         pass
 
+    def get_code_ranges(self) -> List[Tuple[int, int]]:
+        """Returns the (start, end) address ranges of the executable code that was loaded"""
+        return []
+
+    def get_symbol_range(self, name: str) -> Optional[Tuple[int, int]]:
+        """Returns the (start, end) address range of a symbol, or None if it is unknown"""
+        return None
+
+    def get_plt_symbols(self) -> Dict[int, str]:
+        """Returns the names of the dynamically linked functions by the address of their PLT stub"""
+        return {}
+
+    def close(self):
+        """Releases what load() acquired"""
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
 class AsmLoader(Loader):
     CODE_BASE = 0x1000
     DATA_BASE = 0x2000
@@ -40,7 +71,7 @@ class AsmLoader(Loader):
     def load(self, emulator: EmulatorInterface):
         """Load assembly code into the emulator"""
         output_dir = emulator.output_dir
-        self.machine_code = compile_asm(self.asm_code, output_dir=output_dir)
+        self.machine_code = compile_asm(self.asm_code, output_dir=output_dir, debug=emulator.logger.debug)
         self._map_memory(emulator)
     
     def _map_memory(self, emulator: EmulatorInterface):
@@ -60,66 +91,191 @@ class AsmLoader(Loader):
         emulator.fault_handler_addr = emulator.code_exit_addr  # No fault handler in asm snippet
         emulator.data_start_addr = self.DATA_BASE
 
+    def get_code_ranges(self) -> List[Tuple[int, int]]:
+        return [(self.CODE_BASE, self.CODE_BASE + len(self.machine_code))]
+
+class ELFImage():
+    """
+    An ELF file parsed once per process and shared by all ELFLoaders of it (see get()). The file is memory-mapped and
+    the contents of the PT_LOAD segments are views on that mapping, so they are written into Unicorn without copies.
+    Symbol and PLT lookups are cached as well.
+    """
+    _images: Dict[str, 'ELFImage'] = {}
+
+    def __init__(self, path: str, stamp: Tuple[int, int]):
+        self.path = path
+        self.stamp = stamp  # (mtime, size) of the file when it was parsed
+        self.f = open(path, "rb")
+        self.data = mmap.mmap(self.f.fileno(), 0, access=mmap.ACCESS_COPY)  # private and writable, for ctypes views
+        self.elf = ELFFile(self.f)
+
+        # (header, file contents) of the PT_LOAD segments
+        self.segments: List[Tuple[Container, object]] = []
+        for segment in self.elf.iter_segments():
+            if segment.header.p_type == 'PT_LOAD':
+                header = segment.header
+                contents = (ctypes.c_char * header.p_filesz).from_buffer(self.data, header.p_offset) if header.p_filesz else b''
+                self.segments.append((header, contents))
+
+        self.symbol_ranges: Dict[str, Optional[Tuple[int, int]]] = {}
+        self.plt_symbols: Dict[int, str] = None
+
+    def close(self):
+        """
+        Closes the mapping and the file. Fails with a BufferError while segment contents are still in use, e.g. by the
+        demand regions of an emulator that isn't closed.
+        """
+        self.segments = []
+        self.data.close()
+        self.f.close()
+
+    @classmethod
+    def close_all(cls):
+        """
+        Closes all cached images, later loads parse their files again.
+        """
+        for image in cls._images.values():
+            image.close()
+        cls._images.clear()
+
+    @classmethod
+    def get(cls, path: str) -> 'ELFImage':
+        """
+        The image of the file at path, parsed again only if the file changed since.
+        """
+        path = os.path.realpath(path)
+        stat = os.stat(path)
+        stamp = (stat.st_mtime_ns, stat.st_size)
+        image = cls._images.get(path)
+        if image is None or image.stamp != stamp:
+            if image is not None:
+                try:
+                    image.close()
+                except BufferError:
+                    pass  # still used by a live emulator, the mapping is released with its last segment view
+            image = cls(path, stamp)
+            cls._images[path] = image
+        return image
+
 class ELFLoader(Loader):
     STACK_ADDR = 0x70000000
     STACK_SIZE = 0x10000000
+    PLT_ENTRY_SIZE = 16
 
-    def __init__(self, elf_path: str, stack_addr: int = STACK_ADDR, stack_size: int = STACK_SIZE):
+    def __init__(self, elf_path: str, stack_addr: int = STACK_ADDR, stack_size: int = STACK_SIZE,
+                 demand_paging: bool = False, demand_page_limit: int = None):
         self.elf_path = elf_path
         self.stack_addr = stack_addr
         self.stack_size = stack_size
+        # map the stack and the data segments only once they are accessed, at most demand_page_limit pages of them
+        self.demand_paging = demand_paging
+        self.demand_page_limit = demand_page_limit
+        self.code_ranges: List[Tuple[int, int]] = []
     
     def load(self, emulator: EmulatorInterface):
         """Load ELF file into the emulator"""
-        self.f = open(self.elf_path, "rb")
-        self.elf = ELFFile(self.f)
+        self.image = ELFImage.get(self.elf_path)
+        self.elf = self.image.elf
+        if self.demand_paging:
+            emulator.demand_page_limit = self.demand_page_limit
         
         self.map_segments(emulator)
         self.map_stack(emulator)
     
     def map_segments(self, emulator: EmulatorInterface):
         emulator.logger.log("Mapping segments:")
-        for segment in self.elf.iter_segments():
-            if segment.header.p_type == 'PT_LOAD':  # Only consider loadable segments
-                # Calculate memory size (page-aligned)
-                mem_start = segment.header.p_vaddr & ~0xFFF  # Page align
-                mem_end = (segment.header.p_vaddr + segment.header.p_memsz + 0xFFF) & ~0xFFF
-                mem_size = mem_end - mem_start
-
-                # Determine segment permissions
-                perm = 0
-                if segment.header.p_flags & 0x1:  # PF_X - Execute
-                    perm |= UC_PROT_EXEC
-                if segment.header.p_flags & 0x2:  # PF_W - Write
-                    perm |= UC_PROT_WRITE
-                if segment.header.p_flags & 0x4:  # PF_R - Read
-                    perm |= UC_PROT_READ
-                    
-                # Make sure we have at least read permission
-                if perm == 0:
-                    perm = UC_PROT_READ
-                    
-                # Map memory region used by segment
-                emulator.logger.log(f"Mapping segment at 0x{mem_start:x} - 0x{mem_end-1:x}, size: 0x{mem_size:x}")
+        self.code_ranges = []
+        for header, contents in self.image.segments:
+            # Calculate memory size (page-aligned)
+            mem_start = header.p_vaddr & ~0xFFF  # Page align
+            mem_end = (header.p_vaddr + header.p_memsz + 0xFFF) & ~0xFFF
+            mem_size = mem_end - mem_start
+
+            # Determine segment permissions
+            perm = 0
+            if header.p_flags & 0x1:  # PF_X - Execute
+                perm |= UC_PROT_EXEC
+            if header.p_flags & 0x2:  # PF_W - Write
+                perm |= UC_PROT_WRITE
+            if header.p_flags & 0x4:  # PF_R - Read
+                perm |= UC_PROT_READ
                 
-                try:
-                    emulator.uc.mem_map(mem_start, mem_size, perm)
-                    
-                    # Map segment data
-                    data = segment.data()
-                    emulator.uc.mem_write(segment.header.p_vaddr, data)
-                    emulator.logger.log(f"\tData written: 0x{len(data):x} bytes at 0x{segment.header.p_vaddr:x}")
-                    
-                    # Zero out uninitialized data
-                    if segment.header.p_memsz > segment.header.p_filesz:
-                        padding_size = segment.header.p_memsz - segment.header.p_filesz
-                        padding_addr = segment.header.p_vaddr + segment.header.p_filesz
-                        emulator.uc.mem_write(padding_addr, b'\x00' * padding_size)
-                        emulator.logger.log(f"\tZeroed: 0x{padding_size:x} bytes at 0x{padding_addr:x}")
-                except UcError as e:
-                    emulator.logger.log(f"\tError mapping segment: {e}")
+            # Make sure we have at least read permission
+            if perm == 0:
+                perm = UC_PROT_READ
+                
+            # Data segments can be mapped on demand, code is read up front for site maps and PLT intercepts
+            if self.demand_paging and not header.p_flags & 0x1:
+                emulator.logger.log(f"Mapping segment at 0x{mem_start:x} - 0x{mem_end-1:x} on demand, size: 0x{mem_size:x}")
+                emulator.add_demand_region(mem_start, mem_end, perm, contents, header.p_vaddr)
+                continue
+
+            # Map memory region used by segment
+            emulator.logger.log(f"Mapping segment at 0x{mem_start:x} - 0x{mem_end-1:x}, size: 0x{mem_size:x}")
+            
+            try:
+                emulator.uc.mem_map(mem_start, mem_size, perm)
+                
+                # Map segment data, uninitialized data (.bss) is already zeroed by mem_map
+                emulator.uc.mem_write(header.p_vaddr, contents)
+                emulator.logger.log(f"\tData written: 0x{len(contents):x} bytes at 0x{header.p_vaddr:x}")
+                if header.p_flags & 0x1:
+                    self.code_ranges.append((header.p_vaddr, header.p_vaddr + len(contents)))
+            except UcError as e:
+                emulator.logger.log(f"\tError mapping segment: {e}")
     
+    def get_code_ranges(self) -> List[Tuple[int, int]]:
+        return self.code_ranges
+
+    def close(self):
+        """
+        Drops the references to the image. The image itself stays cached for later loads, see ELFImage.close_all.
+        """
+        self.image = None
+        self.elf = None
+
+    def get_symbol_range(self, name: str) -> Optional[Tuple[int, int]]:
+        if name not in self.image.symbol_ranges:
+            self.image.symbol_ranges[name] = self._find_symbol_range(name)
+        return self.image.symbol_ranges[name]
+
+    def _find_symbol_range(self, name: str) -> Optional[Tuple[int, int]]:
+        symtab = self.elf.get_section_by_name('.symtab')
+        if symtab is None:
+            return None
+        for symbol in symtab.get_symbol_by_name(name) or []:
+            if symbol['st_value']:
+                return (symbol['st_value'], symbol['st_value'] + max(symbol['st_size'], 1))
+        return None
+
+    def get_plt_symbols(self) -> Dict[int, str]:
+        if self.image.plt_symbols is None:
+            self.image.plt_symbols = self._find_plt_symbols()
+        return self.image.plt_symbols
+
+    def _find_plt_symbols(self) -> Dict[int, str]:
+        """
+        Resolves the PLT stubs from the .rela.plt relocations: the i-th relocation belongs to the i-th stub in .plt.sec
+        if the binary has one (IBT), otherwise to the (i+1)-th stub in .plt (the first one is the lazy resolver).
+        """
+        rela_plt = self.elf.get_section_by_name('.rela.plt')
+        plt_sec = self.elf.get_section_by_name('.plt.sec')
+        plt = plt_sec or self.elf.get_section_by_name('.plt')
+        if rela_plt is None or plt is None:
+            return {}
+        dynsym = self.elf.get_section(rela_plt['sh_link'])
+        first_stub = plt['sh_addr'] if plt_sec is not None else plt['sh_addr'] + self.PLT_ENTRY_SIZE
+
+        symbols = {}
+        for i, relocation in enumerate(rela_plt.iter_relocations()):
+            symbol = dynsym.get_symbol(relocation['r_info_sym'])
+            symbols[first_stub + i * self.PLT_ENTRY_SIZE] = symbol.name
+        return symbols
+
     def map_stack(self, emulator: EmulatorInterface):
         emulator.logger.log("Mapping stack with base 0x{self.stack_addr:x} and size 0x{self.stack_size:x}")
-        emulator.uc.mem_map(self.stack_addr, self.stack_size, UC_PROT_READ | UC_PROT_WRITE)
+        if self.demand_paging:
+            emulator.add_demand_region(self.stack_addr, self.stack_addr + self.stack_size, UC_PROT_READ | UC_PROT_WRITE)
+        else:
+            emulator.uc.mem_map(self.stack_addr, self.stack_size, UC_PROT_READ | UC_PROT_WRITE)
         emulator.uc.reg_write(UC_X86_REG_RSP, self.stack_addr + self.stack_size - 0x100)
\ No newline at end of file
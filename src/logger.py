@@ -1,20 +1,56 @@
 import os
 import datetime
+import threading
+import weakref
+from collections import deque
+
+# Log levels: messages below the logger's level are dropped
+TRACE = 5   # per instruction and per memory access details
+DEBUG = 10
+INFO = 20
+ERROR = 40
+
+# Log categories, combined into a bit mask of enabled categories
+CAT_GENERAL = 1 << 0  # emulation control: (re)starts, faults, ROI switches
+CAT_INSN = 1 << 1     # executed instructions, RSB
+CAT_MEM = 1 << 2      # memory accesses and the cache
+CAT_SPEC = 1 << 3     # speculation, checkpoints and rollbacks
+CAT_DEPS = 1 << 4     # pending loads and registers (out-of-order execution)
+CAT_TIMER = 1 << 5    # rdtscp
+CAT_ALL = (1 << 6) - 1
 
 class Logger:
-    def __init__(self, log_file, debug: bool = True, log_time: bool = False, max_size_bytes=10 * 1024 * 1024):
+    """
+    Writes log messages to a file, rotating to a new indexed file once it exceeds max_size_bytes.
+
+    The file stays open and messages are buffered: they're written in batches of buffer_size bytes, every
+    flush_interval seconds by a background thread (if set), and on flush()/close(). Use the logger as a context
+    manager or close() it to make sure everything is written.
+    """
+    def __init__(self, log_file, debug: bool = True, log_time: bool = False, max_size_bytes=10 * 1024 * 1024,
+                 level: int = TRACE, categories: int = CAT_ALL, buffer_size: int = 64 * 1024, flush_interval: float = None):
         self.debug = debug
         self.log_time = log_time
+        self.level = level
+        self.categories = categories if debug else 0  # nothing is enabled without debug
         self.base_log_file = log_file
         self.max_size = max_size_bytes
+        self.buffer_size = buffer_size
         
-        # Create directory if it doesn't exist
-        log_dir = os.path.dirname(self.base_log_file)
-        if log_dir and not os.path.exists(log_dir):
-            os.makedirs(log_dir)
-        
-        self.log_file = self._get_latest_log_file()
+        # the directory and file are only created on the first write
+        self.log_file: str = None
         self._initialized_files = set()
+
+        # open file state, the size is tracked in memory instead of stat'ing the file for every message
+        self._file = None
+        self._finalizer = None
+        self._size = 0
+        self._lock = threading.Lock()
+
+        # optional background flushing
+        self._flush_interval = flush_interval
+        self._flush_thread = None
+        self._stop_flushing = threading.Event()
     
     def _get_log_indexed_name(self, index: int) -> str:
         base, ext = os.path.splitext(self.base_log_file)
@@ -29,26 +65,131 @@ class Logger:
             if not os.path.exists(candidate) or os.path.getsize(candidate) < self.max_size:
                 return candidate
             index += 1
+
+    def _open(self):
+        if self.log_file is None:
+            # Create directory if it doesn't exist
+            log_dir = os.path.dirname(self.base_log_file)
+            if log_dir and not os.path.exists(log_dir):
+                os.makedirs(log_dir)
+            self.log_file = self._get_latest_log_file()
+
+        # Use 'w' mode for the first write to this specific file, then 'a' for subsequent writes
+        if self.log_file in self._initialized_files:
+            self._file = open(self.log_file, 'a', buffering=self.buffer_size, encoding='utf-8')
+            self._size = os.path.getsize(self.log_file)
+        else:
+            self._file = open(self.log_file, 'w', buffering=self.buffer_size, encoding='utf-8')
+            self._size = 0
+            self._initialized_files.add(self.log_file)
+        self._finalizer = weakref.finalize(self, self._file.close)  # flushes the buffer if close() is never called
+
+        if self._flush_interval is not None and self._flush_thread is None:
+            self._flush_thread = threading.Thread(target=self._flush_periodically, daemon=True)
+            self._flush_thread.start()
+
+    def _close_file(self):
+        if self._file is not None:
+            self._finalizer.detach()
+            self._file.close()
+            self._file = None
+
+    def _flush_periodically(self):
+        while not self._stop_flushing.wait(self._flush_interval):
+            self.flush()
     
-    def log(self, message):
+    def enabled(self, category: int = CAT_GENERAL, level: int = DEBUG) -> bool:
+        """
+        Cheap check callers can use before building expensive messages.
+        """
+        return bool(self.categories & category) and level >= self.level
+
+    def log(self, message, *args):
+        """
+        Logs a message. If args are given, the message is %-formatted with them, only when it is actually written.
+        """
         if not self.debug:
             return
+
+        if args:
+            message = message % args
         
         if self.log_time:
             timestamp = datetime.datetime.now().strftime("%H:%M:%S.%f")[:-3]
             message = f"[{timestamp}] {message}"
-        
-        # Check if we need to rotate to a new log file
-        if os.path.exists(self.log_file) and os.path.getsize(self.log_file) >= self.max_size:
-            self.log_file = self._get_latest_log_file()
-        
-        # Use 'w' mode for the first write to this specific file, then 'a' for subsequent writes
-        file_already_initialized = self.log_file in self._initialized_files
-        mode = 'a' if file_already_initialized else 'w'
-        
-        with open(self.log_file, mode) as f:
-            f.write(message + '\n')
-        
-        # Mark this file as initialized
-        if not file_already_initialized:
-            self._initialized_files.add(self.log_file)
\ No newline at end of file
+        line = message + '\n'
+
+        with self._lock:
+            # Check if we need to rotate to a new log file
+            if self._file is not None and self._size >= self.max_size:
+                self._close_file()
+                self.log_file = self._get_latest_log_file()
+
+            if self._file is None:
+                self._open()
+
+            self._file.write(line)
+            self._size += len(line) if line.isascii() else len(line.encode())  # bytes, as the file size
+
+    def flush(self):
+        """
+        Writes all buffered messages to the log file.
+        """
+        with self._lock:
+            if self._file is not None:
+                self._file.flush()
+
+    def close(self):
+        """
+        Flushes and closes the log file. Logging again afterwards appends to it.
+        """
+        if self._flush_thread is not None:
+            self._stop_flushing.set()
+            self._flush_thread.join()
+            self._flush_thread = None
+            self._stop_flushing.clear()
+        with self._lock:
+            self._close_file()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+class FlightRecorder:
+    """
+    Fixed-size ring buffer of the most recent log messages, kept in memory. Messages are stored together with their
+    arguments and only formatted by dump(), so recording is cheap enough for bulk runs that only need a trace on failure.
+    Like a Logger, it only records messages of its categories at or above its level, independent of the logger's.
+    """
+    def __init__(self, capacity: int = 10000, level: int = DEBUG, categories: int = CAT_ALL, path: str = None):
+        self.level = level
+        self.path = path  # default for dump()
+        self.categories = categories
+        self.events = deque(maxlen=capacity)
+        self.record = self.events.append  # takes a (message, args) tuple, args must not change until the dump
+
+    def enabled(self, category: int = CAT_GENERAL, level: int = DEBUG) -> bool:
+        return bool(self.categories & category) and level >= self.level
+
+    def __len__(self) -> int:
+        return len(self.events)
+
+    def clear(self):
+        self.events.clear()
+
+    def dump(self, path: str = None) -> str:
+        """
+        Writes the recorded messages to the given file (or the default path), oldest first, and returns the path.
+        """
+        if path is None:
+            path = self.path
+        log_dir = os.path.dirname(path)
+        if log_dir and not os.path.exists(log_dir):
+            os.makedirs(log_dir)
+
+        with open(path, 'w') as f:
+            for message, args in self.events:
+                f.write((message % args if args else message) + '\n')
+        return path
@@ -0,0 +1,41 @@
+from typing import Callable, Dict
+from unicorn.x86_const import UC_X86_REG_RAX, UC_X86_REG_RDI, UC_X86_REG_RSI, UC_X86_REG_RDX
+
+# Python implementations of dynamically linked functions, for the emulator's PLT intercepts (see
+# MuWMEmulator.install_plt_intercepts). A stub runs instead of the call instruction: it reads its arguments from the
+# System V argument registers and writes the return value to rax, the emulator skips the call afterwards.
+
+RAND_VALUE = 0x12345678  # rand() is deterministic, so emulations are reproducible
+
+PltStub = Callable[['MuWMEmulator'], None]
+
+def _map_on_demand(emulator, address: int, size: int):
+    # Python accesses don't pass the emulator's unmapped hook, demand-paged buffers are mapped here
+    if emulator.demand_regions and size:
+        emulator.map_on_demand(address, size)
+
+def rand(emulator):
+    emulator.uc.reg_write(UC_X86_REG_RAX, RAND_VALUE)
+
+def memset(emulator):
+    dest = emulator.uc.reg_read(UC_X86_REG_RDI)
+    value = emulator.uc.reg_read(UC_X86_REG_RSI)
+    count = emulator.uc.reg_read(UC_X86_REG_RDX)
+    _map_on_demand(emulator, dest, count)
+    emulator.uc.mem_write(dest, bytes([value & 0xFF]) * count)
+    emulator.uc.reg_write(UC_X86_REG_RAX, dest)
+
+def memcpy(emulator):
+    dest = emulator.uc.reg_read(UC_X86_REG_RDI)
+    src = emulator.uc.reg_read(UC_X86_REG_RSI)
+    count = emulator.uc.reg_read(UC_X86_REG_RDX)
+    _map_on_demand(emulator, src, count)
+    _map_on_demand(emulator, dest, count)
+    emulator.uc.mem_write(dest, bytes(emulator.uc.mem_read(src, count)))
+    emulator.uc.reg_write(UC_X86_REG_RAX, dest)
+
+LIBC_STUBS: Dict[str, PltStub] = {
+    "rand": rand,
+    "memset": memset,
+    "memcpy": memcpy,
+}
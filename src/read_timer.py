@@ -1,7 +1,7 @@
 from unicorn import *
 from unicorn.x86_const import *
 from typing import Protocol, runtime_checkable
-from logger import Logger
+from logger import Logger, CAT_TIMER
 
 @runtime_checkable
 class EmulatorInterface(Protocol):
@@ -12,18 +12,19 @@ class EmulatorInterface(Protocol):
     uc: Uc
     logger: Logger
 
+    def log(self, message: str, *args, category: int = ..., level: int = ...): ...
+
 class Timer():
     def __init__(self):
         self.reset()
     
     def rdtscp(self, emulator: EmulatorInterface):
+        emulator.log("\tRDTSC cycles: %d", self.cycles, category=CAT_TIMER)
         if self.active:
-            emulator.logger.log(f"\tRDTSC cycles: {self.cycles}")
             emulator.uc.reg_write(UC_X86_REG_RAX, self.cycles & 0xFFFFFFFF)
             emulator.uc.reg_write(UC_X86_REG_RDX, (self.cycles >> 32) & 0xFFFFFFFF)
             self.reset()
         else:
-            emulator.logger.log(f"\tRDTSC cycles: {self.cycles}")
             emulator.uc.reg_write(UC_X86_REG_RAX, 0)
             emulator.uc.reg_write(UC_X86_REG_RDX, 0)
             self.active = True
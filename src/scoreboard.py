@@ -0,0 +1,86 @@
+from typing import List, Set, Tuple
+from capstone.x86 import X86_REG_ENDING
+from helper import X86_REG_FAMILIES
+
+# Family index of every Capstone register id (Unicorn uses the same ids). Registers outside of X86_REG_FAMILIES
+# (flags, rip, vector registers, ...) form a family of their own.
+NUM_REGS = X86_REG_ENDING
+REG_FAMILY: List[int] = [-1] * NUM_REGS
+FAMILY_MEMBERS: List[Tuple[int, ...]] = []  # in the order helper.get_register_aliases returns them
+
+for regs in X86_REG_FAMILIES.values():
+    for reg in regs:
+        REG_FAMILY[reg] = len(FAMILY_MEMBERS)
+    FAMILY_MEMBERS.append(tuple(set(regs)))
+for reg in range(NUM_REGS):
+    if REG_FAMILY[reg] == -1:
+        REG_FAMILY[reg] = len(FAMILY_MEMBERS)
+        FAMILY_MEMBERS.append((reg,))
+
+class RegisterScoreboard():
+    """
+    Pending registers of the out-of-order model, with the amount of cycles until their value is available. A register
+    that isn't pending itself depends on the first register of its family that became pending (e.g. al for rax).
+    Lookups are indexed loads in per-register and per-family arrays.
+    """
+    def __init__(self):
+        self.cycles: List[int] = [0] * NUM_REGS
+        self.order: List[int] = [0] * NUM_REGS  # insertion number of each pending register, 0 if not pending
+        self.family_pending: List[List[int]] = [[] for _ in FAMILY_MEMBERS]  # pending registers per family, in insertion order
+        self.active_families: Set[int] = set()
+        self.next_order = 1
+
+    def __len__(self) -> int:
+        return sum(len(self.family_pending[family]) for family in self.active_families)
+
+    def __contains__(self, reg: int) -> bool:
+        return self.order[reg] != 0
+
+    def set(self, reg: int, cycles: int):
+        if not self.order[reg]:
+            self.order[reg] = self.next_order
+            self.next_order += 1
+            family = REG_FAMILY[reg]
+            self.family_pending[family].append(reg)
+            self.active_families.add(family)
+        self.cycles[reg] = cycles
+
+    def wait(self, reg: int) -> int:
+        """
+        Cycles until the value of the register is available, taking aliasing registers into account.
+        """
+        if self.order[reg]:
+            return self.cycles[reg]
+        pending = self.family_pending[REG_FAMILY[reg]]
+        return self.cycles[pending[0]] if pending else 0
+
+    def remove_family(self, reg: int) -> List[int]:
+        """
+        Removes the register and all its aliases, returns the removed registers.
+        """
+        family = REG_FAMILY[reg]
+        if not self.family_pending[family]:
+            return []
+        removed = [alias for alias in FAMILY_MEMBERS[family] if self.order[alias]]
+        for alias in removed:
+            self.order[alias] = 0
+            self.cycles[alias] = 0
+        self.family_pending[family].clear()
+        self.active_families.discard(family)
+        return removed
+
+    def clear(self):
+        for family in self.active_families:
+            for reg in self.family_pending[family]:
+                self.order[reg] = 0
+                self.cycles[reg] = 0
+            self.family_pending[family].clear()
+        self.active_families.clear()
+
+    def items(self) -> List[Tuple[int, int]]:
+        """
+        (register, cycles) of the pending registers, in the order they became pending.
+        """
+        regs = [reg for family in self.active_families for reg in self.family_pending[family]]
+        regs.sort(key=self.order.__getitem__)
+        return [(reg, self.cycles[reg]) for reg in regs]
@@ -0,0 +1,171 @@
+import mmap
+import os
+import json
+import struct
+from typing import Dict, List, Tuple
+from unicorn import x86_const
+from scoreboard import NUM_REGS
+
+# Emulator state files, for resuming long emulations (see MuWMEmulator.save_state and load_state). Layout:
+#   magic | u32 version | u64 header size | JSON header | padding up to PAGE_SIZE | pages
+# The header holds the mapped regions, the addresses of the stored pages, the registers and the Python-side state of the
+# emulator (cache, RSB, timer, checkpoints, store logs, pending loads and registers, ...). Only pages that aren't zero
+# are stored, in the order of their addresses, page-aligned so they can be memory-mapped straight from the file.
+# Registers (also those of checkpoints) are stored by name, so a state file doesn't depend on the Unicorn or Capstone
+# build that wrote it. Loading one never runs code from the file.
+
+STATE_MAGIC = b"WEMUSTAT"
+STATE_VERSION = 2
+PAGE_SIZE = 0x1000
+SCAN_CHUNK = 0x100000  # regions are scanned for non-zero pages in chunks of this size
+
+_HEADER_PREFIX = struct.Struct("<8sIQ")
+_ZERO_PAGE = bytes(PAGE_SIZE)
+_ZERO_CHUNK = bytes(SCAN_CHUNK)
+
+# registers saved for the CPU and every checkpoint, x87 and segment state isn't (the gates don't change it)
+REGISTERS = (
+    "rax", "rbx", "rcx", "rdx", "rsi", "rdi", "rbp", "rsp", "r8", "r9", "r10", "r11", "r12", "r13", "r14", "r15",
+    "rip", "eflags", "fs_base", "gs_base", "mxcsr", *(f"xmm{i}" for i in range(16)),
+)
+_REG_IDS = {name: getattr(x86_const, f"UC_X86_REG_{name.upper()}") for name in REGISTERS}
+
+# emulator attributes that are saved as they are, next to the ones encoded in _encode_state
+PLAIN_ATTRS = (
+    "code_exit_addr", "round_count", "in_speculation", "speculation_depth", "speculation_limit", "previous_context_addr",
+    "curr_insn_address", "next_insn_addr", "in_roi", "demand_pages",
+)
+
+def _align(offset: int) -> int:
+    return (offset + PAGE_SIZE - 1) & ~(PAGE_SIZE - 1)
+
+def _nonzero_pages(uc, begin: int, end: int):
+    """
+    Yields (address, data) of the pages in [begin, end) that aren't zero.
+    """
+    for chunk_addr in range(begin, end, SCAN_CHUNK):
+        chunk = bytes(uc.mem_read(chunk_addr, min(SCAN_CHUNK, end - chunk_addr)))
+        if chunk == _ZERO_CHUNK:
+            continue
+        for offset in range(0, len(chunk), PAGE_SIZE):
+            page = chunk[offset:offset + PAGE_SIZE]
+            if page != _ZERO_PAGE:
+                yield chunk_addr + offset, page
+
+def _read_registers(context) -> Dict[str, int]:
+    """Reads the saved registers from a Uc or a UcContext"""
+    return {name: context.reg_read(reg) for name, reg in _REG_IDS.items()}
+
+def _write_registers(context, registers: Dict[str, int]):
+    for name, value in registers.items():
+        context.reg_write(_REG_IDS[name], value)
+
+def _encode_data(data):
+    """Cache line data and journaled stores: bytes as hex, ints (values of write hooks) and None as they are"""
+    return data.hex() if isinstance(data, (bytes, bytearray)) else data
+
+def _decode_data(data):
+    return bytearray.fromhex(data) if isinstance(data, str) else data
+
+def _encode_state(emulator) -> dict:
+    cs = emulator.cs
+    state = {attr: getattr(emulator, attr) for attr in PLAIN_ATTRS}
+    state.update({
+        "cache": [[[tag, _encode_data(data)] for tag, data in ways.items()] for ways in emulator.cache.cache],
+        "rsb": {"stack": emulator.rsb.stack, "exception_addrs": sorted(emulator.rsb.exception_addrs)},
+        "timer": {"active": emulator.timer.active, "cycles": emulator.timer.cycles},
+        "previous_context": _read_registers(emulator.previous_context),
+        "pending_registers": [[cs.reg_name(reg), cycles] for reg, cycles in emulator.pending_registers.items()],
+        "pending_memory_loads": sorted(emulator.pending_memory_loads),
+        "checkpoints": [[_read_registers(context), next_insn_addr, flags]
+                        for context, next_insn_addr, flags in emulator.checkpoints],
+        "store_logs": [[[address, _encode_data(value)] for address, value in log] for log in emulator.store_logs],
+        "roi_accesses": list(emulator.roi_accesses),
+        "demand_chunks": sorted(emulator.demand_chunks),
+    })
+    return state
+
+def _decode_state(emulator, state: dict):
+    for attr in PLAIN_ATTRS:
+        setattr(emulator, attr, state[attr])
+
+    cache = emulator.cache
+    if len(state["cache"]) != len(cache.cache):
+        raise ValueError(f"State file has {len(state['cache'])} cache sets, the emulator's cache {len(cache.cache)}")
+    cache.cache = [{tag: _decode_data(data) for tag, data in ways} for ways in state["cache"]]
+    emulator.rsb.stack = list(state["rsb"]["stack"])
+    emulator.rsb.exception_addrs = set(state["rsb"]["exception_addrs"])
+    emulator.timer.active = state["timer"]["active"]
+    emulator.timer.cycles = state["timer"]["cycles"]
+
+    _write_registers(emulator.previous_context, state["previous_context"])
+    reg_ids = {emulator.cs.reg_name(reg): reg for reg in range(1, NUM_REGS)}
+    emulator.pending_registers.clear()
+    for name, cycles in state["pending_registers"]:
+        emulator.pending_registers.set(reg_ids[name], cycles)
+    emulator.pending_memory_loads = set(state["pending_memory_loads"])
+
+    emulator.checkpoints = []
+    for registers, next_insn_addr, flags in state["checkpoints"]:
+        context = emulator.uc.context_save()
+        _write_registers(context, registers)
+        emulator.checkpoints.append((context, next_insn_addr, flags))
+    emulator.store_logs = [[(address, bytes(_decode_data(value))) for address, value in log] for log in state["store_logs"]]
+    emulator.roi_accesses = dict.fromkeys(state["roi_accesses"])
+    emulator.demand_chunks = set(state["demand_chunks"])
+
+def save_state(emulator, path: str, extra: object = None):
+    """
+    Writes the emulator state to path. The file is written next to it first and then renamed, so an interrupted save
+    never leaves a truncated state behind.
+    """
+    uc = emulator.uc
+    regions: List[Tuple[int, int, int]] = [(begin, end + 1, perms) for begin, end, perms in uc.mem_regions()]
+
+    pages: List[Tuple[int, bytes]] = []
+    for begin, end, _ in regions:
+        pages.extend(_nonzero_pages(uc, begin, end))
+
+    header = {
+        "regions": regions,
+        "pages": [address for address, _ in pages],
+        "registers": _read_registers(uc),
+        "state": _encode_state(emulator),
+        "extra": extra,
+    }
+    header_bytes = json.dumps(header, separators=(",", ":")).encode()
+
+    tmp_path = path + ".tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(_HEADER_PREFIX.pack(STATE_MAGIC, STATE_VERSION, len(header_bytes)))
+        f.write(header_bytes)
+        f.seek(_align(_HEADER_PREFIX.size + len(header_bytes)))
+        for _, page in pages:
+            f.write(page)
+    os.replace(tmp_path, path)
+
+def load_state(emulator, path: str) -> object:
+    """
+    Restores the emulator state from path, replacing all of its memory mappings. The emulator has to be created for the
+    same binary (hooks, PLT intercepts and site maps aren't part of the state). Returns the extra object of save_state.
+    """
+    with open(path, 'rb') as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            magic, version, header_size = _HEADER_PREFIX.unpack_from(data, 0)
+            if magic != STATE_MAGIC or version != STATE_VERSION:
+                raise ValueError(f"Not a state file (version {STATE_VERSION}): {path}")
+            header = json.loads(data[_HEADER_PREFIX.size:_HEADER_PREFIX.size + header_size])
+            data_start = _align(_HEADER_PREFIX.size + header_size)
+
+            uc = emulator.uc
+            for begin, end, _ in list(uc.mem_regions()):
+                uc.mem_unmap(begin, end + 1 - begin)
+            for begin, end, perms in header["regions"]:
+                uc.mem_map(begin, end - begin, perms)
+            for i, address in enumerate(header["pages"]):
+                offset = data_start + i * PAGE_SIZE
+                uc.mem_write(address, data[offset:offset + PAGE_SIZE])
+
+    _write_registers(uc, header["registers"])
+    _decode_state(emulator, header["state"])
+    return header["extra"]
@@ -1,115 +1,63 @@
+from typing import Dict, Tuple
+import compiler
 from emulator import MuWMEmulator
+from emulator_pool import EmulatorPool
 from loader import AsmLoader
 from gates.asm import *
 from unicorn.x86_const import *
 
-def emulate_asm_assign(in1, debug=False):
-    code = get_asm_exception_assign(in1)
-    loader = AsmLoader(code)
-    emulator = MuWMEmulator(name='assign', loader=loader, debug=debug)
-
-    # Set input and output addresses of assign gate
-    input_address = emulator.data_start_addr
-    emulator.uc.reg_write(UC_X86_REG_R14, input_address)
-    output_address = emulator.data_start_addr + emulator.cache.line_size  # makes sure output goes in different cache set than input
-    emulator.uc.reg_write(UC_X86_REG_R15, output_address)
+asm_pool = EmulatorPool()  # assembled and loaded gates, reset between evaluations
+
+def _emulate_asm_gate(name: str, code: str, slots: Dict[int, int], in_regs: Tuple[int, ...], in_bits: Tuple[int, ...],
+                      out_reg: int, debug: bool) -> bool:
+    """
+    Runs an asm gate program (which doesn't depend on the inputs, so it's assembled once).
+    - slots: address registers of the gate, mapped to the cache line they point to in the data region
+    - in_regs: registers pointing to the inputs, the inputs that are 1 are primed in the cache
+    - out_reg: register pointing to the output
+    Returns whether the output was cached.
+    """
+    def load_gate() -> MuWMEmulator:
+        emulator = MuWMEmulator(name=name, loader=AsmLoader(code), debug=debug)
+        for reg, slot in slots.items():
+            emulator.uc.reg_write(reg, emulator.data_start_addr + slot * emulator.cache.line_size)
+        return emulator
+
+    # the default assembler backend is only read when a gate is assembled
+    emulator = asm_pool.get((name, debug, compiler.DEFAULT_BACKEND), load_gate)
+    emulator.logger.log(f"Starting emulation of {name.upper()}{tuple(in_bits)}...")
+
+    # Prime the cache for any input bits that are 1
+    for reg, bit in zip(in_regs, in_bits):
+        if bit:
+            emulator.cache.read(emulator.uc.reg_read(reg), emulator.uc)
 
     emulator.emulate()
 
-    emulator.logger.log(f"Output value: {emulator.cache.is_cached(output_address)}")
+    result = emulator.cache.is_cached(emulator.data_start_addr + slots[out_reg] * emulator.cache.line_size)
+    emulator.logger.log(f"Output value: {result}")
+    return result
 
-    return emulator.cache.is_cached(output_address)
+def emulate_asm_assign(in1, debug=False):
+    # output in a different cache set than the input
+    slots = {UC_X86_REG_R14: 0, UC_X86_REG_R15: 1}
+    return _emulate_asm_gate('assign', ASM_GATE_ASSIGN, slots, (UC_X86_REG_R14,), (in1,), UC_X86_REG_R15, debug)
 
 def emulate_asm_or(in1, in2, debug=False):
-    code = get_asm_exception_or(in1, in2)
-    loader = AsmLoader(code)
-    emulator = MuWMEmulator(name='or', loader=loader, debug=debug)
-
-    emulator.logger.log(f"Starting emulation of OR({in1}, {in2})...")
-
-    # Set input and output addresses of OR gate
-    input1_address = emulator.data_start_addr
-    emulator.uc.reg_write(UC_X86_REG_R13, input1_address)
-    input2_address = emulator.data_start_addr + emulator.cache.line_size
-    emulator.uc.reg_write(UC_X86_REG_R14, input2_address)
-    output_address = emulator.data_start_addr + 2 * emulator.cache.line_size
-    emulator.uc.reg_write(UC_X86_REG_R15, output_address)
-
-    emulator.emulate()
-
-    emulator.logger.log(f"Output value: {emulator.cache.is_cached(output_address)}")
-
-    return emulator.cache.is_cached(output_address)
+    slots = {UC_X86_REG_R13: 0, UC_X86_REG_R14: 1, UC_X86_REG_R15: 2}
+    return _emulate_asm_gate('or', ASM_GATE_OR, slots, (UC_X86_REG_R13, UC_X86_REG_R14), (in1, in2), UC_X86_REG_R15, debug)
 
 def emulate_asm_and(in1, in2, debug=False):
-    code = get_asm_exception_and(in1, in2)
-    loader = AsmLoader(code)
-    emulator = MuWMEmulator(name='and', loader=loader, debug=debug)
-
-    emulator.logger.log(f"Starting emulation of AND({in1}, {in2})...")
-
-    # Set input and output addresses of AND gate
-    input1_address = emulator.data_start_addr
-    emulator.uc.reg_write(UC_X86_REG_R13, input1_address)
-    input2_address = emulator.data_start_addr + emulator.cache.line_size
-    emulator.uc.reg_write(UC_X86_REG_R14, input2_address)
-    output_address = emulator.data_start_addr + 2 * emulator.cache.line_size
-    emulator.uc.reg_write(UC_X86_REG_R15, output_address)
-
-    emulator.emulate()
-
-    emulator.logger.log(f"Output value: {emulator.cache.is_cached(output_address)}")
-
-    return emulator.cache.is_cached(output_address)
+    slots = {UC_X86_REG_R13: 0, UC_X86_REG_R14: 1, UC_X86_REG_R15: 2}
+    return _emulate_asm_gate('and', ASM_GATE_AND, slots, (UC_X86_REG_R13, UC_X86_REG_R14), (in1, in2), UC_X86_REG_R15, debug)
 
 # Test Out[0] = (In1[0] ∧ In2[0]) ∨ In3[0]
 def emulate_asm_and_or(in1, in2, in3, debug=False):
-    code = get_asm_exception_and_or(in1, in2, in3)
-    loader = AsmLoader(code)
-    emulator = MuWMEmulator(name='and_or', loader=loader, debug=debug)
-
-    emulator.logger.log(f"Starting emulation of AND-OR({in1}, {in2}, {in3})...")
-
-    # Set input and output addresses
-    input1_address = emulator.data_start_addr
-    emulator.uc.reg_write(UC_X86_REG_R13, input1_address)
-    
-    input2_address = emulator.data_start_addr + emulator.cache.line_size
-    emulator.uc.reg_write(UC_X86_REG_R14, input2_address)
-    
-    input3_address = emulator.data_start_addr + 2 * emulator.cache.line_size
-    emulator.uc.reg_write(UC_X86_REG_R12, input3_address)
-    
-    output_address = emulator.data_start_addr + 3 * emulator.cache.line_size
-    emulator.uc.reg_write(UC_X86_REG_R15, output_address)
-
-    emulator.emulate()
-
-    result = emulator.cache.is_cached(output_address)
-    emulator.logger.log(f"Output value: {result}")
-
-    return result
+    slots = {UC_X86_REG_R13: 0, UC_X86_REG_R14: 1, UC_X86_REG_R12: 2, UC_X86_REG_R15: 3}
+    return _emulate_asm_gate('and_or', ASM_GATE_AND_OR, slots, (UC_X86_REG_R13, UC_X86_REG_R14, UC_X86_REG_R12),
+                             (in1, in2, in3), UC_X86_REG_R15, debug)
 
 def emulate_asm_not(in1, debug=False):
-    code = get_asm_exception_not(in1)
-    loader = AsmLoader(code)
-    emulator = MuWMEmulator(name='not', loader=loader, debug=debug)
-
-    emulator.logger.log(f"Starting emulation of NOT({in1})...")
-
-    # Set input and output addresses
-    input1_address = emulator.data_start_addr
-    emulator.uc.reg_write(UC_X86_REG_R13, input1_address)
-    
-    input2_address = emulator.data_start_addr + emulator.cache.line_size
-    emulator.uc.reg_write(UC_X86_REG_R14, input2_address)
-
-    output_address = emulator.data_start_addr + 3 * emulator.cache.line_size
-    emulator.uc.reg_write(UC_X86_REG_R15, output_address)
-
-    emulator.emulate()
-
-    result = emulator.cache.is_cached(output_address)
-    emulator.logger.log(f"Output value: {result}")
-
-    return result
\ No newline at end of file
+    # r14 points to a flushed auxiliary variable that delays the output
+    slots = {UC_X86_REG_R13: 0, UC_X86_REG_R14: 1, UC_X86_REG_R15: 3}
+    return _emulate_asm_gate('not', ASM_GATE_NOT, slots, (UC_X86_REG_R13,), (in1,), UC_X86_REG_R15, debug)
@@ -2,13 +2,17 @@ import struct
 from typing import Tuple, Dict
 from cache import LRUCache
 from emulator import MuWMEmulator
+from emulator_pool import EmulatorPool
 from loader import ELFLoader
+from plt_stubs import LIBC_STUBS
+from trace_filter import TraceFilter
 from unicorn import UC_HOOK_CODE, UC_PROT_ALL, UC_PROT_READ, UC_PROT_WRITE
 from unicorn.x86_const import *
 import time
 import struct
 from random import randint
 from tests.ref import *
+from tests import gate_modes
 
 # -------------------------------------------------------------------
 # Generic helpers
@@ -21,39 +25,24 @@ IN2_ADDR_ARB    = 0x2000_1000
 OUT_ADDR_ARB    = 0x2000_2000
 ERR_ADDR_ARB    = 0x2000_3000
 
+flexo_pool = EmulatorPool()  # loaded gates and adders, reset between evaluations
+
 def _ensure_memory(emulator: MuWMEmulator, addr: int, size: int = PAGE_SIZE, init_zero: bool = True):
     """
     Ensure that `addr` is mapped in the emulator's address space.
     Optionally initialize it to zero if `init_zero` is True.
     """
-    try:
-        emulator.uc.mem_read(addr, 1)
-    except:
+    if not emulator.is_mapped(addr) and not emulator.map_on_demand(addr, size):
         emulator.logger.log(f"Mapping memory at {addr:#x}")
         emulator.uc.mem_map(addr, size, UC_PROT_ALL)
     if init_zero:
         emulator.uc.mem_write(addr, b'\x00' * size)
 
-def _hook_rand_once(emulator: MuWMEmulator, rand_addr: int):
-    """
-    Install a hook that intercepts a single call to rand@plt at `rand_addr`
-    and forces RAX to a fixed value, then skips the call instruction.
-    """
-    def _hook(uc, address, size, user_data):
-        if address == rand_addr:
-            uc.reg_write(UC_X86_REG_RAX, 0x12345678)
-            emulator.skip_curr_insn()
-            return True
-        return False
-
-    emulator.uc.hook_add(UC_HOOK_CODE, _hook, None, rand_addr, rand_addr + 1)
-
 def _emulate_boolean_gate(
     name: str,
     elf_path: str,
     start_addr: int,
     end_addr: int,
-    rand_addr: int,
     regs_setup: Dict[int, int],
     debug: bool = False
 ) -> int:
@@ -62,21 +51,18 @@ def _emulate_boolean_gate(
     - name: name to label the emulator instance
     - elf_path: path to the gate's ELF file
     - start_addr, end_addr: code boundaries for emulation
-    - rand_addr: address of the rand@plt call to hook
     - regs_setup: mapping from unicorn register constants to their values
     Returns the single-byte result read from OUT_ADDR_BOOL.
     """
-    # Create loader and emulator
-    loader = ELFLoader(elf_path)
-    emulator = MuWMEmulator(name=name, loader=loader, debug=debug)
-    emulator.code_start_address = start_addr
-    emulator.code_exit_addr = end_addr
+    def load_gate() -> MuWMEmulator:
+        emulator = gate_modes.build_gate(name, elf_path, start_addr, end_addr, debug, plt_stubs=LIBC_STUBS)
 
-    # Ensure output memory is mapped and zeroed
-    _ensure_memory(emulator, OUT_ADDR_BOOL)
+        # Ensure output memory is mapped and zeroed
+        _ensure_memory(emulator, OUT_ADDR_BOOL)
+        return emulator
 
-    # Hook rand@plt to be deterministic
-    _hook_rand_once(emulator, rand_addr)
+    # Load the gate, or reset the previously loaded one
+    emulator = flexo_pool.get((name, debug, gate_modes.mode), load_gate)
 
     # Write inputs/register values
     for reg, val in regs_setup.items():
@@ -96,7 +82,6 @@ def emulate_flexo_and(in1: int, in2: int, debug: bool = False) -> int:
         elf_path="gates/flexo/gates/gate_and.elf",
         start_addr=0x11e0,
         end_addr=0x13fb,
-        rand_addr=0x11f9,
         regs_setup={
             UC_X86_REG_RDI: in1 & 0x1,
             UC_X86_REG_RSI: in2 & 0x1,
@@ -112,7 +97,6 @@ def emulate_flexo_or(in1: int, in2: int, debug: bool = False) -> int:
         elf_path="gates/flexo/gates/gate_or.elf",
         start_addr=0x1400,
         end_addr=0x161b,
-        rand_addr=0x1419,
         regs_setup={
             UC_X86_REG_RDI: in1 & 0x1,
             UC_X86_REG_RSI: in2 & 0x1,
@@ -128,7 +112,6 @@ def emulate_flexo_not(in1: int, debug: bool = False) -> int:
         elf_path="gates/flexo/gates/gate_not.elf",
         start_addr=0x1620,
         end_addr=0x17d5,
-        rand_addr=0x1632,
         regs_setup={
             UC_X86_REG_RDI: in1 & 0x1,
             UC_X86_REG_RSI: OUT_ADDR_BOOL,
@@ -143,7 +126,6 @@ def emulate_flexo_nand(in1: int, in2: int, debug: bool = False) -> int:
         elf_path="gates/flexo/gates/gate_nand.elf",
         start_addr=0x17e0,
         end_addr=0x19fb,
-        rand_addr=0x17f9,
         regs_setup={
             UC_X86_REG_RDI: in1 & 0x1,
             UC_X86_REG_RSI: in2 & 0x1,
@@ -159,7 +141,6 @@ def emulate_flexo_xor(in1: int, in2: int, debug: bool = False) -> int:
         elf_path="gates/flexo/gates/gate_xor.elf",
         start_addr=0x1a00,
         end_addr=0x1c1b,
-        rand_addr=0x1a19,
         regs_setup={
             UC_X86_REG_RDI: in1 & 0x1,
             UC_X86_REG_RSI: in2 & 0x1,
@@ -175,7 +156,6 @@ def emulate_flexo_xor3(in1: int, in2: int, in3: int, debug: bool = False) -> int
         elf_path="gates/flexo/gates/gate_xor3.elf",
         start_addr=0x1ed0,
         end_addr=0x2172,
-        rand_addr=0x1ef2,
         regs_setup={
             UC_X86_REG_RDI: in1 & 0x1,
             UC_X86_REG_RSI: in2 & 0x1,
@@ -192,7 +172,6 @@ def emulate_flexo_xor4(in1: int, in2: int, in3: int, in4: int, debug: bool = Fal
         elf_path="gates/flexo/gates/gate_xor4.elf",
         start_addr=0x2180,
         end_addr=0x24b3,
-        rand_addr=0x21ab,
         regs_setup={
             UC_X86_REG_RDI: in1 & 0x1,
             UC_X86_REG_RSI: in2 & 0x1,
@@ -210,7 +189,6 @@ def emulate_flexo_mux(in1: int, in2: int, sel: int, debug: bool = False) -> int:
         elf_path="gates/flexo/gates/gate_mux.elf",
         start_addr=0x1c20,
         end_addr=0x1ec2,
-        rand_addr=0x1c42,
         regs_setup={
             UC_X86_REG_RDI: in1 & 0x1,
             UC_X86_REG_RSI: in2 & 0x1,
@@ -226,7 +204,6 @@ def _emulate_adder(
     elf_path: str,
     start_addr: int,
     end_addr: int,
-    rand_addr: int,
     a: int,
     b: int,
     byte_width: int,
@@ -237,21 +214,22 @@ def _emulate_adder(
     - name: emulator name
     - elf_path: path to the adder ELF
     - start_addr, end_addr: code boundaries for emulation
-    - rand_addr: address of the rand@plt call to hook
     - a, b: integer operands
     - byte_width: how many bytes to write/read for the result
     Returns a tuple (sum, error_flag), where `sum` is the integer result (low `byte_width` bytes),
     and `error_flag` is a single byte read from the error-output region.
     """
     # Addresses for code and data (shared for all adders)
-    loader = ELFLoader(elf_path)
-    emulator = MuWMEmulator(name=name, loader=loader, debug=debug)
-    emulator.code_start_address = start_addr
-    emulator.code_exit_addr = end_addr
+    def load_adder() -> MuWMEmulator:
+        emulator = gate_modes.build_gate(name, elf_path, start_addr, end_addr, debug, plt_stubs=LIBC_STUBS)
+
+        # Ensure memory regions for inputs, outputs, and error flags
+        for addr in (IN1_ADDR_ARB, IN2_ADDR_ARB, OUT_ADDR_ARB, ERR_ADDR_ARB):
+            _ensure_memory(emulator, addr, size=PAGE_SIZE, init_zero=False)
+        return emulator
 
-    # Ensure memory regions for inputs, outputs, and error flags
-    for addr in (IN1_ADDR_ARB, IN2_ADDR_ARB, OUT_ADDR_ARB, ERR_ADDR_ARB):
-        _ensure_memory(emulator, addr, size=PAGE_SIZE, init_zero=False)
+    # Load the adder, or reset the previously loaded one
+    emulator = flexo_pool.get((name, debug, gate_modes.mode), load_adder)
 
     # Prepare input buffers: only low `byte_width` bytes carry the value
     in1_bytes = (a & ((1 << (8 * byte_width)) - 1)).to_bytes(byte_width, 'little') + b'\x00' * (8 - byte_width)
@@ -261,9 +239,6 @@ def _emulate_adder(
     emulator.uc.mem_write(OUT_ADDR_ARB,     b'\x00' * 8)
     emulator.uc.mem_write(ERR_ADDR_ARB,     b'\x00' * 8)
 
-    # Hook rand@plt for determinism
-    _hook_rand_once(emulator, rand_addr)
-
     # Set up registers (RDI, RSI, RDX, RCX) to point to memory buffers
     emulator.uc.reg_write(UC_X86_REG_RDI, IN1_ADDR_ARB)
     emulator.uc.reg_write(UC_X86_REG_RSI, IN2_ADDR_ARB)
@@ -285,7 +260,6 @@ def emulate_flexo_adder8(a: int, b: int, debug: bool = False) -> Tuple[int, int]
         elf_path="gates/flexo/arithmetic/adder.elf",
         start_addr=0x1270,
         end_addr=0x362e,
-        rand_addr=0x12a0,
         a=a,
         b=b,
         byte_width=1,
@@ -299,7 +273,6 @@ def emulate_flexo_adder16(a: int, b: int, debug: bool = False) -> Tuple[int, int
         elf_path="gates/flexo/arithmetic/adder.elf",
         start_addr=0x3630,
         end_addr=0x94da,
-        rand_addr=0x3660,
         a=a,
         b=b,
         byte_width=2,
@@ -311,43 +284,39 @@ def emulate_flexo_adder32(a: int, b: int, debug: bool = False) -> Tuple[int, int
     # The 32-bit adder uses a slightly different memory mapping (unmapping then mapping)
     ADDER_START_ADDR = 0x94e0
     ADDER_END_ADDR   = 0x16bd1
-    RAND_CALL_ADDR   = 0x9510
 
     loader = ELFLoader("gates/flexo/arithmetic/adder.elf")
-    emulator = MuWMEmulator(name="flexo-adder32", loader=loader, debug=debug)
-    emulator.code_start_address = ADDER_START_ADDR
-    emulator.code_exit_addr = ADDER_END_ADDR
-
-    # For 32-bit, explicitly unmap then remap to set correct protections
-    for addr in (IN1_ADDR_ARB, IN2_ADDR_ARB, OUT_ADDR_ARB, ERR_ADDR_ARB):
-        try:
-            emulator.uc.mem_unmap(addr, PAGE_SIZE)
-        except:
-            pass
-        emulator.uc.mem_map(addr, PAGE_SIZE, UC_PROT_READ | UC_PROT_WRITE)
-
-    # Write inputs (4-byte values, low 4 bytes)
-    in1 = (a & 0xFFFFFFFF).to_bytes(4, 'little') + b'\x00' * 4
-    in2 = (b & 0xFFFFFFFF).to_bytes(4, 'little') + b'\x00' * 4
-    emulator.uc.mem_write(IN1_ADDR_ARB, in1)
-    emulator.uc.mem_write(IN2_ADDR_ARB, in2)
-    emulator.uc.mem_write(OUT_ADDR_ARB,  b'\x00' * 8)
-    emulator.uc.mem_write(ERR_ADDR_ARB,  b'\x00' * 8)
-
-    # Hook rand
-    _hook_rand_once(emulator, RAND_CALL_ADDR)
-
-    # Set up registers
-    emulator.uc.reg_write(UC_X86_REG_RDI, IN1_ADDR_ARB)
-    emulator.uc.reg_write(UC_X86_REG_RSI, IN2_ADDR_ARB)
-    emulator.uc.reg_write(UC_X86_REG_RDX, OUT_ADDR_ARB)
-    emulator.uc.reg_write(UC_X86_REG_RCX, ERR_ADDR_ARB)
+    with MuWMEmulator(name="flexo-adder32", loader=loader, debug=debug, plt_stubs=LIBC_STUBS) as emulator:
+        emulator.code_start_address = ADDER_START_ADDR
+        emulator.code_exit_addr = ADDER_END_ADDR
 
-    emulator.emulate()
+        # For 32-bit, explicitly unmap then remap to set correct protections
+        for addr in (IN1_ADDR_ARB, IN2_ADDR_ARB, OUT_ADDR_ARB, ERR_ADDR_ARB):
+            try:
+                emulator.uc.mem_unmap(addr, PAGE_SIZE)
+            except:
+                pass
+            emulator.uc.mem_map(addr, PAGE_SIZE, UC_PROT_READ | UC_PROT_WRITE)
 
-    result = int.from_bytes(emulator.uc.mem_read(OUT_ADDR_ARB, 4), 'little')
-    error_flag = emulator.uc.mem_read(ERR_ADDR_ARB, 1)[0]
-    return result, error_flag
+        # Write inputs (4-byte values, low 4 bytes)
+        in1 = (a & 0xFFFFFFFF).to_bytes(4, 'little') + b'\x00' * 4
+        in2 = (b & 0xFFFFFFFF).to_bytes(4, 'little') + b'\x00' * 4
+        emulator.uc.mem_write(IN1_ADDR_ARB, in1)
+        emulator.uc.mem_write(IN2_ADDR_ARB, in2)
+        emulator.uc.mem_write(OUT_ADDR_ARB,  b'\x00' * 8)
+        emulator.uc.mem_write(ERR_ADDR_ARB,  b'\x00' * 8)
+
+        # Set up registers
+        emulator.uc.reg_write(UC_X86_REG_RDI, IN1_ADDR_ARB)
+        emulator.uc.reg_write(UC_X86_REG_RSI, IN2_ADDR_ARB)
+        emulator.uc.reg_write(UC_X86_REG_RDX, OUT_ADDR_ARB)
+        emulator.uc.reg_write(UC_X86_REG_RCX, ERR_ADDR_ARB)
+
+        emulator.emulate()
+
+        result = int.from_bytes(emulator.uc.mem_read(OUT_ADDR_ARB, 4), 'little')
+        error_flag = emulator.uc.mem_read(ERR_ADDR_ARB, 1)[0]
+        return result, error_flag
 
 
 # -------------------------------------------------------------------
@@ -365,41 +334,33 @@ def emulate_flexo_sha1_round(state_in, w_in, debug=False):
     SHA1_RET_ADDR    = 0x28e73
 
     loader   = ELFLoader("gates/flexo/sha1/sha1_round.elf")
-    emulator = MuWMEmulator(name='flexo-sha1', loader=loader, debug=debug)
-    emulator.code_start_address = WEIRD_SHA1_ADDR
-    emulator.code_exit_addr      = SHA1_RET_ADDR
-
-    # Map memory for inputs/outputs
-    emulator.uc.mem_map(INPUT_ADDR, PAGE_SIZE_LOCAL)
-    emulator.uc.mem_map(OUTPUT_ADDR, PAGE_SIZE_LOCAL)
-    emulator.uc.mem_map(ERROR_OUTPUT_ADDR, PAGE_SIZE_LOCAL)
-
-    # Write input state (5 × uint32) at INPUT_ADDR
-    emulator.uc.mem_write(INPUT_ADDR, struct.pack("<5I", *state_in))
-
-    # Set up registers: rdi=input, rsi=w, rdx=output, rcx=error_output
-    emulator.uc.reg_write(UC_X86_REG_RDI, INPUT_ADDR)
-    emulator.uc.reg_write(UC_X86_REG_RSI, w_in)
-    emulator.uc.reg_write(UC_X86_REG_RDX, OUTPUT_ADDR)
-    emulator.uc.reg_write(UC_X86_REG_RCX, ERROR_OUTPUT_ADDR)
-
-    # Hook rand@plt
-    emulator.rsb.add_exception_addr(RAND_CALL_ADDR)
-    def hook_rand_call(uc, address, size, user_data):
-        if address == RAND_CALL_ADDR:
-            uc.reg_write(UC_X86_REG_RAX, 0x12345678)
-            emulator.skip_curr_insn()
-            return True
-        return False
-    emulator.uc.hook_add(UC_HOOK_CODE, hook_rand_call, None, WEIRD_SHA1_ADDR, SHA1_RET_ADDR)
+    with MuWMEmulator(name='flexo-sha1', loader=loader, debug=debug, plt_stubs=LIBC_STUBS) as emulator:
+        emulator.code_start_address = WEIRD_SHA1_ADDR
+        emulator.code_exit_addr      = SHA1_RET_ADDR
 
-    emulator.emulate()
+        # Map memory for inputs/outputs
+        emulator.uc.mem_map(INPUT_ADDR, PAGE_SIZE_LOCAL)
+        emulator.uc.mem_map(OUTPUT_ADDR, PAGE_SIZE_LOCAL)
+        emulator.uc.mem_map(ERROR_OUTPUT_ADDR, PAGE_SIZE_LOCAL)
+
+        # Write input state (5 × uint32) at INPUT_ADDR
+        emulator.uc.mem_write(INPUT_ADDR, struct.pack("<5I", *state_in))
+
+        # Set up registers: rdi=input, rsi=w, rdx=output, rcx=error_output
+        emulator.uc.reg_write(UC_X86_REG_RDI, INPUT_ADDR)
+        emulator.uc.reg_write(UC_X86_REG_RSI, w_in)
+        emulator.uc.reg_write(UC_X86_REG_RDX, OUTPUT_ADDR)
+        emulator.uc.reg_write(UC_X86_REG_RCX, ERROR_OUTPUT_ADDR)
 
-    # Read 5 × uint32 from OUTPUT_ADDR and ERROR_OUTPUT_ADDR
-    result = list(struct.unpack("<5I", emulator.uc.mem_read(OUTPUT_ADDR, 20)))
-    err_out= list(struct.unpack("<5I", emulator.uc.mem_read(ERROR_OUTPUT_ADDR, 20)))
+        emulator.rsb.add_exception_addr(RAND_CALL_ADDR)
 
-    return result, err_out
+        emulator.emulate()
+
+        # Read 5 × uint32 from OUTPUT_ADDR and ERROR_OUTPUT_ADDR
+        result = list(struct.unpack("<5I", emulator.uc.mem_read(OUTPUT_ADDR, 20)))
+        err_out= list(struct.unpack("<5I", emulator.uc.mem_read(ERROR_OUTPUT_ADDR, 20)))
+
+        return result, err_out
 
 
 def emulate_flexo_aes_round(input_block, key_block, debug=False):
@@ -414,37 +375,30 @@ def emulate_flexo_aes_round(input_block, key_block, debug=False):
     AES_RET_ADDR      = 0xb4f44
 
     loader   = ELFLoader("gates/flexo/aes/aes_round-16.elf")
-    emulator = MuWMEmulator(name='flexo-aes', loader=loader, debug=debug)
-    emulator.code_start_address = WEIRD_AES_ADDR
-    emulator.code_exit_addr      = AES_RET_ADDR
-
-    emulator.uc.mem_map(INPUT_ADDR,        PAGE_SIZE_LOCAL)
-    emulator.uc.mem_map(KEY_ADDR,          PAGE_SIZE_LOCAL)
-    emulator.uc.mem_map(OUTPUT_ADDR,       PAGE_SIZE_LOCAL)
-    emulator.uc.mem_map(ERROR_OUTPUT_ADDR, PAGE_SIZE_LOCAL)
-
-    emulator.uc.mem_write(INPUT_ADDR,  bytes(input_block))
-    emulator.uc.mem_write(KEY_ADDR,    bytes(key_block))
-
-    emulator.uc.reg_write(UC_X86_REG_RDI, INPUT_ADDR)
-    emulator.uc.reg_write(UC_X86_REG_RSI, KEY_ADDR)
-    emulator.uc.reg_write(UC_X86_REG_RDX, OUTPUT_ADDR)
-    emulator.uc.reg_write(UC_X86_REG_RCX, ERROR_OUTPUT_ADDR)
-
-    emulator.rsb.add_exception_addr(RAND_CALL_ADDR)
-    def hook_rand_call(uc, address, size, user_data):
-        if address == RAND_CALL_ADDR:
-            uc.reg_write(UC_X86_REG_RAX, 0x12345678)
-            emulator.skip_curr_insn()
-            return True
-        return False
-    emulator.uc.hook_add(UC_HOOK_CODE, hook_rand_call, None, WEIRD_AES_ADDR, AES_RET_ADDR)
+    with MuWMEmulator(name='flexo-aes', loader=loader, debug=debug, plt_stubs=LIBC_STUBS) as emulator:
+        emulator.code_start_address = WEIRD_AES_ADDR
+        emulator.code_exit_addr      = AES_RET_ADDR
 
-    emulator.emulate()
+        emulator.uc.mem_map(INPUT_ADDR,        PAGE_SIZE_LOCAL)
+        emulator.uc.mem_map(KEY_ADDR,          PAGE_SIZE_LOCAL)
+        emulator.uc.mem_map(OUTPUT_ADDR,       PAGE_SIZE_LOCAL)
+        emulator.uc.mem_map(ERROR_OUTPUT_ADDR, PAGE_SIZE_LOCAL)
+
+        emulator.uc.mem_write(INPUT_ADDR,  bytes(input_block))
+        emulator.uc.mem_write(KEY_ADDR,    bytes(key_block))
+
+        emulator.uc.reg_write(UC_X86_REG_RDI, INPUT_ADDR)
+        emulator.uc.reg_write(UC_X86_REG_RSI, KEY_ADDR)
+        emulator.uc.reg_write(UC_X86_REG_RDX, OUTPUT_ADDR)
+        emulator.uc.reg_write(UC_X86_REG_RCX, ERROR_OUTPUT_ADDR)
 
-    result = list(emulator.uc.mem_read(OUTPUT_ADDR, 16))
-    err_out= list(emulator.uc.mem_read(ERROR_OUTPUT_ADDR, 16))
-    return result, err_out
+        emulator.rsb.add_exception_addr(RAND_CALL_ADDR)
+
+        emulator.emulate()
+
+        result = list(emulator.uc.mem_read(OUTPUT_ADDR, 16))
+        err_out= list(emulator.uc.mem_read(ERROR_OUTPUT_ADDR, 16))
+        return result, err_out
 
 
 def emulate_flexo_simon32(input_block, key_block, debug=False):
@@ -459,49 +413,53 @@ def emulate_flexo_simon32(input_block, key_block, debug=False):
     SIMON_RET_ADDR    = 0x116246
 
     loader   = ELFLoader("gates/flexo/simon/simon32-14.elf")
-    emulator = MuWMEmulator(name='flexo-simon32', loader=loader, debug=debug)
-    emulator.code_start_address = WEIRD_SIMON_ADDR
-    emulator.code_exit_addr      = SIMON_RET_ADDR
-
-    emulator.uc.mem_map(INPUT_ADDR,        PAGE_SIZE_LOCAL)
-    emulator.uc.mem_map(KEY_ADDR,          PAGE_SIZE_LOCAL)
-    emulator.uc.mem_map(OUTPUT_ADDR,       PAGE_SIZE_LOCAL)
-    emulator.uc.mem_map(ERROR_OUTPUT_ADDR, PAGE_SIZE_LOCAL)
-
-    emulator.uc.mem_write(INPUT_ADDR,  bytes(input_block))
-    emulator.uc.mem_write(KEY_ADDR,    bytes(key_block))
-
-    emulator.uc.reg_write(UC_X86_REG_RDI, INPUT_ADDR)
-    emulator.uc.reg_write(UC_X86_REG_RSI, KEY_ADDR)
-    emulator.uc.reg_write(UC_X86_REG_RDX, OUTPUT_ADDR)
-    emulator.uc.reg_write(UC_X86_REG_RCX, ERROR_OUTPUT_ADDR)
-
-    emulator.rsb.add_exception_addr(RAND_CALL_ADDR)
-    def hook_rand_call(uc, address, size, user_data):
-        if address == RAND_CALL_ADDR:
-            uc.reg_write(UC_X86_REG_RAX, 0x12345678)
-            emulator.skip_curr_insn()
-            return True
-        return False
-    emulator.uc.hook_add(UC_HOOK_CODE, hook_rand_call, None, WEIRD_SIMON_ADDR, SIMON_RET_ADDR)
+    with MuWMEmulator(name='flexo-simon32', loader=loader, debug=debug, plt_stubs=LIBC_STUBS) as emulator:
+        emulator.code_start_address = WEIRD_SIMON_ADDR
+        emulator.code_exit_addr      = SIMON_RET_ADDR
 
-    emulator.emulate()
+        emulator.uc.mem_map(INPUT_ADDR,        PAGE_SIZE_LOCAL)
+        emulator.uc.mem_map(KEY_ADDR,          PAGE_SIZE_LOCAL)
+        emulator.uc.mem_map(OUTPUT_ADDR,       PAGE_SIZE_LOCAL)
+        emulator.uc.mem_map(ERROR_OUTPUT_ADDR, PAGE_SIZE_LOCAL)
+
+        emulator.uc.mem_write(INPUT_ADDR,  bytes(input_block))
+        emulator.uc.mem_write(KEY_ADDR,    bytes(key_block))
+
+        emulator.uc.reg_write(UC_X86_REG_RDI, INPUT_ADDR)
+        emulator.uc.reg_write(UC_X86_REG_RSI, KEY_ADDR)
+        emulator.uc.reg_write(UC_X86_REG_RDX, OUTPUT_ADDR)
+        emulator.uc.reg_write(UC_X86_REG_RCX, ERROR_OUTPUT_ADDR)
 
-    result = list(emulator.uc.mem_read(OUTPUT_ADDR, 4))
-    err_out= list(emulator.uc.mem_read(ERROR_OUTPUT_ADDR, 4))
-    return result, err_out
+        emulator.rsb.add_exception_addr(RAND_CALL_ADDR)
 
+        emulator.emulate()
 
-def emulate_flexo_sha1_2blocks(block1, block2, debug=False):
+        result = list(emulator.uc.mem_read(OUTPUT_ADDR, 4))
+        err_out= list(emulator.uc.mem_read(ERROR_OUTPUT_ADDR, 4))
+        return result, err_out
+
+
+def emulate_flexo_sha1_2blocks(block1, block2, debug=False, fast_forward=False, trace_path=None, state_path=None, resume=False):
+    """
+    Emulates SHA-1 over two blocks. With state_path, the emulator state is saved there at every round boundary, and
+    resume=True continues from the saved state instead of starting over.
+    """
     INPUT_ADDR   = 0x200000
     STATES_ADDR  = 0x201000
     PAGE_SIZE_LOCAL = 0x1000
 
     SHA1_BLOCK_ADDR      = 0xa2820
     SHA1_BLOCK_RET_ADDR  = 0xa2cdf
+    WEIRD_ROUNDS_RANGE   = (0x1560, 0xa2820)  # __weird__sha1_round1 up to __weird__sha1_round4
+    ROUND_RET_ADDRS      = [0xa29bd, 0xa2a8f, 0xa2b5c, 0xa2c0f]
 
     loader   = ELFLoader("gates/flexo/sha1/sha1_2blocks-6.elf")
-    emulator = MuWMEmulator(name='flexo-sha1-2blocks', loader=loader, debug=debug)
+    emulator = MuWMEmulator(name='flexo-sha1-2blocks', loader=loader, debug=debug, trace_path=trace_path,
+                            trace_filter=TraceFilter(symbols=["sha1_block"]), plt_stubs=LIBC_STUBS)
+
+    # Only model the weird rounds, the sha1_block glue runs architecturally
+    if fast_forward:
+        emulator.set_roi([WEIRD_ROUNDS_RANGE], exit_addrs=ROUND_RET_ADDRS)
 
     # Allocate memory for both blocks + state
     emulator.uc.mem_map(INPUT_ADDR, PAGE_SIZE_LOCAL * 3)
@@ -510,11 +468,14 @@ def emulate_flexo_sha1_2blocks(block1, block2, debug=False):
     initial_state = [0x67452301, 0xEFCDAB89, 0x98BADCFE, 0x10325476, 0xC3D2E1F0]
     emulator.uc.mem_write(STATES_ADDR, struct.pack("<5I", *initial_state))
 
-    # Hooks for round debugging and handling PLT calls (rand, memset, memcpy)
+    # Hooks for round debugging (PLT calls to rand, memset and memcpy are intercepted by the emulator)
     emulator.round_count = [0]
+    block = [1]  # block being processed, saved with the state
 
     def hook_round_debug(uc, address, size, user_data):
         if address in [0x1560, 0x28e90, 0x50820, 0x7a560]:
+            if state_path is not None:
+                emulator.save_state(state_path, extra=block[0])  # resuming runs this hook again
             emulator.persist_pending_loads()
             emulator.cache.reset()
             emulator.in_speculation = False
@@ -530,6 +491,7 @@ def emulate_flexo_sha1_2blocks(block1, block2, debug=False):
                 emulator.logger.log(f"Round {emulator.round_count[0]} input: {[hex(x) for x in input_state]}")
             except:
                 pass
+            emulator.mark_round(emulator.round_count[0])
             emulator.round_count[0] += 1
         return False
 
@@ -539,71 +501,52 @@ def emulate_flexo_sha1_2blocks(block1, block2, debug=False):
             print(f"SHA1_BLOCK COMPLETE - State: {[hex(x) for x in state]}")
         return False
 
-    def hook_dyn_calls(uc, address, size, user_data):
-        # rand calls inside weird SHA-1
-        if address in [0x158f, 0x28ebf, 0x5084f, 0x7a58f]:
-            uc.reg_write(UC_X86_REG_RAX, 0x12345678)
-            emulator.skip_curr_insn()
-            return True
-        # memset@plt
-        if address == 0xa284f:
-            rdi = uc.reg_read(UC_X86_REG_RDI)
-            rsi = uc.reg_read(UC_X86_REG_RSI)
-            rdx = uc.reg_read(UC_X86_REG_RDX)
-            data = bytes([rsi & 0xFF] * int(rdx))
-            uc.mem_write(rdi, data)
-            emulator.skip_curr_insn()
-            return True
-        # memcpy@plt
-        if address == 0xa2869:
-            rdi = int(uc.reg_read(UC_X86_REG_RDI))
-            rsi = int(uc.reg_read(UC_X86_REG_RSI))
-            rdx = int(uc.reg_read(UC_X86_REG_RDX))
-            try:
-                chunk = bytes(uc.mem_read(rsi, rdx))
-                uc.mem_write(rdi, chunk)
-                if rdx >= 16:
-                    words = struct.unpack("<4I", chunk[:16])
-                    print(f"First 4 words copied: {[hex(w) for w in words]}")
-            except Exception as e:
-                print(f"ERROR in memcpy: {e}")
-            emulator.skip_curr_insn()
-            return True
-        return False
-
-    emulator.uc.hook_add(UC_HOOK_CODE, hook_dyn_calls, None, 0x1560, 0xa3530)
     emulator.uc.hook_add(UC_HOOK_CODE, hook_round_debug, None, 0x1560, 0xa3530)
     emulator.uc.hook_add(UC_HOOK_CODE, hook_after_sha1_block, None, SHA1_BLOCK_RET_ADDR - 8, SHA1_BLOCK_RET_ADDR + 1)
 
-    # Process first 512-bit block
-    print("=== PROCESSING FIRST BLOCK ===")
-    print(f"Initial SHA-1 state: {[hex(x) for x in initial_state]}")
-    emulator.uc.mem_write(INPUT_ADDR, struct.pack("<16I", *block1))
-    emulator.code_start_address = SHA1_BLOCK_ADDR
-    emulator.code_exit_addr      = SHA1_BLOCK_RET_ADDR
-    emulator.uc.reg_write(UC_X86_REG_RDI, INPUT_ADDR)
-    emulator.uc.reg_write(UC_X86_REG_RSI, STATES_ADDR)
-    emulator.uc.reg_write(UC_X86_REG_RDX, 0)  # do_ref = false
-    emulator.emulate()
+    # Resume from a saved round boundary (memory, registers and emulator state)
+    if resume:
+        block[0] = emulator.load_state(state_path)
+        print(f"=== RESUMING BLOCK {block[0]} AT ROUND {emulator.round_count[0]} ===")
 
-    intermediate_state = list(struct.unpack("<5I", emulator.uc.mem_read(STATES_ADDR, 20)))
-    print(f"Intermediate state: {[hex(x) for x in intermediate_state]}")
+    # Process first 512-bit block
+    if block[0] == 1:
+        if not resume:
+            print("=== PROCESSING FIRST BLOCK ===")
+            print(f"Initial SHA-1 state: {[hex(x) for x in initial_state]}")
+            emulator.uc.mem_write(INPUT_ADDR, struct.pack("<16I", *block1))
+            emulator.code_start_address = SHA1_BLOCK_ADDR
+            emulator.code_exit_addr      = SHA1_BLOCK_RET_ADDR
+            emulator.uc.reg_write(UC_X86_REG_RDI, INPUT_ADDR)
+            emulator.uc.reg_write(UC_X86_REG_RSI, STATES_ADDR)
+            emulator.uc.reg_write(UC_X86_REG_RDX, 0)  # do_ref = false
+        emulator.emulate()
+
+        intermediate_state = list(struct.unpack("<5I", emulator.uc.mem_read(STATES_ADDR, 20)))
+        print(f"Intermediate state: {[hex(x) for x in intermediate_state]}")
 
     # Process second 512-bit block
-    print("\n=== PROCESSING SECOND BLOCK ===")
-    emulator.round_count[0] = 0
-    emulator.uc.mem_write(INPUT_ADDR, struct.pack("<16I", *block2))
-    emulator.uc.reg_write(UC_X86_REG_RDI, INPUT_ADDR)
-    emulator.uc.reg_write(UC_X86_REG_RSI, STATES_ADDR)
-    emulator.uc.reg_write(UC_X86_REG_RDX, 0)
-    emulator.uc.reg_write(UC_X86_REG_RIP, SHA1_BLOCK_ADDR)
-    emulator.in_speculation    = False
-    emulator.speculation_depth = 0
-    emulator.checkpoints       = []
-    emulator.store_logs        = []
+    if not (resume and block[0] == 2):
+        block[0] = 2
+        print("\n=== PROCESSING SECOND BLOCK ===")
+        emulator.round_count[0] = 0
+        emulator.uc.mem_write(INPUT_ADDR, struct.pack("<16I", *block2))
+        emulator.uc.reg_write(UC_X86_REG_RDI, INPUT_ADDR)
+        emulator.uc.reg_write(UC_X86_REG_RSI, STATES_ADDR)
+        emulator.uc.reg_write(UC_X86_REG_RDX, 0)
+        emulator.uc.reg_write(UC_X86_REG_RIP, SHA1_BLOCK_ADDR)
+        emulator.code_start_address = SHA1_BLOCK_ADDR
+        emulator.in_speculation    = False
+        emulator.speculation_depth = 0
+        emulator.checkpoints       = []
+        emulator.store_logs        = []
     emulator.emulate()
 
     final_state = list(struct.unpack("<5I", emulator.uc.mem_read(STATES_ADDR, 20)))
     print(f"Final state: {[hex(x) for x in final_state]}")
 
+    # index the trace for random-access queries (see trace_index.py)
+    emulator.close_trace(index=True)
+    emulator.close()
+
     return final_state
@@ -0,0 +1,53 @@
+from cache import InfiniteCache
+from emulator import MuWMEmulator, CHECKPOINT_SNAPSHOT, MEM_ALWAYS_HIT, MEM_IGNORE
+from loader import ELFImage, ELFLoader
+from typing import List, Tuple
+
+# -------------------------------------------------------------------
+# Opt-in emulator modes the pooled gate tests can run under. None of them may change a gate's output (see the
+# test_mode_* tests in unit_tests.py).
+# -------------------------------------------------------------------
+
+MODE_SPARSE_HOOKS = "sparse_hooks"  # code hooks only at special instruction sites
+MODE_ROI = "roi"  # the gate's code is the region of interest, entered when emulation starts
+MODE_DATA_HIT = "data_hit"  # memory hooks scoped to the gate's data and stack, other accesses (e.g. the I/O pages) hit
+MODE_DATA_IGNORE = "data_ignore"  # as above, but the other accesses aren't modeled at all
+MODE_SNAPSHOT = "snapshot"  # checkpoints are copy-on-write memory snapshots (the pool rebuilds these gates every time)
+MODE_DEMAND_PAGING = "demand_paging"  # stack and data mapped on first access, the cache keeps line data (rebuilt as well)
+
+mode: str = None  # mode of the gates built from now on, part of their pool keys
+
+def set_mode(new_mode: str):
+    global mode
+    mode = new_mode
+
+def data_ranges(loader: ELFLoader) -> List[Tuple[int, int]]:
+    """
+    The [start, end) ranges of a gate's writable segments and its stack, where its weird registers are.
+    """
+    ranges = [(loader.stack_addr, loader.stack_addr + loader.stack_size)]
+    for header, _ in ELFImage.get(loader.elf_path).segments:
+        if header.p_flags & 0x2:  # PF_W
+            ranges.append((header.p_vaddr & ~0xFFF, (header.p_vaddr + header.p_memsz + 0xFFF) & ~0xFFF))
+    return sorted(ranges)
+
+def build_gate(name: str, elf_path: str, start_addr: int, end_addr: int, debug: bool, **kwargs) -> MuWMEmulator:
+    """
+    Loads a gate binary in the current mode, to be emulated from start_addr to end_addr. kwargs go to MuWMEmulator.
+    """
+    loader = ELFLoader(elf_path, demand_paging=mode == MODE_DEMAND_PAGING)
+    if mode == MODE_DEMAND_PAGING:
+        kwargs["cache"] = InfiniteCache()  # cache misses read the line from memory, mapping it
+    elif not debug:
+        kwargs.setdefault("cache", InfiniteCache(tag_only=True))  # bulk evaluations don't need the line data
+    if mode in (MODE_DATA_HIT, MODE_DATA_IGNORE):
+        kwargs["mem_ranges"] = data_ranges(loader)
+        kwargs["unmodeled_policy"] = MEM_ALWAYS_HIT if mode == MODE_DATA_HIT else MEM_IGNORE
+    if mode == MODE_SNAPSHOT:
+        kwargs["checkpoint_backend"] = CHECKPOINT_SNAPSHOT
+    emulator = MuWMEmulator(name=name, loader=loader, debug=debug, sparse_hooks=mode == MODE_SPARSE_HOOKS, **kwargs)
+    emulator.code_start_address = start_addr
+    emulator.code_exit_addr = end_addr
+    if mode == MODE_ROI:
+        emulator.set_roi([(start_addr, end_addr)])
+    return emulator
@@ -1,5 +1,6 @@
 from emulator import MuWMEmulator
-from loader import ELFLoader
+from emulator_pool import EmulatorPool
+from tests import gate_modes
 from unicorn import UC_HOOK_CODE
 from unicorn.x86_const import UC_X86_REG_RDI
 
@@ -7,6 +8,8 @@ from unicorn.x86_const import UC_X86_REG_RDI
 # Generic helper for DRY emulation of GitM‐based gates
 # -------------------------------------------------------------------
 
+gitm_pool = EmulatorPool()  # loaded gates, reset between evaluations
+
 def _emulate_gitm_gate(
     name: str,
     elf_path: str,
@@ -27,14 +30,16 @@ def _emulate_gitm_gate(
     - out_addrs: tuple of memory addresses from which to read cached output bits
     Returns a tuple of booleans indicating whether each out_addr was cached.
     """
-    loader = ELFLoader(elf_path)
-    emulator = MuWMEmulator(name=name, loader=loader, debug=debug)
-    emulator.code_start_address = start_addr
-    emulator.code_exit_addr = end_addr
+    def load_gate() -> MuWMEmulator:
+        return gate_modes.build_gate(name, elf_path, start_addr, end_addr, debug)
+
+    emulator = gitm_pool.get((name, debug, gate_modes.mode), load_gate)
 
     # Prime the cache for any input bits that are 1
     for addr, bit in zip(in_addrs, in_bits):
         if bit:
+            if emulator.demand_regions:
+                emulator.map_on_demand(addr, emulator.cache.line_size)  # reads from Python don't pass unmapped_hook
             emulator.cache.read(addr, emulator.uc)
 
     # Combine all input bits into a single integer parameter, LSB = in_bits[0], etc.
@@ -1,8 +1,12 @@
 from tests.flexo_tests import *
 from tests.gitm_tests import *
 from tests.ref import ref_sha1_round
+import os
 import time
 from random import randint
+from emulator import MuWMEmulator, CHECKPOINT_JOURNAL, CHECKPOINT_SNAPSHOT
+
+MuWMEmulator.flight_recorder_size = 10000  # dumped for the first wrong result
 
 def time_gate_bulk(
     gate_fn, 
@@ -21,6 +25,8 @@ def time_gate_bulk(
         input_bits: Number of input bits to extract from seed
         expected_fn: Function to compute expected result (for validation)
     """
+    first_error = [True]
+
     def gate_fn_with_error_codes(seed: int) -> int:
         """
         Gate function that returns error codes like the hardware:
@@ -40,6 +46,9 @@ def time_gate_bulk(
             if result == expected:
                 return 0  # Correct
             else:
+                if first_error[0]:  # only keep the trace of the first wrong result
+                    first_error[0] = False
+                    print(f"Wrong result for inputs {inputs}, flight recorder: {MuWMEmulator.dump_last_flight_recorder()}")
                 return 1  # Undetected error
         else:
             return 0  # Assume correct if no validation
@@ -162,6 +171,69 @@ def time_flexo_sha1_round_average(num_iterations: int = 100) -> None:
     print(f"Average execution time per round: {avg_time:.9f} s")
     print(f"Average time per round (nanoseconds): {avg_time * 1_000_000_000:.2f} ns")
 
+def time_checkpoint_backends(num_iterations: int = 10) -> None:
+    """
+    Compares the checkpoint backends (see MuWMEmulator.checkpoint_backend) on gates with many rollbacks.
+    """
+    benchmarks = [
+        ("Flexo AND", lambda: emulate_flexo_and(randint(0, 1), randint(0, 1), debug=False)),
+        ("Flexo XOR4", lambda: emulate_flexo_xor4(*[randint(0, 1) for _ in range(4)], debug=False)),
+        ("Flexo adder8", lambda: emulate_flexo_adder8(randint(0, 0xFF), randint(0, 0xFF), debug=False)),
+        ("Flexo SHA1 round", lambda: emulate_flexo_sha1_round([randint(0, 0xFFFFFFFF) for _ in range(5)], randint(0, 0xFFFFFFFF), debug=False)),
+    ]
+    default_backend = MuWMEmulator.checkpoint_backend
+
+    print(f"\n=== Checkpoint Backends ({num_iterations} iterations) ===")
+    try:
+        for name, run in benchmarks:
+            for backend in (CHECKPOINT_JOURNAL, CHECKPOINT_SNAPSHOT):
+                MuWMEmulator.checkpoint_backend = backend
+                start_time = time.perf_counter_ns()
+                for _ in range(num_iterations):
+                    flexo_pool.clear()  # snapshot emulators aren't pooled, so both backends load the gate every run
+                    run()
+                avg_s = (time.perf_counter_ns() - start_time) / 1_000_000_000 / num_iterations
+                print(f"{name:<18} {backend:<10} {avg_s:.6f} s per run")
+    finally:
+        MuWMEmulator.checkpoint_backend = default_backend
+        flexo_pool.clear()
+
+def _rss_kib() -> int:
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") // 1024
+
+def _fd_count() -> int:
+    return len(os.listdir("/proc/self/fd"))
+
+def check_resource_leaks(num_evaluations: int = 100000, fresh_every: int = 10, max_rss_growth_kib: int = 16 * 1024,
+                         num_samples: int = 10) -> bool:
+    """
+    Evaluates Flexo AND gates and checks that RSS and the number of open file descriptors stay flat (Linux only), and
+    that the Unicorn engines of closed emulators are released.
+    Every fresh_every evaluations the gate pool is cleared, so loading and closing emulators is covered as well.
+    The first sample is taken after a warm-up of 1% of the evaluations.
+    """
+    print(f"\n=== Resource Leaks ({num_evaluations} evaluations) ===")
+    warmup = max(num_evaluations // 100, fresh_every)
+    samples = []
+    flexo_pool.clear()
+    live_engines = MuWMEmulator.live_engines
+    for i in range(num_evaluations):
+        if i % fresh_every == 0:
+            flexo_pool.clear()
+        emulate_flexo_and(i & 1, (i >> 1) & 1, debug=False)
+        if i + 1 == warmup or (i + 1 - warmup) % max((num_evaluations - warmup) // num_samples, 1) == 0:
+            samples.append((i + 1, _rss_kib(), _fd_count()))
+            print(f"{i + 1:>8} evaluations: RSS {samples[-1][1]} KiB, {samples[-1][2]} fds")
+    flexo_pool.clear()
+
+    rss_growth = samples[-1][1] - samples[0][1]
+    fd_growth = samples[-1][2] - samples[0][2]
+    passed = rss_growth <= max_rss_growth_kib and fd_growth <= 0 and MuWMEmulator.live_engines == live_engines
+    print(f"RSS growth: {rss_growth} KiB, fd growth: {fd_growth}, "
+          f"unreleased engines: {MuWMEmulator.live_engines - live_engines}: {'passed' if passed else 'FAILED'}")
+    return passed
+
 if __name__ == "__main__":
     # Bulk timing tests
     # print("=== Bulk Timing Tests ===")
@@ -176,4 +248,5 @@ if __name__ == "__main__":
     # print("=== SHA1 Round Timing Tests ===")
     # time_flexo_sha1_round_average(num_iterations=10)
 
-    time_flexo_and(tot_trials=1000)
\ No newline at end of file
+    with flexo_pool, gitm_pool:
+        time_flexo_and(tot_trials=1000)
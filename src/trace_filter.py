@@ -0,0 +1,65 @@
+from typing import Callable, Iterable, List, Optional, Tuple
+
+class TraceFilter():
+    """
+    Declarative selection of what MuWMEmulator.log() writes. Each given criterion must hold for a message to be logged,
+    a criterion holds if any of its values matches:
+    - address_ranges: [start, end) ranges containing the current instruction
+    - symbols: ELF symbols (functions) containing the current instruction
+    - speculative_only: only log during speculation
+    - mnemonics: mnemonics of the current instruction
+    - mem_ranges: [start, end) ranges containing the memory address accessed by the current instruction
+    - rounds: values of the emulator's round_count
+    The filter is compiled into a predicate once the code is loaded (see compile()).
+    """
+    def __init__(self, address_ranges: Iterable[Tuple[int, int]] = (), symbols: Iterable[str] = (),
+                 speculative_only: bool = False, mnemonics: Iterable[str] = (), mem_ranges: Iterable[Tuple[int, int]] = (),
+                 rounds: Iterable[int] = ()):
+        self.address_ranges = list(address_ranges)
+        self.symbols = list(symbols)
+        self.speculative_only = speculative_only
+        self.mnemonics = set(mnemonics)
+        self.mem_ranges = list(mem_ranges)
+        self.rounds = set(rounds)
+
+    def compile(self, symbol_resolver: Callable[[str], Optional[Tuple[int, int]]]) -> Optional[Callable[[object], bool]]:
+        """
+        Compiles the filter into a predicate on the emulator, resolving symbols to address ranges with symbol_resolver.
+        Returns None if the filter selects everything.
+        """
+        address_ranges = list(self.address_ranges)
+        for symbol in self.symbols:
+            symbol_range = symbol_resolver(symbol)
+            if symbol_range is None:
+                raise ValueError(f"Unknown symbol in trace filter: {symbol}")
+            address_ranges.append(symbol_range)
+
+        mnemonics = frozenset(self.mnemonics)
+        rounds = frozenset(self.rounds)
+        mem_ranges = sorted(self.mem_ranges)
+        address_ranges.sort()
+        predicates: List[Callable[[object], bool]] = []
+        if address_ranges:
+            predicates.append(lambda em: _in_ranges(em.curr_insn_address, address_ranges))
+        if self.speculative_only:
+            predicates.append(lambda em: em.in_speculation)
+        if mnemonics:
+            predicates.append(lambda em: getattr(em, 'curr_insn', None) is not None and em.curr_insn.mnemonic in mnemonics)
+        if mem_ranges:
+            # the last access must belong to the current instruction
+            predicates.append(lambda em: em.curr_mem_insn_address == em.curr_insn_address
+                              and _in_ranges(em.curr_mem_address, mem_ranges))
+        if rounds:
+            predicates.append(lambda em: em.round_count is not None and em.round_count[0] in rounds)
+
+        if not predicates:
+            return None
+        if len(predicates) == 1:
+            return predicates[0]
+        return lambda em: all(predicate(em) for predicate in predicates)
+
+def _in_ranges(value: int, ranges: List[Tuple[int, int]]) -> bool:
+    for start, end in ranges:
+        if start <= value < end:
+            return True
+    return False
@@ -0,0 +1,231 @@
+import json
+import os
+from bisect import bisect_right
+from typing import Dict, Iterator, List, NamedTuple, Tuple
+from bintrace import *
+
+# Sparse random-access index of a binary execution trace (see bintrace.py). The trace is cut into blocks of
+# BLOCK_EVENTS events, and the decoder state at the start of each block is stored as a sync point. Lookups by
+# instruction count bisect the sync points, all other lookups go through tables of the blocks they concern, so a query
+# only decodes the blocks it needs. The index is stored next to the trace, as <trace>.idx.
+
+BLOCK_EVENTS = 4096
+LINE_SIZE = 64  # granularity of the address table
+
+class IndexedEvent(NamedTuple):
+    insn_count: int  # amount of instructions executed before this event
+    round: int       # index of the last round marker (-1 before the first one)
+    window: int      # innermost open speculation window (-1 outside of speculation), the closed one for rollbacks
+    event: TraceEvent
+
+class SyncPoint(NamedTuple):
+    offset: int
+    insn_count: int
+    prev_insn_addr: int
+    prev_mem_addr: int
+    round: int
+    windows: Tuple[int, ...]  # stack of open speculation windows
+    next_window: int
+
+class TraceIndex():
+    """
+    Random-access queries on a binary execution trace. The index is built (and saved) on first use.
+
+    Speculation windows are numbered in the order of their checkpoints. Rounds are identified by their marker index,
+    because drivers may restart counting (e.g. for every SHA-1 block): find_rounds() maps a round value to its markers.
+    """
+    def __init__(self, trace_path: str):
+        self.trace_path = trace_path
+        with open(trace_path, 'rb') as f:
+            self.data = f.read()
+
+        self.sync: List[SyncPoint] = []
+        self.insn_counts: List[int] = []                       # instruction count at each sync point
+        self.round_values: List[int] = []                      # round value of each marker
+        self.round_blocks: List[int] = []                      # block of each marker
+        self.window_blocks: List[int] = []                     # block of the checkpoint of each speculation window
+        self.rollback_blocks: Dict[int, List[Tuple[int, int]]] = {}  # round marker -> (window, block) per rollback
+        self.line_blocks: Dict[int, List[int]] = {}            # cache line -> blocks accessing it
+        self.code: Dict[int, bytes] = {}                       # instruction bytes by address
+
+        if self.is_up_to_date():
+            self.load()
+        else:
+            self.build()
+            self.save()
+
+    @property
+    def index_path(self) -> str:
+        return self.trace_path + ".idx"
+
+    def is_up_to_date(self) -> bool:
+        return os.path.exists(self.index_path) and os.path.getmtime(self.index_path) >= os.path.getmtime(self.trace_path)
+
+    # -------------------------------------------------------------------
+    # Decoding
+    # -------------------------------------------------------------------
+
+    def _decode(self, sync: SyncPoint, add_sync_points: bool = False) -> Iterator[IndexedEvent]:
+        """
+        Decodes the trace starting at a sync point, keeping track of the instruction count, round and windows.
+        """
+        reader = TraceReader(self.data, (sync.prev_insn_addr, sync.prev_mem_addr), self.code)
+        insn_count = sync.insn_count
+        round_marker = sync.round
+        windows = list(sync.windows)
+        next_window = sync.next_window
+
+        count = 0
+        for _, event in reader.events(sync.offset):
+            event_type = event[0]
+            window = windows[-1] if windows else -1
+            if event_type == EV_INSN:
+                insn_count += 1
+            elif event_type == EV_CHECKPOINT:
+                window = next_window
+                windows.append(next_window)
+                next_window += 1
+            elif event_type == EV_ROLLBACK:
+                if windows:
+                    windows.pop()
+            elif event_type == EV_ROUND:
+                round_marker += 1
+            yield IndexedEvent(insn_count - (event_type == EV_INSN), round_marker, window, event)
+
+            count += 1
+            if add_sync_points and count % BLOCK_EVENTS == 0:
+                self.sync.append(SyncPoint(reader.offset, insn_count, reader.prev[STREAM_INSN], reader.prev[STREAM_MEM],
+                                           round_marker, tuple(windows), next_window))
+                self.insn_counts.append(insn_count)
+
+    def _decode_block(self, block: int) -> Iterator[IndexedEvent]:
+        """
+        Decodes a single block.
+        """
+        for count, indexed in enumerate(self._decode(self.sync[block])):
+            if count == BLOCK_EVENTS:
+                return
+            yield indexed
+
+    def build(self):
+        """
+        Indexes the whole trace in a single pass.
+        """
+        self.sync.append(SyncPoint(len(TRACE_MAGIC), 0, 0, 0, -1, (), 0))
+        self.insn_counts.append(0)
+        for count, (_, round_marker, window, event) in enumerate(self._decode(self.sync[0], add_sync_points=True)):
+            event_type = event[0]
+            block = count // BLOCK_EVENTS
+            if event_type in (EV_MEM_READ_HIT, EV_MEM_READ_MISS, EV_MEM_WRITE):
+                for line in range(event[1] // LINE_SIZE, (event[1] + event[2] - 1) // LINE_SIZE + 1):
+                    blocks = self.line_blocks.setdefault(line, [])
+                    if not blocks or blocks[-1] != block:
+                        blocks.append(block)
+            elif event_type == EV_CHECKPOINT:
+                self.window_blocks.append(block)
+            elif event_type == EV_ROLLBACK:
+                self.rollback_blocks.setdefault(round_marker, []).append((window, block))
+            elif event_type == EV_ROUND:
+                self.round_values.append(event[3])
+                self.round_blocks.append(block)
+
+    def save(self):
+        index = {
+            "sync": self.sync,
+            "round_values": self.round_values,
+            "round_blocks": self.round_blocks,
+            "window_blocks": self.window_blocks,
+            "rollback_blocks": {str(marker): rollbacks for marker, rollbacks in self.rollback_blocks.items()},
+            "line_blocks": {str(line): blocks for line, blocks in self.line_blocks.items()},
+            "code": {str(address): insn_bytes.hex() for address, insn_bytes in self.code.items()},
+        }
+        with open(self.index_path, 'w') as f:
+            json.dump(index, f)
+
+    def load(self):
+        with open(self.index_path) as f:
+            index = json.load(f)
+        self.sync = [SyncPoint(*sync[:5], tuple(sync[5]), sync[6]) for sync in index["sync"]]
+        self.insn_counts = [sync.insn_count for sync in self.sync]
+        self.round_values = index["round_values"]
+        self.round_blocks = index["round_blocks"]
+        self.window_blocks = index["window_blocks"]
+        self.rollback_blocks = {int(marker): [tuple(r) for r in rollbacks] for marker, rollbacks in index["rollback_blocks"].items()}
+        self.line_blocks = {int(line): blocks for line, blocks in index["line_blocks"].items()}
+        self.code = {int(address): bytes.fromhex(insn_bytes) for address, insn_bytes in index["code"].items()}
+
+    # -------------------------------------------------------------------
+    # Queries
+    # -------------------------------------------------------------------
+
+    def events(self) -> Iterator[IndexedEvent]:
+        return self._decode(self.sync[0])
+
+    def seek_insn(self, insn_count: int) -> Iterator[IndexedEvent]:
+        """
+        Events starting at the instruction with the given (0-based) instruction count.
+        """
+        block = bisect_right(self.insn_counts, insn_count) - 1
+        started = False
+        for indexed in self._decode(self.sync[block]):
+            if not started:
+                if indexed.event[0] != EV_INSN or indexed.insn_count != insn_count:
+                    continue
+                started = True
+            yield indexed
+
+    def find_rounds(self, round_value: int) -> List[int]:
+        """
+        Markers of all rounds with the given value.
+        """
+        return [marker for marker, value in enumerate(self.round_values) if value == round_value]
+
+    def round(self, marker: int) -> Iterator[IndexedEvent]:
+        """
+        Events of a round, from its marker up to the next one.
+        """
+        for indexed in self._decode(self.sync[self.round_blocks[marker]]):
+            if indexed.round > marker:
+                return
+            if indexed.round == marker:
+                yield indexed
+
+    def rollback(self, marker: int, n: int) -> IndexedEvent:
+        """
+        The n-th (0-based) rollback in a round.
+        """
+        window, block = self.rollback_blocks.get(marker, [])[n]
+        for indexed in self._decode(self.sync[block]):
+            if indexed.event[0] == EV_ROLLBACK and indexed.window == window:
+                return indexed
+
+    def window(self, window: int) -> Iterator[IndexedEvent]:
+        """
+        Events of a speculation window, from its checkpoint up to its rollback (including nested windows).
+        """
+        inside = False
+        for indexed in self._decode(self.sync[self.window_blocks[window]]):
+            event_type = indexed.event[0]
+            if not inside:
+                if event_type == EV_CHECKPOINT and indexed.window == window:
+                    inside = True
+                else:
+                    continue
+            yield indexed
+            if event_type == EV_ROLLBACK and indexed.window == window:
+                return
+
+    def accesses(self, address: int, speculative_only: bool = False) -> Iterator[IndexedEvent]:
+        """
+        Memory reads and writes overlapping the given address, optionally only those during speculation.
+        """
+        for block in self.line_blocks.get(address // LINE_SIZE, []):
+            for indexed in self._decode_block(block):
+                event_type, event_address, size = indexed.event[:3]
+                if event_type not in (EV_MEM_READ_HIT, EV_MEM_READ_MISS, EV_MEM_WRITE):
+                    continue
+                if not event_address <= address < event_address + size:
+                    continue
+                if speculative_only and indexed.window < 0:
+                    continue
+                yield indexed
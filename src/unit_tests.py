@@ -1,44 +1,108 @@
+import os
 import sys
+import shutil
 import struct
+from types import SimpleNamespace
 import itertools
 import random
-from emulator import MuWMEmulator
+import compiler
+from bintrace import TraceWriter, read_trace, EV_INSN, EV_MEM_READ_HIT, EV_MEM_READ_MISS, EV_MEM_WRITE, EV_CHECKPOINT, \
+    EV_ROLLBACK, EV_SPEC_WINDOW_EXCEEDED, EV_CACHE_FLUSH, EV_ROUND
+from cache import LRUCache, InfiniteCache
+from scoreboard import RegisterScoreboard
+from trace_filter import TraceFilter
+from trace_index import TraceIndex, BLOCK_EVENTS
+from decoder import DecodedInsn, DecodeCache
+from decode_trace import format_event
+from capstone import Cs, CS_ARCH_X86, CS_MODE_64
+from emulator import MuWMEmulator, DEMAND_CHUNK_SHIFT
+from unicorn import Uc, UC_ARCH_X86, UC_MODE_64, UC_HOOK_CODE, UC_PROT_READ, UC_PROT_WRITE
 from loader import *
 from gates.asm import *
+from typing import List
 from unicorn.x86_const import *
 
 # Import tests
 from tests.asm_tests import *
 from tests.flexo_tests import *
+from tests.flexo_tests import _ensure_memory
 from tests.gitm_tests import *
+from tests import gate_modes
 
 # Import reference implementations
 from tests.ref import *
 
+MuWMEmulator.flight_recorder_size = 10000  # dumped when a result is wrong
+
 ##########################################
 # ASM tests
 ##########################################
 
+def assembler_installed(test_name: str) -> bool:
+    """
+    The ASM tests need an assembler, they are skipped without one rather than passing on leftover cached machine code.
+    """
+    if compiler.installed_backends():
+        return True
+    print(f"Test skipped for {test_name}: the ASM gates need nasm (with objcopy) or keystone-engine to assemble")
+    return False
+
 def test_asm_assign() -> bool:
+    if not assembler_installed('ASSIGN'):
+        return True
     verifier = lambda a: a
     return run_gate_test('ASSIGN', emulate_asm_assign, verifier, 1)
 
 def test_asm_and() -> bool:
+    if not assembler_installed('AND'):
+        return True
     verifier = lambda a, b: a and b
     return run_gate_test('AND', emulate_asm_and, verifier, 2)
 
 def test_asm_or() -> bool:
+    if not assembler_installed('OR'):
+        return True
     verifier = lambda a, b: a or b
     return run_gate_test('OR', emulate_asm_or, verifier, 2)
 
 def test_asm_not() -> bool:
+    if not assembler_installed('NOT'):
+        return True
     verifier = lambda a: not a
     return run_gate_test('NOT', emulate_asm_not, verifier, 1)
 
 def test_asm_and_or() -> bool:
+    if not assembler_installed('AND-OR'):
+        return True
     verifier = lambda a, b, c: (a and b) or c
     return run_gate_test('AND-OR', emulate_asm_and_or, verifier, 3)
 
+def test_asm_backends() -> bool:
+    """
+    Assembles the AND gate with each installed assembler backend, bypassing the caches, and runs it with that backend.
+    """
+    if not assembler_installed('ASM-BACKENDS'):
+        return True
+    backends = compiler.installed_backends()
+
+    all_passed = True
+    default_backend = compiler.DEFAULT_BACKEND
+    try:
+        for backend in backends:
+            machine_code = compiler.compile_asm(ASM_GATE_AND, os.path.join('output', 'asm-backends'), backend=backend,
+                                                cache_dir=None)
+            decoded = sum(size for _, size, _, _ in Cs(CS_ARCH_X86, CS_MODE_64).disasm_lite(machine_code or b'', 0))
+            if machine_code and decoded == len(machine_code):
+                print(f"Test passed for ASM-BACKENDS({backend}): {len(machine_code)} bytes")
+            else:
+                print(f"Test failed for ASM-BACKENDS({backend}): {machine_code}")
+                all_passed = False
+            compiler.DEFAULT_BACKEND = backend
+            all_passed &= run_gate_test(f'AND-{backend.upper()}', emulate_asm_and, lambda a, b: a and b, 2)
+    finally:
+        compiler.DEFAULT_BACKEND = default_backend
+    return all_passed
+
 ##########################################
 # GITM tests
 ##########################################
@@ -195,6 +259,439 @@ def test_flexo_simon32():
     
     return all_passed
 
+##########################################
+# Mode tests
+##########################################
+
+# the pooled gate tests, which must pass in each opt-in mode of tests/gate_modes.py
+MODE_GATE_TESTS = (test_gitm_assign, test_gitm_and, test_gitm_or, test_gitm_not, test_gitm_nand, test_gitm_mux,
+                   test_gitm_xor, test_flexo_and, test_flexo_or, test_flexo_not, test_flexo_nand, test_flexo_xor,
+                   test_flexo_xor3, test_flexo_xor4, test_flexo_mux, test_flexo_adder8, test_flexo_adder16)
+
+FLEXO_GATES = (('AND', emulate_flexo_and, 2), ('OR', emulate_flexo_or, 2), ('NOT', emulate_flexo_not, 1),
+               ('NAND', emulate_flexo_nand, 2), ('XOR', emulate_flexo_xor, 2), ('XOR3', emulate_flexo_xor3, 3),
+               ('XOR4', emulate_flexo_xor4, 4), ('MUX', emulate_flexo_mux, 3))
+
+def test_mode_sparse_hooks() -> bool:
+    return run_gate_tests_in_mode(gate_modes.MODE_SPARSE_HOOKS)
+
+def test_mode_roi() -> bool:
+    return run_gate_tests_in_mode(gate_modes.MODE_ROI)
+
+def test_mode_data_hit() -> bool:
+    return run_gate_tests_in_mode(gate_modes.MODE_DATA_HIT)
+
+def test_mode_data_ignore() -> bool:
+    return run_gate_tests_in_mode(gate_modes.MODE_DATA_IGNORE)
+
+def test_mode_snapshot() -> bool:
+    return run_gate_tests_in_mode(gate_modes.MODE_SNAPSHOT)
+
+def test_mode_demand_paging() -> bool:
+    return run_gate_tests_in_mode(gate_modes.MODE_DEMAND_PAGING)
+
+def test_mode_sparse_hooks_timer() -> bool:
+    """
+    Sparse hooks account most instructions per basic block, the gates' timers must still read the same cycles.
+    """
+    all_passed = True
+    for gate_name, emulate_function, num_inputs in FLEXO_GATES:
+        for inputs in itertools.product([0, 1], repeat=num_inputs):
+            full = run_timer_readings(emulate_function, inputs, None)
+            sparse = run_timer_readings(emulate_function, inputs, gate_modes.MODE_SPARSE_HOOKS)
+            if full == sparse:
+                print(f"Test passed for SPARSE-TIMER-{gate_name}{inputs}: {sparse}")
+            else:
+                print(f"Test failed for SPARSE-TIMER-{gate_name}{inputs}:")
+                print(f"\tExpected: {full}")
+                print(f"\tResult: {sparse}")
+                all_passed = False
+    return all_passed
+
+##########################################
+# Component tests
+##########################################
+
+def test_decode_cache_invalidate() -> bool:
+    # decoded instructions are reused until a write overlaps them, then the new bytes are decoded
+    uc = Uc(UC_ARCH_X86, UC_MODE_64)
+    uc.mem_map(0x1000, 0x1000)
+    uc.mem_write(0x1000, b'\x48\x89\xd8\x90')  # mov rax, rbx; nop
+    decode_cache = DecodeCache(detailed_cs())
+    mov = decode_cache.get_at(uc, 0x1000)
+    nop = decode_cache.get_at(uc, 0x1003)
+    reused = decode_cache.get_at(uc, 0x1000) is mov
+
+    uc.mem_write(0x1002, b'\xc3')  # mov rbx, rax
+    decode_cache.invalidate(0x1002, 1)
+    rewritten = decode_cache.get_at(uc, 0x1000)
+    passed = reused and rewritten.op_str == "rbx, rax" and decode_cache.get_at(uc, 0x1003) is nop \
+        and decode_cache.code_written
+    print(f"Test {'passed' if passed else 'failed'} for DECODE-CACHE: {mov.op_str} -> {rewritten.op_str}")
+    return passed
+
+def test_scoreboard_aliasing() -> bool:
+    # a register that isn't pending itself waits for the first pending register of its family
+    scoreboard = RegisterScoreboard()
+    scoreboard.set(UC_X86_REG_AL, 5)
+    scoreboard.set(UC_X86_REG_EAX, 3)
+    scoreboard.set(UC_X86_REG_RBX, 7)
+    checks = [
+        scoreboard.wait(UC_X86_REG_RAX) == 5,  # via al, which became pending first
+        scoreboard.wait(UC_X86_REG_AH) == 5,
+        scoreboard.wait(UC_X86_REG_EAX) == 3,  # pending itself
+        scoreboard.wait(UC_X86_REG_BL) == 7,
+        scoreboard.wait(UC_X86_REG_RCX) == 0,
+        UC_X86_REG_AX not in scoreboard and len(scoreboard) == 3,
+        scoreboard.items() == [(UC_X86_REG_AL, 5), (UC_X86_REG_EAX, 3), (UC_X86_REG_RBX, 7)],
+        sorted(scoreboard.remove_family(UC_X86_REG_AX)) == sorted([UC_X86_REG_AL, UC_X86_REG_EAX]),
+        scoreboard.wait(UC_X86_REG_RAX) == 0 and scoreboard.wait(UC_X86_REG_RBX) == 7,
+        scoreboard.remove_family(UC_X86_REG_AX) == [],
+    ]
+    scoreboard.set(UC_X86_REG_AH, 2)
+    scoreboard.clear()
+    checks.append(len(scoreboard) == 0 and scoreboard.wait(UC_X86_REG_RAX) == 0 and scoreboard.items() == [])
+    failed = [i for i, check in enumerate(checks) if not check]
+    print(f"Test {'failed' if failed else 'passed'} for SCOREBOARD-ALIASING{f': checks {failed}' if failed else ''}")
+    return not failed
+
+def test_cache_lru_eviction() -> bool:
+    # a full set evicts its least recently used line, hits and writes make a line the most recently used
+    cache = LRUCache(amt_sets=4, amt_ways=2, line_size=64, tag_only=True)
+    stride = cache.amt_sets * cache.line_size  # same set, next tag
+    a, b, c, d = (0x40 + i * stride for i in range(4))
+    cache.read(a, None)
+    cache.read(b, None)
+    cache.read(a, None)  # hit, b becomes the LRU line
+    cache.read(c, None)
+    checks = [cache.is_cached(a), not cache.is_cached(b), cache.is_cached(c)]
+    cache.write(a, None)  # c becomes the LRU line
+    cache.read(d, None)
+    checks += [cache.is_cached(a), not cache.is_cached(c), cache.is_cached(d),
+               list(cache.cache[1]) == [cache.get_tag(a), cache.get_tag(d)],
+               all(not ways for i, ways in enumerate(cache.cache) if i != 1)]  # other sets untouched
+    cache.flush_address(a + 8)  # flushes the whole line
+    cache.flush_address(b)  # not cached, nothing to flush
+    cache.read(b, None)  # fills the freed way, d isn't evicted
+    checks += [not cache.is_cached(a), cache.is_cached(b), cache.is_cached(d)]
+    failed = [i for i, check in enumerate(checks) if not check]
+    print(f"Test {'failed' if failed else 'passed'} for CACHE-LRU-EVICTION{f': checks {failed}' if failed else ''}")
+    return not failed
+
+def test_cache_tag_only_parity() -> bool:
+    # tag-only caches hit and miss exactly like the ones that keep line data, without reading memory
+    uc = Uc(UC_ARCH_X86, UC_MODE_64)
+    uc.mem_map(0x10000, 0x10000)
+    uc.mem_write(0x10000, bytes(range(256)) * 256)
+    rng = random.Random(0)
+    accesses = [(rng.choice("rwf"), 0x10000 + rng.randrange(0x10000 - 64)) for _ in range(2000)]  # misses read 64 bytes
+    all_passed = True
+    for make_cache in (lambda tag_only: LRUCache(amt_sets=8, amt_ways=2, tag_only=tag_only),
+                       lambda tag_only: InfiniteCache(amt_sets=8, tag_only=tag_only)):
+        full, tag_only = make_cache(False), make_cache(True)
+        data_ok, diverged = True, None
+        for i, (kind, address) in enumerate(accesses):
+            if kind == "r":
+                missed = not full.is_cached(address)
+                line = full.read(address, uc)
+                data_ok &= (not missed or bytes(line) == bytes(uc.mem_read(address, 64))) and tag_only.read(address, None) is None
+            elif kind == "w":
+                full.write(address, address)  # like the write hook, which passes the written value
+                tag_only.write(address, address)
+            else:
+                full.flush_address(address)
+                tag_only.flush_address(address)
+            probe = 0x10000 + rng.randrange(0x10000)
+            if diverged is None and (full.is_cached(address) != tag_only.is_cached(address)
+                                     or full.is_cached(probe) != tag_only.is_cached(probe)):
+                diverged = i
+        stored_none = all(value is None for ways in tag_only.cache for value in ways.values())
+        name = type(full).__name__
+        if diverged is None and data_ok and stored_none:
+            print(f"Test passed for TAG-ONLY-{name}")
+        else:
+            print(f"Test failed for TAG-ONLY-{name}: diverged at {diverged}, data {data_ok}, tags only {stored_none}")
+            all_passed = False
+    return all_passed
+
+def test_demand_paging_line() -> bool:
+    # a miss on the last bytes of a demand chunk reads line_size bytes from the address, so the next chunk is mapped too
+    region_start = 0x100000
+    address = region_start + (1 << DEMAND_CHUNK_SHIFT) - 8
+    with MuWMEmulator(name='demand-paging-line', loader=MachineCodeLoader(b'\x48\x8b\x03'), debug=False,  # mov rax, [rbx]
+                      cache=InfiniteCache()) as emulator:
+        emulator.add_demand_region(region_start, region_start + (2 << DEMAND_CHUNK_SHIFT), UC_PROT_READ | UC_PROT_WRITE)
+        emulator.uc.reg_write(UC_X86_REG_RBX, address)
+        try:
+            emulator.emulate()
+            line = emulator.cache.read(address, emulator.uc)  # a hit, the line data of the miss
+            passed = bytes(line) == bytes(emulator.uc.mem_read(address, 64)) \
+                and emulator.demand_chunks == {region_start, region_start + (1 << DEMAND_CHUNK_SHIFT)}
+        except Exception as e:
+            print(f"\tError: {e}")
+            passed = False
+    print(f"Test {'passed' if passed else 'failed'} for DEMAND-PAGING-LINE(0x{address:x})")
+    return passed
+
+def test_fault_context() -> bool:
+    # only instructions that can fault snapshot the registers, a fault restores the snapshot of its own instruction
+    seen = {}
+    def handler(errno: int) -> int:
+        seen['fault'] = (emulator.previous_context_addr, emulator.uc.reg_read(UC_X86_REG_RIP),
+                         emulator.uc.reg_read(UC_X86_REG_RAX))
+        return 0  # not handled, emulation stops
+
+    with MuWMEmulator(name='fault-context', loader=MachineCodeLoader(FAULT_CODE), debug=False) as emulator:
+        emulator.uc.mem_write(emulator.data_start_addr, (5).to_bytes(8, 'little'))
+        emulator.fault_handlers[UC_ERR_EXCEPTION] = handler
+        emulator.uc.hook_add(UC_HOOK_CODE, lambda uc, address, size, data: seen.setdefault('xor', emulator.previous_context_addr),
+                             None, FAULT_CODE_BASE + 0xe, FAULT_CODE_BASE + 0xe)
+        emulator.emulate()
+    # the load at +0x7 is the last instruction that can fault before xor, the div at +0x12 faults after the add
+    passed = seen.get('xor') == FAULT_CODE_BASE + 0x7 and seen.get('fault') == (FAULT_CODE_BASE + 0x12, FAULT_CODE_BASE + 0x12, 12)
+    print(f"Test {'passed' if passed else 'failed'} for FAULT-CONTEXT: {seen}")
+    return passed
+
+def test_fault_handler() -> bool:
+    # a custom handler gets the CPU exception from the interrupt hook and emulation continues where it says
+    calls = []
+    def skip_div(errno: int) -> int:
+        calls.append(errno)
+        return FAULT_CODE_BASE + 0x15
+
+    with MuWMEmulator(name='fault-handler', loader=MachineCodeLoader(FAULT_CODE), debug=False) as emulator:
+        emulator.fault_handlers[UC_ERR_EXCEPTION] = skip_div
+        emulator.emulate()
+        rsi = emulator.uc.reg_read(UC_X86_REG_RSI)
+        passed = calls == [UC_ERR_EXCEPTION] and rsi == 1 and not emulator.in_speculation and not emulator.checkpoints
+    print(f"Test {'passed' if passed else 'failed'} for FAULT-HANDLER: calls {calls}, rsi {rsi}")
+    return passed
+
+def test_elf_image_cache() -> bool:
+    # an ELF file is parsed once per path, and again once its mtime or size changes
+    path = os.path.join('output', 'elf-tests', 'gate_and.elf')
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    shutil.copyfile('gates/flexo/gates/gate_and.elf', path)
+    first = ELFImage.get(path)
+    checks = [ELFImage.get(path) is first,
+              ELFImage.get(os.path.join('output', 'elf-tests', '..', 'elf-tests', 'gate_and.elf')) is first]
+
+    stat = os.stat(path)
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000_000))
+    touched = ELFImage.get(path)
+    checks += [touched is not first, first.data.closed, ELFImage.get(path) is touched]
+
+    stat = os.stat(path)
+    with open(path, 'ab') as f:
+        f.write(b'\0')  # same mtime, one byte longer
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+    grown = ELFImage.get(path)
+    checks += [grown is not touched, touched.data.closed, grown.stamp[1] == stat.st_size + 1,
+               [bytes(contents) for _, contents in grown.segments]
+               == [bytes(contents) for _, contents in ELFImage.get('gates/flexo/gates/gate_and.elf').segments]]
+    failed = [i for i, check in enumerate(checks) if not check]
+    print(f"Test {'failed' if failed else 'passed'} for ELF-IMAGE-CACHE{f': checks {failed}' if failed else ''}")
+    return not failed
+
+def test_state_roundtrip() -> bool:
+    # a Flexo AND gate saved after n instructions (after 500 it speculates) and resumed in a new emulator computes the
+    # same output
+    path = os.path.join('output', 'state-tests', 'flexo-and.state')
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    def load_gate() -> MuWMEmulator:
+        emulator = gate_modes.build_gate('flexo-and-state', 'gates/flexo/gates/gate_and.elf', 0x11e0, 0x13fb, False,
+                                         plt_stubs=LIBC_STUBS)
+        _ensure_memory(emulator, OUT_ADDR_BOOL)
+        return emulator
+
+    all_passed = True
+    for inputs in itertools.product([0, 1], repeat=2):
+        for save_after in (10, 60, 200, 500):
+            with load_gate() as emulator:
+                executed = [0]
+                speculating = []
+                def save_hook(uc, address, size, user_data):
+                    executed[0] += 1
+                    if executed[0] == save_after:
+                        emulator.save_state(path, extra=inputs)
+                        speculating.append(emulator.in_speculation)
+                emulator.uc.hook_add(UC_HOOK_CODE, save_hook)
+                emulator.uc.reg_write(UC_X86_REG_RDI, inputs[0])
+                emulator.uc.reg_write(UC_X86_REG_RSI, inputs[1])
+                emulator.uc.reg_write(UC_X86_REG_RDX, OUT_ADDR_BOOL)
+                emulator.emulate()
+                expected = emulator.uc.mem_read(OUT_ADDR_BOOL, 1)[0]
+
+            with load_gate() as emulator:
+                extra = emulator.load_state(path)
+                emulator.emulate()
+                result = emulator.uc.mem_read(OUT_ADDR_BOOL, 1)[0]
+
+            if executed[0] >= save_after and result == expected == (inputs[0] & inputs[1]) and extra == list(inputs) \
+                    and speculating == [save_after == 500]:
+                print(f"Test passed for STATE-ROUNDTRIP{inputs} after {save_after} instructions")
+            else:
+                print(f"Test failed for STATE-ROUNDTRIP{inputs} after {save_after} instructions:")
+                print(f"\tExpected: {expected}")
+                print(f"\tResult: {result} (extra {extra}, {executed[0]} instructions executed, speculating {speculating})")
+                all_passed = False
+    return all_passed
+
+def test_trace_filter_compile() -> bool:
+    # each criterion must hold, any of its values may match, symbols resolve to ranges
+    symbols = {'round_fn': (0x2000, 0x2100)}
+    trace_filter = TraceFilter(address_ranges=[(0x1000, 0x1010)], symbols=['round_fn'], speculative_only=True,
+                               mnemonics=['mov', 'add'], mem_ranges=[(0x8000, 0x8040)], rounds=[2, 3])
+    predicate = trace_filter.compile(symbols.get)
+
+    def state(**changes):
+        em = SimpleNamespace(curr_insn_address=0x2010, in_speculation=True, curr_insn=SimpleNamespace(mnemonic='add'),
+                             curr_mem_address=0x8008, curr_mem_insn_address=0x2010, round_count=[3])
+        for name, value in changes.items():
+            setattr(em, name, value)
+        return em
+
+    cases = [
+        (state(), True),
+        (state(curr_insn_address=0x100c, curr_mem_insn_address=0x100c), True),
+        (state(curr_insn_address=0x1010, curr_mem_insn_address=0x1010), False),  # ranges are half-open
+        (state(in_speculation=False), False),
+        (state(curr_insn=SimpleNamespace(mnemonic='sub')), False),
+        (state(curr_mem_address=0x8040), False),
+        (state(curr_mem_insn_address=0x2000), False),  # the access belongs to an earlier instruction
+        (state(round_count=[1]), False),
+        (state(round_count=None), False),
+    ]
+    results = [predicate(em) for em, _ in cases]
+    passed = results == [expected for _, expected in cases] and TraceFilter().compile(symbols.get) is None
+    try:
+        TraceFilter(symbols=['missing']).compile(symbols.get)
+        passed = False
+    except ValueError:
+        pass
+    print(f"Test {'passed' if passed else 'failed'} for TRACE-FILTER: {results}")
+    return passed
+
+##########################################
+# Trace tests
+##########################################
+
+def test_trace_roundtrip() -> bool:
+    # every record type, with address deltas that need rebasing, decodes to the events that were written
+    path = os.path.join('output', 'trace-tests', 'roundtrip.bin')
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    nop = decode_insn(b'\x90', 0x1000)
+    far_nop = decode_insn(b'\x90', 0x7fff_0000_0000)
+    with TraceWriter(path) as trace:
+        trace.insn(nop)
+        trace.mem_read(0x2000, 8, False)
+        trace.mem_read(0x7000_0000_0000, 4, True)
+        trace.mem_write(0x2040, 8, -1)
+        trace.checkpoint(0x1001)
+        trace.insn(far_nop)
+        trace.spec_window_exceeded(250, 200)
+        trace.rollback(0x1001)
+        trace.cache_flush(0x2000)
+        trace.round(3)
+        trace.insn(nop)
+    expected = [
+        (EV_INSN, 0x1000, 1, 0, b'\x90'),
+        (EV_MEM_READ_MISS, 0x2000, 8, 0, b''),
+        (EV_MEM_READ_HIT, 0x7000_0000_0000, 4, 0, b''),
+        (EV_MEM_WRITE, 0x2040, 8, 0xFFFFFFFFFFFFFFFF, b''),
+        (EV_CHECKPOINT, 0x1001, 0, 0, b''),
+        (EV_INSN, 0x7fff_0000_0000, 1, 0, b'\x90'),
+        (EV_SPEC_WINDOW_EXCEEDED, 0, 250, 200, b''),
+        (EV_ROLLBACK, 0x1001, 0, 0, b''),
+        (EV_CACHE_FLUSH, 0x2000, 0, 0, b''),
+        (EV_ROUND, 0, 0, 3, b''),
+        (EV_INSN, 0x1000, 1, 0, b'\x90'),
+    ]
+    events = [tuple(event) for event in read_trace(path)]
+    passed = events == expected
+    print(f"Test {'passed' if passed else 'failed'} for TRACE-ROUNDTRIP: {len(events)} events")
+    if not passed:
+        for event, expected_event in zip(events, expected):
+            if event != expected_event:
+                print(f"\tExpected: {expected_event}")
+                print(f"\tResult: {event}")
+                break
+    return passed
+
+def test_trace_index_seek() -> bool:
+    # queries through the index match a linear decode of the whole trace, across blocks and rebases
+    path = os.path.join('output', 'trace-tests', 'index.bin')
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    nops = [decode_insn(b'\x90', 0x1000 + i) for i in range(64)]
+    with TraceWriter(path) as trace:
+        for i in range(3 * BLOCK_EVENTS):
+            if i % 1000 == 0:
+                trace.round(i // 1000)
+            if i % 700 == 0:
+                trace.checkpoint(0x1000)
+            trace.insn(nops[i % 64])
+            trace.mem_read((i % 5) << 40 | (i % 64) * 8, 8, i % 3 == 0)  # 5 regions far apart, rebased
+            if i % 700 == 5:
+                trace.rollback(0x1000)
+    if os.path.exists(path + '.idx'):
+        os.remove(path + '.idx')  # an index with the same mtime as the trace would count as up to date
+
+    events = list(read_trace(path))
+    insns = [event for event in events if event[0] == EV_INSN]
+    rounds = [i for i, event in enumerate(events) if event[0] == EV_ROUND]
+    checkpoints = [i for i, event in enumerate(events) if event[0] == EV_CHECKPOINT]
+    rollbacks = [i for i, event in enumerate(events) if event[0] == EV_ROLLBACK]
+    address = (3 << 40) + 17 * 8
+    expected = {
+        'seek': [insns[n] for n in (0, 1, BLOCK_EVENTS // 2 + 7, len(insns) - 1)],
+        'round': events[rounds[7]:rounds[8]],
+        'window': events[checkpoints[5]:rollbacks[5] + 1],
+        'accesses': [event for event in events if event[0] in (EV_MEM_READ_HIT, EV_MEM_READ_MISS)
+                     and event[1] <= address < event[1] + event[2]],
+    }
+
+    all_passed = True
+    for built in (True, False):  # built from the trace, then loaded from the saved index
+        index = TraceIndex(path)
+        results = {
+            'seek': [next(index.seek_insn(n)).event for n in (0, 1, BLOCK_EVENTS // 2 + 7, len(insns) - 1)],
+            'round': [indexed.event for indexed in index.round(index.find_rounds(7)[0])],
+            'window': [indexed.event for indexed in index.window(5)],
+            'accesses': [indexed.event for indexed in index.accesses(address)],
+        }
+        for query, result in results.items():
+            passed = bool(result) and result == expected[query]
+            print(f"Test {'passed' if passed else 'failed'} for TRACE-INDEX-{query.upper()}({'built' if built else 'loaded'}): "
+                  f"{len(result)} events")
+            all_passed &= passed
+    return all_passed
+
+def test_trace_self_modifying_code() -> bool:
+    # code rewritten at an executed address gets a new EV_CODE record, so the trace disassembles to the new instruction
+    path = os.path.join('output', 'trace-tests', 'smc.bin')
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with TraceWriter(path) as trace:
+        for code in (b'\x90', b'\x90', b'\xc3'):  # nop, nop again, then a ret written over it
+            trace.insn(decode_insn(code, 0x1000))
+    events = [event for event in read_trace(path) if event[0] == EV_INSN]
+    executed = [insn_bytes for _, _, _, _, insn_bytes in events]
+    rendered = [format_event(event) for event in events]
+    passed = executed == [b'\x90', b'\x90', b'\xc3'] and rendered == ["Executing 0x1000: nop "] * 2 + ["Executing 0x1000: ret "]
+    print(f"Test {'passed' if passed else 'failed'} for TRACE-SMC: {executed}, {rendered}")
+    return passed
+
+##########################################
+# Resource tests
+##########################################
+
+def test_resource_leaks() -> bool:
+    # a short version of the bulk check in timing_tests.py, still builds and closes 100 emulators
+    from timing_tests import check_resource_leaks
+    passed = check_resource_leaks(num_evaluations=1000)
+    print(f"Test {'passed' if passed else 'failed'} for RESOURCE_LEAKS")
+    return passed
+
 # def test_flexo_sha1_2blocks():
 #      # Use the same random seed as your working 1-block test for consistency
 #     random.seed(12345)
@@ -254,10 +751,12 @@ def run_gate_test(gate_name, emulate_function, verifier, num_inputs, debug=False
                 print(f"Test failed for {gate_name}{inputs}:")
                 print(f"\tExpected: {expected}")
                 print(f"\tResult: {result}")
+                print(f"\tFlight recorder: {MuWMEmulator.dump_last_flight_recorder()}")
                 all_passed = False
                 
         except Exception as e:
             print(f"Test error for {gate_name}{inputs}: {e}")
+            print(f"\tFlight recorder: {MuWMEmulator.dump_last_flight_recorder()}")
             all_passed = False
     
     return all_passed
@@ -283,12 +782,61 @@ def run_adder_flexo_test(adder_name, emulate_function, verifier, bits, runs=4,de
             print(f"Test failed for {adder_name}({a}, {b}):")
             print(f"\tExpected: {expected}")
             print(f"\tResult:   {result}")
+            print(f"\tFlight recorder: {MuWMEmulator.dump_last_flight_recorder()}")
             all_passed = False
         else:
             print(f"Test passed for {adder_name}({a}, {b})")
 
     return all_passed
 
+def run_gate_tests_in_mode(mode: str) -> bool:
+    """
+    Runs the truth tables of the pooled gates, with the gates built in the given mode.
+    """
+    gate_modes.set_mode(mode)
+    try:
+        all_passed = True
+        for test in MODE_GATE_TESTS:
+            all_passed &= test()
+        return all_passed
+    finally:
+        gate_modes.set_mode(None)
+
+def run_timer_readings(emulate_function, inputs, mode: str) -> List[int]:
+    """
+    Runs a gate in the given mode and returns the cycles its rdtscp instructions read, from the flight recorder.
+    """
+    gate_modes.set_mode(mode)
+    try:
+        emulate_function(*inputs)
+    finally:
+        gate_modes.set_mode(None)
+    events = MuWMEmulator.last_flight_recorder.events
+    return [args[0] for message, args in events if message == "\tRDTSC cycles: %d"]
+
+class MachineCodeLoader(AsmLoader):
+    """
+    Loads machine code into AsmLoader's memory layout, so a test doesn't need an assembler.
+    """
+    def __init__(self, machine_code: bytes):
+        super().__init__(None)
+        self.machine_code = machine_code
+
+    def load(self, emulator):
+        self._map_memory(emulator)
+
+# mov rbx, DATA_BASE; mov rax, [rbx]; add rax, 7; xor edx, edx; xor ecx, ecx; div rcx; mov rsi, 1
+FAULT_CODE_BASE = AsmLoader.CODE_BASE
+FAULT_CODE = bytes.fromhex('48c7c300200000' '488b03' '4883c007' '31d2' '31c9' '48f7f1' '48c7c601000000')
+
+def detailed_cs() -> Cs:
+    cs = Cs(CS_ARCH_X86, CS_MODE_64)
+    cs.detail = True  # DecodedInsn reads the operands
+    return cs
+
+def decode_insn(code: bytes, address: int) -> DecodedInsn:
+    return DecodedInsn(next(detailed_cs().disasm(code, address)))
+
 ##########################################
 # CLI
 ##########################################
@@ -301,11 +849,13 @@ def run_all_tests():
                      if name.startswith('test_') and callable(globals()[name])]
     
     print(f"Running {len(test_functions)} tests:")
+    all_passed = True
     for test_func_name in test_functions:
         print(f"\n--- Running {test_func_name} ---")
-        globals()[test_func_name]()
+        all_passed &= globals()[test_func_name]() is not False
     
     print("\nAll tests have been run!")
+    return all_passed
 
 def run_tests_by_prefix(prefix):
     """
@@ -316,14 +866,16 @@ def run_tests_by_prefix(prefix):
     
     if not test_functions:
         print(f"No tests found with prefix 'test_{prefix}'")
-        return
+        return False
     
     print(f"Running {len(test_functions)} {prefix.upper()} tests:")
+    all_passed = True
     for test_func_name in test_functions:
         print(f"\n--- Running {test_func_name} ---")
-        globals()[test_func_name]()
+        all_passed &= globals()[test_func_name]() is not False
     
     print(f"\nAll {prefix.upper()} tests have been run!")
+    return all_passed
 
 if __name__ == "__main__":
     if len(sys.argv) != 2:
@@ -332,6 +884,7 @@ if __name__ == "__main__":
         print("       python unit_tests.py asm (to run all ASM tests)")
         print("       python unit_tests.py gitm (to run all GITM (Ghost is the Machine) tests)")
         print("       python unit_tests.py flexo (to run all Flexo tests)")
+        print("       python unit_tests.py mode (to run the gate tests in all opt-in emulator modes)")
         print("Available tests:")
         # List all functions that start with 'test_'
         # tests = [name for name in globals() if name.startswith('test_')]
@@ -340,13 +893,19 @@ if __name__ == "__main__":
         sys.exit(1)
 
     test_name = sys.argv[1]
-    if test_name.lower() == 'all':
-        run_all_tests()
-    elif test_name.lower() in ['asm', 'gitm', 'flexo']:
-        run_tests_by_prefix(test_name.lower())
-    elif test_name in globals() and test_name.startswith('test_'):
-        globals()[test_name]()  # Run the requested test
-        print("Finished unit tests")
-    else:
-        print(f"Error: Test '{test_name}' not found")
-        sys.exit(1)
\ No newline at end of file
+    try:
+        if test_name.lower() == 'all':
+            passed = run_all_tests()
+        elif test_name.lower() in ['asm', 'gitm', 'flexo', 'mode']:
+            passed = run_tests_by_prefix(test_name.lower())
+        elif test_name in globals() and test_name.startswith('test_'):
+            passed = globals()[test_name]() is not False  # Run the requested test
+            print("Finished unit tests")
+        else:
+            print(f"Error: Test '{test_name}' not found")
+            sys.exit(1)
+    finally:
+        for pool in (asm_pool, flexo_pool, gitm_pool):
+            pool.close()
+    if not passed:
+        sys.exit(1)  # so scripts and CI notice failures
\ No newline at end of file